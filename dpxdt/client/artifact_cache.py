@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+# Copyright 2013 Brett Slatkin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Local cache of downloaded artifacts, keyed by their content hash.
+
+Workers download the same configs and reference images for many tasks.
+With --artifact_cache_dir set, DownloadArtifactWorkflow keeps a copy of
+each artifact it downloads and hardlinks it into place the next time the
+same content is needed. Cached files are read-only, since every hardlink to
+them shares the same data.
+"""
+
+import collections
+import errno
+import hashlib
+import logging
+import os
+import re
+import shutil
+import stat
+import tempfile
+import threading
+
+# Local Libraries
+import gflags
+FLAGS = gflags.FLAGS
+
+
+gflags.DEFINE_string(
+    'artifact_cache_dir', None,
+    'Directory for caching downloaded artifacts on this worker. When not '
+    'set, artifacts are downloaded every time they are needed.')
+
+gflags.DEFINE_integer(
+    'artifact_cache_mb', 1024,
+    'Most megabytes of artifacts to keep in --artifact_cache_dir. The least '
+    'recently used artifacts are removed first.')
+
+
+SHA1SUM_RE = re.compile('^[0-9a-f]{40}$')
+
+
+def link_or_copy(source_path, dest_path):
+    """Hardlinks the source to the destination, replacing it if it exists.
+
+    Falls back to copying when the paths are on different filesystems or
+    hardlinks aren't supported.
+    """
+    try:
+        os.remove(dest_path)
+    except OSError:
+        pass
+
+    try:
+        os.link(source_path, dest_path)
+    except OSError:
+        shutil.copyfile(source_path, dest_path)
+
+
+def get_file_sha1sum(path):
+    """Returns the hex SHA-1 hash of the file's content."""
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as data_file:
+        while True:
+            data = data_file.read(1024 * 1024)
+            if not data:
+                break
+            sha1.update(data)
+    return sha1.hexdigest()
+
+
+class ArtifactCache(object):
+    """Size-bounded, least-recently-used cache of artifacts on disk.
+
+    Each artifact is stored in a file named after its SHA-1 hash. Any number
+    of threads may fill the cache at once: each new file is completely
+    written before it's linked into place, and whichever fill is first for
+    the same content wins. The modified time of each file is updated when
+    it's used, so the order survives restarts.
+    """
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        # Maps sha1sum to file size, least recently used first.
+        self.entries = collections.OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        self._load()
+
+    def _get_path(self, sha1sum):
+        return os.path.join(self.cache_dir, sha1sum)
+
+    def _load(self):
+        found = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if name.endswith('.tmp'):
+                # Left over from a fill that was interrupted.
+                os.remove(path)
+            elif SHA1SUM_RE.match(name):
+                stat_result = os.stat(path)
+                found.append(
+                    (stat_result.st_mtime, name, stat_result.st_size))
+
+        with self.lock:
+            for _, sha1sum, size in sorted(found):
+                self.entries[sha1sum] = size
+                self.total_bytes += size
+            self._evict()
+
+    def _evict(self):
+        # Must hold the lock.
+        while self.total_bytes > self.max_bytes and self.entries:
+            sha1sum, size = self.entries.popitem(last=False)
+            self.total_bytes -= size
+            self.evictions += 1
+            try:
+                os.remove(self._get_path(sha1sum))
+            except OSError:
+                pass
+
+    def get(self, sha1sum, result_path):
+        """Puts the cached artifact at the result path, if it's cached.
+
+        Returns:
+            True if the artifact was cached, False otherwise.
+        """
+        with self.lock:
+            size = self.entries.pop(sha1sum, None)
+            if size is None:
+                self.misses += 1
+                return False
+            self.entries[sha1sum] = size
+
+        cache_path = self._get_path(sha1sum)
+        try:
+            link_or_copy(cache_path, result_path)
+            os.utime(cache_path, None)
+        except (IOError, OSError):
+            # Evicted by another thread before it could be linked.
+            with self.lock:
+                self.misses += 1
+            return False
+
+        with self.lock:
+            self.hits += 1
+        return True
+
+    def put(self, sha1sum, path):
+        """Adds the file at the path to the cache as the given artifact.
+
+        The file is left where it is. Nothing is cached if the file's content
+        doesn't match the hash.
+        """
+        if not SHA1SUM_RE.match(sha1sum or ''):
+            return
+        if get_file_sha1sum(path) != sha1sum:
+            logging.warning('Not caching artifact with bad content '
+                            'sha1sum=%r, path=%r', sha1sum, path)
+            return
+
+        size = os.path.getsize(path)
+        if size > self.max_bytes:
+            return
+
+        cache_path = self._get_path(sha1sum)
+        handle, temp_path = tempfile.mkstemp(
+            dir=self.cache_dir, suffix='.tmp')
+        os.close(handle)
+        try:
+            link_or_copy(path, temp_path)
+            os.chmod(temp_path, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+            try:
+                os.link(temp_path, cache_path)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+                # Another fill of the same content finished first.
+        finally:
+            os.remove(temp_path)
+
+        with self.lock:
+            if sha1sum not in self.entries:
+                self.entries[sha1sum] = size
+                self.total_bytes += size
+                self._evict()
+
+
+_CACHE = None
+_CACHE_LOCK = threading.Lock()
+
+
+def get_cache():
+    """Returns the ArtifactCache for this process, or None if disabled."""
+    global _CACHE
+    # Filling the cache safely relies on hardlinks.
+    if not FLAGS.artifact_cache_dir or not hasattr(os, 'link'):
+        return None
+    with _CACHE_LOCK:
+        if _CACHE is None:
+            _CACHE = ArtifactCache(
+                FLAGS.artifact_cache_dir,
+                FLAGS.artifact_cache_mb * 1024 * 1024)
+        return _CACHE
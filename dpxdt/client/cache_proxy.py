@@ -0,0 +1,554 @@
+#!/usr/bin/env python
+# Copyright 2013 Brett Slatkin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Caching HTTP forward proxy shared by the capture processes on a worker.
+
+Captures of many pages from the same site load the same fonts, stylesheets,
+scripts and images over and over. Pointing every capture browser at this
+proxy lets them share one on-disk cache of those responses.
+
+Plain HTTP GET responses are cached when their Cache-Control or Expires
+headers allow it, and stale responses with an ETag or Last-Modified header
+are revalidated with a conditional request. URLs ending in one of the
+--capture_proxy_force_cache_suffixes are cached whatever their headers say.
+HTTPS is tunneled with CONNECT and can't be cached.
+
+Requesting /stats from the proxy itself returns its hit rate and other
+counters as JSON.
+"""
+
+import BaseHTTPServer
+import SocketServer
+import calendar
+import collections
+import email.utils
+import hashlib
+import httplib
+import json
+import logging
+import os
+import select
+import socket
+import tempfile
+import threading
+import time
+import urlparse
+
+# Local Libraries
+import gflags
+FLAGS = gflags.FLAGS
+
+
+gflags.DEFINE_string(
+    'capture_proxy_cache_dir', None,
+    'Directory for the on-disk cache of the capture proxy. When set, a '
+    'caching HTTP proxy is started and all capture processes use it. '
+    'Only plain HTTP responses are cached; HTTPS is tunneled with CONNECT '
+    'and always goes to the remote server.')
+
+gflags.DEFINE_integer(
+    'capture_proxy_cache_mb', 512,
+    'Most megabytes of responses to keep in the capture proxy cache. The '
+    'least recently used responses are removed first.')
+
+gflags.DEFINE_integer(
+    'capture_proxy_port', 0,
+    'Port for the capture proxy to listen on. Zero picks a free port.')
+
+gflags.DEFINE_list(
+    'capture_proxy_force_cache_suffixes', [],
+    'URL path suffixes, like .css,.js,.woff, that the capture proxy caches '
+    'even when the response headers say not to.')
+
+gflags.DEFINE_integer(
+    'capture_proxy_force_cache_seconds', 3600,
+    'How long responses cached because of their suffix stay fresh.')
+
+gflags.DEFINE_integer(
+    'capture_proxy_timeout', 60,
+    'Seconds until the capture proxy gives up on a remote server.')
+
+
+# Headers that only apply to a single connection and must not be forwarded.
+HOP_BY_HOP_HEADERS = frozenset([
+    'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization',
+    'proxy-connection', 'te', 'trailer', 'transfer-encoding', 'upgrade'])
+
+# Headers that aren't stored with a cached response.
+UNCACHED_HEADERS = HOP_BY_HOP_HEADERS | frozenset(['content-length'])
+
+
+def get_header(headers, name):
+    """Returns the first value of a header in a list of pairs, or None."""
+    name = name.lower()
+    for key, value in headers:
+        if key.lower() == name:
+            return value
+    return None
+
+
+def parse_cache_control(value):
+    """Returns a dictionary of Cache-Control directives to their values."""
+    directives = {}
+    for part in (value or '').split(','):
+        name, _, argument = part.strip().partition('=')
+        if name:
+            directives[name.lower()] = argument.strip('"')
+    return directives
+
+
+def parse_http_date(value):
+    """Returns the Unix time of an HTTP date header, or None."""
+    parsed = value and email.utils.parsedate(value)
+    if not parsed:
+        return None
+    return calendar.timegm(parsed)
+
+
+def get_freshness_seconds(headers, now):
+    """Returns how long a response may be served from a shared cache.
+
+    Args:
+        headers: List of (name, value) response header pairs.
+        now: Current Unix time, used when there is no Date header.
+
+    Returns:
+        Seconds the response stays fresh, which may be zero when it must
+        be revalidated before every use, or None if it may not be stored.
+    """
+    directives = parse_cache_control(get_header(headers, 'cache-control'))
+    if 'no-store' in directives or 'private' in directives:
+        return None
+    if 'no-cache' in directives:
+        return 0
+
+    for name in ('s-maxage', 'max-age'):
+        if name in directives:
+            try:
+                return max(0, int(directives[name]))
+            except ValueError:
+                return 0
+
+    expires = get_header(headers, 'expires')
+    if expires is not None:
+        expires_time = parse_http_date(expires)
+        if expires_time is None:
+            # Invalid dates like "0" mean already expired.
+            return 0
+        date_time = parse_http_date(get_header(headers, 'date'))
+        if date_time is None:
+            date_time = now
+        return max(0, expires_time - date_time)
+
+    return None
+
+
+class DiskCache(object):
+    """Bounded least-recently-used cache of HTTP responses on disk.
+
+    Each response is stored in its own file named after the hash of its URL,
+    with a line of JSON metadata followed by the body. The modified time of
+    each file is updated when it's used, so the order survives restarts.
+    """
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        # Maps key to file size, least recently used first.
+        self.entries = collections.OrderedDict()
+        self.total_bytes = 0
+        self.evictions = 0
+
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        self._load()
+
+    def _get_path(self, key):
+        return os.path.join(self.cache_dir, key + '.entry')
+
+    def _load(self):
+        found = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if name.endswith('.tmp'):
+                # Left over from a write that was interrupted.
+                os.remove(path)
+            elif name.endswith('.entry'):
+                stat = os.stat(path)
+                found.append((stat.st_mtime, name[:-len('.entry')],
+                              stat.st_size))
+
+        for _, key, size in sorted(found):
+            self.entries[key] = size
+            self.total_bytes += size
+
+        with self.lock:
+            self._evict()
+
+    def _evict(self):
+        # Must hold the lock.
+        while self.total_bytes > self.max_bytes and self.entries:
+            key, size = self.entries.popitem(last=False)
+            self.total_bytes -= size
+            self.evictions += 1
+            try:
+                os.remove(self._get_path(key))
+            except OSError:
+                pass
+
+    def get(self, url):
+        """Returns a (metadata, body) tuple for the URL, or None."""
+        key = hashlib.sha1(url).hexdigest()
+        path = self._get_path(key)
+        with self.lock:
+            size = self.entries.pop(key, None)
+            if size is None:
+                return None
+            self.entries[key] = size
+
+        try:
+            with open(path, 'rb') as entry_file:
+                metadata = json.loads(entry_file.readline())
+                body = entry_file.read()
+            os.utime(path, None)
+        except (IOError, OSError, ValueError):
+            # Evicted or replaced while being read.
+            return None
+
+        if metadata.get('url') != url:
+            return None
+        return metadata, body
+
+    def put(self, url, metadata, body):
+        """Stores a response for the URL, replacing any previous one."""
+        key = hashlib.sha1(url).hexdigest()
+        metadata = dict(metadata, url=url)
+
+        handle, temp_path = tempfile.mkstemp(
+            dir=self.cache_dir, suffix='.tmp')
+        with os.fdopen(handle, 'wb') as entry_file:
+            entry_file.write(json.dumps(metadata))
+            entry_file.write('\n')
+            entry_file.write(body)
+        size = os.path.getsize(temp_path)
+
+        if size > self.max_bytes:
+            os.remove(temp_path)
+            return
+
+        with self.lock:
+            os.rename(temp_path, self._get_path(key))
+            self.total_bytes -= self.entries.pop(key, 0)
+            self.entries[key] = size
+            self.total_bytes += size
+            self._evict()
+
+
+class ProxyHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Handles one connection from a capture browser to the proxy."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        logging.debug('Capture proxy: ' + format, *args)
+
+    def do_GET(self):
+        if not self.path.startswith('http://'):
+            self.send_stats()
+        else:
+            self.proxy_request()
+
+    def do_HEAD(self):
+        self.proxy_request()
+
+    do_POST = do_HEAD
+    do_PUT = do_HEAD
+    do_DELETE = do_HEAD
+    do_OPTIONS = do_HEAD
+    do_PATCH = do_HEAD
+
+    def do_CONNECT(self):
+        """Tunnels an HTTPS connection to the remote server."""
+        self.close_connection = 1
+        host, _, port = self.path.rpartition(':')
+        try:
+            remote = socket.create_connection(
+                (host, int(port)), FLAGS.capture_proxy_timeout)
+        except (socket.error, ValueError), e:
+            self.server.record('errors')
+            self.send_error(502, 'Could not connect: %s' % e)
+            return
+
+        self.server.record('tunnels')
+        try:
+            self.send_response(200, 'Connection established')
+            self.end_headers()
+
+            connections = [self.connection, remote]
+            while True:
+                readable, _, errored = select.select(
+                    connections, [], connections,
+                    FLAGS.capture_proxy_timeout)
+                if errored or not readable:
+                    break
+                for source in readable:
+                    data = source.recv(65536)
+                    if not data:
+                        return
+                    if source is remote:
+                        self.connection.sendall(data)
+                    else:
+                        remote.sendall(data)
+        except socket.error:
+            pass
+        finally:
+            remote.close()
+
+    def send_stats(self):
+        body = json.dumps(self.server.get_stats(), indent=2, sort_keys=True)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_cached(self, status, reason, headers, body, cache_status):
+        self.send_response(status, reason)
+        for name, value in headers:
+            if name.lower() not in UNCACHED_HEADERS:
+                self.send_header(name, value)
+        self.send_header('X-Cache', cache_status)
+        if self.command == 'HEAD':
+            content_length = get_header(headers, 'content-length')
+            if content_length is not None:
+                self.send_header('Content-Length', content_length)
+            self.end_headers()
+        elif status in (204, 304) or status < 200:
+            self.end_headers()
+        else:
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    def fetch(self, url, extra_headers=None):
+        """Requests the URL from the remote server.
+
+        Returns:
+            Tuple (status, reason, headers, body).
+
+        Raises:
+            socket.error or httplib.HTTPException on failure.
+        """
+        parts = urlparse.urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+
+        request_body = None
+        content_length = self.headers.getheader('content-length')
+        if content_length:
+            request_body = self.rfile.read(int(content_length))
+
+        headers = {}
+        for line in self.headers.headers:
+            name, _, value = line.partition(':')
+            name = name.strip()
+            if name and name.lower() not in HOP_BY_HOP_HEADERS:
+                headers[name] = value.strip()
+        headers.update(extra_headers or {})
+        headers['Connection'] = 'close'
+
+        conn = httplib.HTTPConnection(
+            parts.netloc, timeout=FLAGS.capture_proxy_timeout)
+        try:
+            conn.request(self.command, path, request_body, headers)
+            response = conn.getresponse()
+            body = response.read()
+        finally:
+            conn.close()
+
+        # Use the raw header lines so repeated headers like Set-Cookie
+        # aren't merged together.
+        response_headers = []
+        for line in response.msg.headers:
+            if line[:1] in ' \t' and response_headers:
+                name, value = response_headers[-1]
+                response_headers[-1] = (name, value + ' ' + line.strip())
+                continue
+            name, _, value = line.partition(':')
+            response_headers.append((name.strip(), value.strip()))
+
+        return response.status, response.reason, response_headers, body
+
+    def is_forced(self, url):
+        path = urlparse.urlsplit(url).path.lower()
+        for suffix in FLAGS.capture_proxy_force_cache_suffixes:
+            if suffix and path.endswith(suffix.lower()):
+                return True
+        return False
+
+    def proxy_request(self):
+        url = self.path
+        cacheable = (
+            self.command == 'GET' and
+            url.startswith('http://') and
+            not self.headers.getheader('authorization'))
+
+        cached = cacheable and self.server.cache.get(url)
+        extra_headers = {}
+        if cached:
+            metadata, body = cached
+            if metadata['expires'] > time.time():
+                self.server.record('hits', bytes_from_cache=len(body))
+                self.send_cached(metadata['status'], metadata['reason'],
+                                 metadata['headers'], body, 'HIT')
+                return
+
+            etag = get_header(metadata['headers'], 'etag')
+            last_modified = get_header(metadata['headers'], 'last-modified')
+            if etag:
+                extra_headers['If-None-Match'] = etag
+            if last_modified:
+                extra_headers['If-Modified-Since'] = last_modified
+
+        try:
+            status, reason, headers, body = self.fetch(url, extra_headers)
+        except (socket.error, httplib.HTTPException), e:
+            self.server.record('errors')
+            self.send_error(502, 'Could not fetch: %s' % e)
+            return
+
+        if cached and extra_headers and status == 304:
+            metadata, body = cached
+            # Take the new freshness headers and keep the rest.
+            new_names = set(name.lower() for name, _ in headers)
+            merged_headers = [
+                (name, value) for name, value in metadata['headers']
+                if name.lower() not in new_names]
+            merged_headers.extend(
+                (name, value) for name, value in headers
+                if name.lower() not in UNCACHED_HEADERS)
+            self.store(url, metadata['status'], metadata['reason'],
+                       merged_headers, body)
+            self.server.record('revalidations', bytes_from_cache=len(body))
+            self.send_cached(metadata['status'], metadata['reason'],
+                             merged_headers, body, 'REVALIDATED')
+            return
+
+        self.server.record('misses', bytes_from_network=len(body))
+        if cacheable and status == 200:
+            self.store(url, status, reason, headers, body)
+        self.send_cached(status, reason, headers, body, 'MISS')
+
+    def store(self, url, status, reason, headers, body):
+        """Saves a response in the cache if its headers allow it."""
+        if get_header(headers, 'set-cookie') is not None:
+            return
+
+        now = time.time()
+        if self.is_forced(url):
+            freshness = FLAGS.capture_proxy_force_cache_seconds
+        else:
+            freshness = get_freshness_seconds(headers, now)
+            if freshness is None:
+                return
+            vary = get_header(headers, 'vary')
+            if vary and vary.strip().lower() != 'accept-encoding':
+                # All capture browsers send the same Accept-Encoding, but
+                # other request headers may differ.
+                return
+            has_validator = (get_header(headers, 'etag') or
+                             get_header(headers, 'last-modified'))
+            if not freshness and not has_validator:
+                return
+
+        metadata = dict(
+            status=status,
+            reason=reason,
+            headers=[(name, value) for name, value in headers
+                     if name.lower() not in UNCACHED_HEADERS],
+            expires=now + freshness)
+        try:
+            self.server.cache.put(url, metadata, body)
+        except (IOError, OSError):
+            logging.exception('Could not cache url=%r', url)
+
+
+class CacheProxyServer(SocketServer.ThreadingMixIn,
+                       BaseHTTPServer.HTTPServer):
+    """Caching forward proxy with a shared DiskCache and hit counters."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, cache):
+        BaseHTTPServer.HTTPServer.__init__(self, address, ProxyHandler)
+        self.cache = cache
+        self.stats_lock = threading.Lock()
+        self.stats = collections.defaultdict(int)
+
+    @property
+    def address(self):
+        """Returns the host:port to give capture browsers."""
+        return '127.0.0.1:%d' % self.server_address[1]
+
+    def record(self, name, **counters):
+        """Increments the named counter and any others given."""
+        with self.stats_lock:
+            self.stats[name] += 1
+            for key, value in counters.iteritems():
+                self.stats[key] += value
+
+    def get_stats(self):
+        """Returns a dictionary of counters and the hit rate."""
+        with self.stats_lock:
+            stats = dict(self.stats)
+        for name in ('hits', 'revalidations', 'misses', 'tunnels', 'errors',
+                     'bytes_from_cache', 'bytes_from_network'):
+            stats.setdefault(name, 0)
+
+        lookups = stats['hits'] + stats['revalidations'] + stats['misses']
+        stats['hit_rate'] = 0.0
+        if lookups:
+            stats['hit_rate'] = (
+                float(stats['hits'] + stats['revalidations']) / lookups)
+
+        with self.cache.lock:
+            stats['cached_responses'] = len(self.cache.entries)
+            stats['cached_bytes'] = self.cache.total_bytes
+            stats['evictions'] = self.cache.evictions
+        return stats
+
+
+def start(cache_dir, max_bytes, port=0):
+    """Starts a caching proxy in a background thread.
+
+    Args:
+        cache_dir: Directory to store cached responses in.
+        max_bytes: Most bytes of responses to keep on disk.
+        port: Port to listen on localhost, or zero to pick a free one.
+
+    Returns:
+        The running CacheProxyServer.
+    """
+    server = CacheProxyServer(
+        ('127.0.0.1', port), DiskCache(cache_dir, max_bytes))
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    logging.info('Capture proxy listening on %s with cache_dir=%r',
+                 server.address, cache_dir)
+    return server
@@ -19,8 +19,21 @@
 var fs = require('fs');
 var system = require('system');
 
-console.log = function(msg){
-  fs.write("/tmp/phantom.log", msg + "\n", 'w');
+// When running as a capture server or from a manifest, each job's log goes
+// to its own file.
+var jobLogPath = null;
+
+// The capture server starts each job with a cold cache. Jobs from a manifest
+// share the cache, since they usually load the same resources.
+var clearCacheBetweenJobs = false;
+
+console.log = function() {
+  var msg = Array.prototype.slice.call(arguments).join(' ');
+  if (jobLogPath) {
+    fs.write(jobLogPath, msg + "\n", 'a');
+  } else {
+    fs.write("/tmp/phantom.log", msg + "\n", 'w');
+  }
 };
 
 var resourceWait  = 300;
@@ -30,360 +43,607 @@ var count         = 0;
 var forcedRenderTimeout;
 var renderTimeout;
 
-// Read and validate config.
-var configPath = null;
-var outputPath = null;
-if (system.args.length == 3) {
-    configPath = system.args[1];
-    outputPath = system.args[2];
-} else {
-    console.log('Usage: phantomjs capture.js <config.js> <outputPath>');
-    phantom.exit(1);
-}
 
-try {
-    var config = JSON.parse(fs.read(configPath));
-} catch (e) {
-    console.log('Could not read config at "' + configPath + '":\n' + e);
-    phantom.exit(1);
-}
+// Reads and validates the config at the given path, or returns null.
+var readConfig = function(configPath) {
+    try {
+        var config = JSON.parse(fs.read(configPath));
+    } catch (e) {
+        console.log('Could not read config at "' + configPath + '":\n' + e);
+        return null;
+    }
 
-['targetUrl'].forEach(function(field) {
-    if (!config[field]) {
-        console.log('Missing required field: ' + field);
-        phantom.exit(1);
+    var missing = ['targetUrl'].filter(function(field) {
+        return !config[field];
+    });
+    if (missing.length) {
+        console.log('Missing required field: ' + missing[0]);
+        return null;
     }
-});
+    return config;
+};
 
 
-// Configure the page.
-var page = require('webpage').create();
+// Captures one screenshot of config.targetUrl to outputPath, then calls
+// done with the exit code: 0 for success, 1 for failure. Returns a function
+// that aborts the capture with the given exit code.
+var capture = function(config, outputPath, done) {
+    var finished = false;
+    var loadFinished = false;
 
-if (config.viewportSize) {
-    page.viewportSize = {
-        width: config.viewportSize.width,
-        height: config.viewportSize.height
+    var finish = function(code) {
+        if (finished) {
+            return;
+        }
+        finished = true;
+        page.close();
+        done(code);
     };
-}
 
-if (config.userAgent) {
-    page.settings.userAgent = config.userAgent;
-}
+    // Configure the page. Each capture gets a fresh page so no state carries
+    // over between jobs in server mode.
+    var page = require('webpage').create();
+    if (clearCacheBetweenJobs && page.clearMemoryCache) {
+        page.clearMemoryCache();
+    }
 
-if (config.clipRect) {
-    page.clipRect = {
-        left: 0,
-        top: 0,
-        width: config.clipRect.width,
-        height: config.clipRect.height
-    };
-}
+    // With viewportSizes, the page loads at the first size and is resized
+    // to each of the others in turn, writing one screenshot per size.
+    var viewportSizes = config.viewportSizes || null;
+    var viewportSize = viewportSizes ? viewportSizes[0] : config.viewportSize;
+    if (viewportSize) {
+        page.viewportSize = {
+            width: viewportSize.width,
+            height: viewportSize.height
+        };
+    }
 
-if (config.cookies) {
-    config.cookies.forEach(function(cookie) {
-        phantom.addCookie(cookie);
-    });
-}
+    if (config.userAgent) {
+        page.settings.userAgent = config.userAgent;
+    }
 
-// Add username and password as a parameter for HTTP basic auth
-if (config.httpUserName && config.httpPassword) {
-    page.settings.userName = config.httpUserName;
-    page.settings.password = config.httpPassword;
-}
+    if (config.clipRect) {
+        page.clipRect = {
+            left: 0,
+            top: 0,
+            width: config.clipRect.width,
+            height: config.clipRect.height
+        };
+    }
 
-page.settings.resourceTimeout = config.resourceTimeoutMs || 10000;
+    if (config.cookies) {
+        config.cookies.forEach(function(cookie) {
+            phantom.addCookie(cookie);
+        });
+    }
 
+    // Add username and password as a parameter for HTTP basic auth
+    if (config.httpUserName && config.httpPassword) {
+        page.settings.userName = config.httpUserName;
+        page.settings.password = config.httpPassword;
+    }
 
-// Do not load Google Analytics URLs. We don't want to pollute stats.
-var badResources = [
-    'www.google-analytics.com'
-];
+    page.settings.resourceTimeout = config.resourceTimeoutMs || 10000;
 
-if (config.resourcesToIgnore) {
-    badResources.forEach(function(bad) {
-        config.resourcesToIgnore.push(bad);
-    });
-} else {
-    config.resourcesToIgnore = badResources;
-}
+    // Options for deciding when the page is stable; see readiness.js.
+    // maxWaitMs is a hard cap on how long to wait before capturing anyway.
+    var readiness = config.readiness || {};
+    var maxWaitMs = readiness.maxWaitMs || 30000;
+    var readyDeadline = null;
 
 
-// Echo all console messages from the page to our log.
-page.onConsoleMessage = function(message, line, source) {
-    console.log('>> CONSOLE: ' + message);
-};
+    // Do not load Google Analytics URLs. We don't want to pollute stats.
+    var badResources = [
+        'www.google-analytics.com'
+    ];
+
+    if (config.resourcesToIgnore) {
+        badResources.forEach(function(bad) {
+            config.resourcesToIgnore.push(bad);
+        });
+    } else {
+        config.resourcesToIgnore = badResources;
+    }
 
 
-var ResourceStatus = {
-    DONE: 'done',
-    ERROR: 'error',
-    TIMEOUT: 'timeout',
-    PENDING: 'pending'
-};
+    // Echo all console messages from the page to our log.
+    page.onConsoleMessage = function(message, line, source) {
+        console.log('>> CONSOLE: ' + message);
+    };
+
 
-// Maps a URL to a ResultStatus value.
-var resourceStatusMap = {};
+    var ResourceStatus = {
+        DONE: 'done',
+        ERROR: 'error',
+        TIMEOUT: 'timeout',
+        PENDING: 'pending'
+    };
 
+    // Maps a URL to a ResultStatus value.
+    var resourceStatusMap = {};
 
-// We don't necessarily want to load every resource a page asks for.
-page.onResourceRequested = function(requestData, networkRequest) {
-    var url = requestData.url;
+    // When a request last started or finished.
+    var lastResourceActivity = new Date().getTime();
 
-    if (url.indexOf('data:') == 0) {
-        console.log('Requested data URI');
-    } else {
-        for (var i = 0; i < config.resourcesToIgnore.length; i++) {
-            var bad = config.resourcesToIgnore[i];
-            if (bad == url || url.match(new RegExp(bad))) {
-                console.log('Blocking resource: ' + url);
-                networkRequest.abort();
-                return;
+
+    // We don't necessarily want to load every resource a page asks for.
+    page.onResourceRequested = function(requestData, networkRequest) {
+        var url = requestData.url;
+
+        if (url.indexOf('data:') == 0) {
+            console.log('Requested data URI');
+        } else {
+            for (var i = 0; i < config.resourcesToIgnore.length; i++) {
+                var bad = config.resourcesToIgnore[i];
+                if (bad == url || url.match(new RegExp(bad))) {
+                    console.log('Blocking resource: ' + url);
+                    networkRequest.abort();
+                    return;
+                }
             }
-        }
 
-        if (config.injectHeaders) {
-            for (var host in config.injectHeaders) {
-                if (host == url || url.match(new RegExp(host))) {
-                    var headers = config.injectHeaders[host];
-                    for (var header in headers) {
-                        networkRequest.setHeader(header, headers[header]);
-                        console.log('Setting header ' + header + ' to ' + headers[header]);
+            if (config.injectHeaders) {
+                for (var host in config.injectHeaders) {
+                    if (host == url || url.match(new RegExp(host))) {
+                        var headers = config.injectHeaders[host];
+                        for (var header in headers) {
+                            networkRequest.setHeader(header, headers[header]);
+                            console.log('Setting header ' + header + ' to ' + headers[header]);
+                        }
                     }
                 }
             }
+            console.log('Requested: ' + url);
         }
-        console.log('Requested: ' + url);
-    }
 
-    // Always reset the status to pending each time a new request happens.
-    // This handles the case where the page or JS causes a resource to reload
-    // for some reason, expecting a different result.
-    resourceStatusMap[url] = ResourceStatus.PENDING;
-};
+        // Always reset the status to pending each time a new request happens.
+        // This handles the case where the page or JS causes a resource to reload
+        // for some reason, expecting a different result.
+        resourceStatusMap[url] = ResourceStatus.PENDING;
+        lastResourceActivity = new Date().getTime();
+    };
 
 
-// Log all resources loaded as part of this request, for debugging.
-page.onResourceReceived = function(response) {
-    if (response.stage != 'end') {
-        return;
-    }
-    var url = response.url;
-    if (url.indexOf('data:') == 0) {
-        console.log('Loaded data URI');
-    } else if (response.redirectURL) {
-        console.log('Loaded redirect: ' + url + ' -> ' + response.redirectURL);
-    } else {
-        console.log('Loaded: ' + url);
-    }
-    if (resourceStatusMap[url] == ResourceStatus.PENDING) {
-        resourceStatusMap[url] = ResourceStatus.DONE;
-    }
-};
+    // Log all resources loaded as part of this request, for debugging.
+    page.onResourceReceived = function(response) {
+        if (response.stage != 'end') {
+            return;
+        }
+        var url = response.url;
+        if (url.indexOf('data:') == 0) {
+            console.log('Loaded data URI');
+        } else if (response.redirectURL) {
+            console.log('Loaded redirect: ' + url + ' -> ' + response.redirectURL);
+        } else {
+            console.log('Loaded: ' + url);
+        }
+        if (resourceStatusMap[url] == ResourceStatus.PENDING) {
+            resourceStatusMap[url] = ResourceStatus.DONE;
+        }
+        lastResourceActivity = new Date().getTime();
+    };
 
 
-// Detect if any resources timeout.
-page.onResourceTimeout = function(request) {
-    var url = request.url;
-    console.log('Loading resource timed out: ' + url);
-    if (resourceStatusMap[url] == ResourceStatus.PENDING) {
-        resourceStatusMap[url] = ResourceStatus.TIMEOUT;
-    }
-};
+    // Detect if any resources timeout.
+    page.onResourceTimeout = function(request) {
+        var url = request.url;
+        console.log('Loading resource timed out: ' + url);
+        if (resourceStatusMap[url] == ResourceStatus.PENDING) {
+            resourceStatusMap[url] = ResourceStatus.TIMEOUT;
+        }
+        lastResourceActivity = new Date().getTime();
+    };
 
 
-// Detect if any resources fail to load.
-page.onResourceError = function(error) {
-    var url = error.url;
-    console.log('Loading resource errored: ' + url +
-                ', errorCode=' + error.errorCode +
-                ', errorString=' + error.errorString);
-    if (resourceStatusMap[url] == ResourceStatus.PENDING) {
-        resourceStatusMap[url] = ResourceStatus.ERROR;
-    }
-};
+    // Detect if any resources fail to load.
+    page.onResourceError = function(error) {
+        var url = error.url;
+        console.log('Loading resource errored: ' + url +
+                    ', errorCode=' + error.errorCode +
+                    ', errorString=' + error.errorString);
+        if (resourceStatusMap[url] == ResourceStatus.PENDING) {
+            resourceStatusMap[url] = ResourceStatus.ERROR;
+        }
+        lastResourceActivity = new Date().getTime();
+    };
 
 
-// Just for debug logging.
-page.onInitialized = function() {
-    console.log('page.onInitialized');
-};
+    // Just for debug logging.
+    page.onInitialized = function() {
+        console.log('page.onInitialized');
+    };
 
 
-// Dumps out any error logs.
-page.onError = function(msg, trace) {
-    var msgStack = [msg];
-    if (trace && trace.length) {
-        trace.forEach(function(t) {
-            msgStack.push(
-                ' -> ' + (t.file || t.sourceURL) + ': ' + t.line +
-                (t.function ? ' (in function ' + t.function + ')' : ''));
-        });
-    }
+    // Dumps out any error logs.
+    page.onError = function(msg, trace) {
+        var msgStack = [msg];
+        if (trace && trace.length) {
+            trace.forEach(function(t) {
+                msgStack.push(
+                    ' -> ' + (t.file || t.sourceURL) + ': ' + t.line +
+                    (t.function ? ' (in function ' + t.function + ')' : ''));
+            });
+        }
 
-    console.log('page.onError', msgStack.join('\n'));
-};
+        console.log('page.onError', msgStack.join('\n'));
+    };
 
 
-// Just for debug logging.
-page.onNavigationRequested = function(url, type, willNavigate, main) {
-    if (!main) {
-        return;
-    }
-    console.log('page.onNavigationRequested: ' + url);
-};
+    // Just for debug logging.
+    page.onNavigationRequested = function(url, type, willNavigate, main) {
+        if (!main) {
+            return;
+        }
+        console.log('page.onNavigationRequested: ' + url);
+    };
 
 
-// Just for debug logging.
-page.onLoadStarted = function() {
-    console.log('page.onLoadStarted');
-};
+    // Just for debug logging.
+    page.onLoadStarted = function() {
+        console.log('page.onLoadStarted');
+    };
 
 
-// Just for debug logging.
-page.onLoadFinished = function(status) {
-    console.log('page.onLoadFinished');
-    if (status == 'success') {
-        console.log('Loaded the page successfully');
-    } else {
-        console.log('Loading the page failed', status);
-        phantom.exit(1);
-    }
-};
+    // Just for debug logging.
+    page.onLoadFinished = function(status) {
+        console.log('page.onLoadFinished');
+        if (status == 'success') {
+            console.log('Loaded the page successfully');
+        } else {
+            console.log('Loading the page failed', status);
+            finish(1);
+        }
+    };
 
 
-// Takes the screenshot and exits successfully.
-page.doScreenshot = function() {
-    console.log('Taking the screenshot and saving to:', outputPath);
-    phantom.injectJs(system.env['INJECT_DIR'] + '/inject.js');
-    console.log('starting timeout before render');
+    // Writes the page rectangles of elements matching the selectors in
+    // config.ignoreRegions next to the screenshot, for the pdiff to ignore.
+    page.doIgnoreRegions = function(imagePath) {
+        var selectors = [];
+        (config.ignoreRegions || []).forEach(function(region) {
+            if (region.selector) {
+                selectors.push(region.selector);
+            }
+        });
+        if (!selectors.length) {
+            return;
+        }
 
-    // window.setTimeout(function() {
-      console.log('timeout finsihed rendering');
-      page.render(outputPath);
-    // }, 5000);
+        var regions = page.evaluate(function(selectors) {
+            var result = [];
+            selectors.forEach(function(selector) {
+                var elements = document.querySelectorAll(selector);
+                for (var i = 0; i < elements.length; i++) {
+                    var rect = elements[i].getBoundingClientRect();
+                    if (!rect.width || !rect.height) {
+                        continue;
+                    }
+                    result.push({
+                        left: rect.left + window.pageXOffset,
+                        top: rect.top + window.pageYOffset,
+                        width: rect.width,
+                        height: rect.height
+                    });
+                }
+            });
+            return result;
+        }, selectors);
+
+        console.log('Ignoring ' + regions.length + ' regions for selectors: ' +
+                    selectors.join(', '));
+        fs.write(imagePath + '.mask.json',
+                 JSON.stringify({version: 1, regions: regions}), 'w');
+    };
 
-    phantom.exit(0);
-};
 
+    // Saves the screenshot of the page as it is now to imagePath.
+    page.doRender = function(imagePath) {
+        console.log('Taking the screenshot and saving to:', imagePath);
+        page.doIgnoreRegions(imagePath);
+        page.render(imagePath);
+    };
 
-// Injects CSS and JS into the page.
-page.doInject = function() {
-    var didInject = false;
 
-    if (config.injectCss) {
-        didInject = true;
-        console.log('Injecting CSS: ' + config.injectCss);
-        page.evaluate(function(config) {
-            var styleEl = document.createElement('style');
-            styleEl.type = 'text/css';
-            styleEl.innerHTML = config.injectCss;
-            document.getElementsByTagName('head')[0].appendChild(styleEl);
-        }, config);
-    }
+    // Takes the screenshot, or one for each of config.viewportSizes, and
+    // exits successfully.
+    page.doScreenshot = function() {
+        phantom.injectJs(system.env['INJECT_DIR'] + '/inject.js');
+        if (!viewportSizes) {
+            page.doRender(outputPath);
+            finish(0);
+            return;
+        }
 
-    if (config.injectJs) {
-        didInject = true;
-        console.log('Injecting JS: ' + config.injectJs);
-        var success = page.evaluate(function(config) {
-            try {
-                window.eval(config.injectJs);
-            } catch (e) {
-                console.log('Exception running injectJs');
-                console.log(e.stack);
-                return false;
+        var index = 0;
+        var next = function() {
+            page.doRender(getViewportOutputPath(outputPath, index));
+            index++;
+            if (index == viewportSizes.length) {
+                finish(0);
+                return;
             }
-            return true;
-        }, config);
-        if (!success) {
-            phantom.exit(1);
-        }
-    }
-    console.log('doinject done, waiting');
 
-    // setTimeout(function() {
-    page.waitForReady(page.doScreenshot);
-    // }, 2000);
-};
+            var size = viewportSizes[index];
+            console.log('Resizing viewport to ' + size.width + 'x' + size.height);
+            page.viewportSize = {width: size.width, height: size.height};
+            // Responsive pages may load new resources and change the DOM at
+            // the new size, so wait for them to settle again.
+            page.evaluate(function() {
+                if (window.dpxdtReadiness) {
+                    window.dpxdtReadiness.reset();
+                }
+            });
+            lastResourceActivity = new Date().getTime();
+            readyDeadline = null;
+            page.waitForReady(next);
+        };
+        next();
+    };
 
 
-// Wait for all resources on the page to load, then call the given function.
-page.waitForReady = function(func) {
-    var totals = {};
-    for (var url in resourceStatusMap) {
-        var status = resourceStatusMap[url];
-        var value = totals[status] || 0;
-        totals[status] = value + 1;
-    }
+    // Injects CSS and JS into the page.
+    page.doInject = function() {
+        var didInject = false;
 
-    console.log('Status of all resources:', JSON.stringify(totals));
+        if (config.injectCss) {
+            didInject = true;
+            console.log('Injecting CSS: ' + config.injectCss);
+            page.evaluate(function(config) {
+                var styleEl = document.createElement('style');
+                styleEl.type = 'text/css';
+                styleEl.innerHTML = config.injectCss;
+                document.getElementsByTagName('head')[0].appendChild(styleEl);
+            }, config);
+        }
 
-    var pending = totals[ResourceStatus.PENDING] || 0;
-    if (!pending) {
-        console.log('No more resources are pending. get funcy!');
-        func();
-        return;
-    } else {
+        if (config.injectJs) {
+            didInject = true;
+            console.log('Injecting JS: ' + config.injectJs);
+            var success = page.evaluate(function(config) {
+                try {
+                    window.eval(config.injectJs);
+                } catch (e) {
+                    console.log('Exception running injectJs');
+                    console.log(e.stack);
+                    return false;
+                }
+                return true;
+            }, config);
+            if (!success) {
+                finish(1);
+            }
+        }
+        console.log('doinject done, waiting');
+
+        // setTimeout(function() {
+        page.waitForReady(page.doScreenshot);
+        // }, 2000);
+    };
+
+
+    // Returns the network state as PhantomJS sees it, which includes every
+    // request the page makes.
+    page.getNetworkState = function() {
+        var inflight = 0;
         for (var url in resourceStatusMap) {
             if (resourceStatusMap[url] == ResourceStatus.PENDING) {
-                console.log('Still waiting for: ' + url);
+                inflight++;
             }
         }
-    }
+        return {
+            inflight: inflight,
+            idleMs: new Date().getTime() - lastResourceActivity
+        };
+    };
+
+
+    // Wait until the page is stable, then call the given function. Gives up
+    // waiting once maxWaitMs has passed since the page loaded.
+    page.waitForReady = function(func) {
+        if (finished) {
+            return;
+        }
+        if (readyDeadline === null) {
+            readyDeadline = new Date().getTime() + maxWaitMs;
+        }
+
+        var status = page.evaluate(function(options, network) {
+            if (!window.dpxdtReadiness) {
+                return null;
+            }
+            return window.dpxdtReadiness.check(options, network);
+        }, readiness, page.getNetworkState());
+
+        if (!status) {
+            // This is a new document, so the readiness script is needed.
+            page.injectJs(phantom.libraryPath + '/readiness.js');
+        } else if (status.ready) {
+            console.log('Page is ready:', JSON.stringify(status));
+            func();
+            return;
+        } else if (new Date().getTime() >= readyDeadline) {
+            console.log('Page still not ready after ' + maxWaitMs + 'ms:',
+                        JSON.stringify(status));
+            for (var url in resourceStatusMap) {
+                if (resourceStatusMap[url] == ResourceStatus.PENDING) {
+                    console.log('Still waiting for: ' + url);
+                }
+            }
+            func();
+            return;
+        }
+
+        setTimeout(function() {
+            page.waitForReady(func);
+        }, 100);
+    };
+
+    page.onLoadFinished = function(status) {
+        console.log('page.onLoadFinished', status);
+        // Frames and redirects can finish loading more than once.
+        if (loadFinished) {
+            return;
+        }
+        loadFinished = true;
+        page.waitForReady(page.doInject);
+    };
+
+    // Kickoff the load!
+    console.log('Opening page', config.targetUrl);
+
+    page.open(config.targetUrl, function(status) {
+      console.log('page opened');
+    });
 
-    setTimeout(function() {
-        page.waitForReady(func);
-    }, 500);
+    return finish;
 };
 
-page.isDone = function(){
-  return page.evaluate(function() {
 
-    if(document.readyState != "complete"){
-      return false;
+// Returns where the screenshot for the viewport size at the given index of
+// config.viewportSizes goes. The index goes before the extension so the
+// format stays the same, e.g. capture.png becomes capture.1.png.
+var getViewportOutputPath = function(outputPath, index) {
+    var dot = outputPath.lastIndexOf('.');
+    if (dot <= outputPath.lastIndexOf('/')) {
+        return outputPath + '.' + index;
     }
+    return outputPath.slice(0, dot) + '.' + index + outputPath.slice(dot);
+};
 
-    var llis = document.getElementsByTagName('img');
-    var t_flag = true;
 
-    for(var lcv = 0; lcv < llis.length; lcv++){
+// Reads the config and captures one screenshot, then calls done with the
+// exit code. Returns a function that aborts the capture.
+var runCapture = function(configPath, outputPath, done) {
+    var config = readConfig(configPath);
+    if (!config) {
+        done(1);
+        return function() {};
+    }
+    return capture(config, outputPath, done);
+};
 
-      var imgElement = llis[lcv];
 
-      if(
-        typeof imgElement == 'undefined' ||
-        typeof imgElement.complete == 'undefined' ||
-        typeof imgElement.naturalHeight == 'undefined' ||
-        !(imgElement.complete && imgElement.naturalHeight != 0)
-      ){
-        return false;
-      }
+// Captures every job in a manifest in turn, reusing this process and its
+// cache. The manifest is JSON like:
+//
+//     {"timeoutMs": 60000,
+//      "jobs": [{"configPath": "...", "outputPath": "...", "logPath": "..."},
+//               ...]}
+//
+// The exit code of each job is written to resultsPath after it finishes,
+// as {"returncodes": [0, 1, ...]}, so results survive a crash part way
+// through. A job that fails or takes longer than timeoutMs doesn't stop
+// the jobs after it.
+var runManifest = function(manifestPath, resultsPath) {
+    try {
+        var manifest = JSON.parse(fs.read(manifestPath));
+    } catch (e) {
+        console.log('Could not read manifest at "' + manifestPath + '":\n' + e);
+        phantom.exit(1);
+        return;
     }
 
-    if( document.getElementsByClassName('lazy-load').length !=
-        document.getElementsByClassName('lazy-load is-unveiled').length
-      ){
-      return false;
-    }
+    var returncodes = [];
+    var next = function() {
+        jobLogPath = null;
+        if (returncodes.length == manifest.jobs.length) {
+            phantom.exit(0);
+            return;
+        }
 
-    return true;
-  });
+        var job = manifest.jobs[returncodes.length];
+        phantom.clearCookies();
+        jobLogPath = job.logPath || null;
+
+        var timeout = null;
+        var abort = runCapture(job.configPath, job.outputPath, function(code) {
+            if (timeout !== null) {
+                clearTimeout(timeout);
+            }
+            returncodes.push(code);
+            fs.write(resultsPath, JSON.stringify({returncodes: returncodes}), 'w');
+            // Start the next job from a fresh call stack.
+            setTimeout(next, 0);
+        });
+        if (manifest.timeoutMs) {
+            timeout = setTimeout(function() {
+                timeout = null;
+                console.log('Capture timed out after ' + manifest.timeoutMs + 'ms');
+                abort(1);
+            }, manifest.timeoutMs);
+        }
+    };
+    next();
 };
 
-page.onLoadFinished = function(status){
-  //Check for completion every second
-  var iid = setInterval(function(){
-    console.log('interval run');
-    if(page.isDone()){
-      console.log('page done');
-      clearInterval(iid);
-      page.waitForReady(page.doInject);
+
+// Takes capture jobs over HTTP on a local port, one at a time, so a single
+// browser process can take many screenshots. Each job is a POST with a
+// JSON body like:
+//
+//     {"configPath": "...", "outputPath": "...", "logPath": "..."}
+//
+// The response is JSON with the exit code the capture would have had in
+// a process of its own: {"returncode": 0}
+var serve = function(port) {
+    var server = require('webserver').create();
+    var busy = false;
+    clearCacheBetweenJobs = true;
+
+    var listening = server.listen('127.0.0.1:' + port, function(request, response) {
+        var reply = function(statusCode, result) {
+            response.statusCode = statusCode;
+            response.setHeader('Content-Type', 'application/json');
+            response.write(JSON.stringify(result));
+            response.close();
+        };
+
+        if (request.method != 'POST') {
+            reply(405, {error: 'Capture jobs must be POSTed'});
+            return;
+        }
+        if (busy) {
+            reply(503, {error: 'Already capturing'});
+            return;
+        }
+        try {
+            var job = JSON.parse(request.post);
+        } catch (e) {
+            reply(400, {error: 'Bad capture job: ' + e});
+            return;
+        }
+
+        // Cookies are shared by every page in the process.
+        busy = true;
+        phantom.clearCookies();
+        jobLogPath = job.logPath || null;
+
+        runCapture(job.configPath, job.outputPath, function(code) {
+            jobLogPath = null;
+            busy = false;
+            reply(200, {returncode: code});
+        });
+    });
+
+    if (!listening) {
+        console.log('Could not listen on port ' + port);
+        phantom.exit(1);
     }
-  }, 1000);
-}
+    console.log('Capture server listening on port ' + port);
+};
 
-// Kickoff the load!
-console.log('Opening page', config.targetUrl);
 
-page.open(config.targetUrl, function(status) {
-  console.log('page opened');
-});
+if (system.args.length == 3 && system.args[1] == '--server') {
+    serve(system.args[2]);
+} else if (system.args.length == 4 && system.args[1] == '--manifest') {
+    runManifest(system.args[2], system.args[3]);
+} else if (system.args.length == 3) {
+    runCapture(system.args[1], system.args[2], function(code) {
+        phantom.exit(code);
+    });
+} else {
+    console.log('Usage: phantomjs capture.js <config.js> <outputPath>\n' +
+                '       phantomjs capture.js --server <port>\n' +
+                '       phantomjs capture.js --manifest <manifest.json> <results.json>');
+    phantom.exit(1);
+}
@@ -21,31 +21,38 @@
 # TODO(elsigh): Support httpUserName/httpPassWord
 # TODO(elsigh): Support injectHeaders
 
+import BaseHTTPServer
 import json
 import logging
+import os
 from pprint import pprint
 import sys
+import threading
 import time
 from selenium import webdriver
-from selenium.webdriver.support.ui import WebDriverWait
+from selenium.common.exceptions import TimeoutException
 
-config_file_path = sys.argv[1]
-output_file = sys.argv[2]
 
-with open(config_file_path) as config_file:
-    config = json.load(config_file)
-print "config: "
-pprint(config)
+# Shared with capture.js for deciding when a page is stable.
+READINESS_SCRIPT_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'readiness.js')
 
-assert config['command_executor']
-command_executor = config['command_executor']
-assert config['desired_capabilities']
-desired_capabilities = config['desired_capabilities']
-assert config['targetUrl']
-target_url = config['targetUrl']
+CHECK_READINESS_SCRIPT = (
+    'if (!window.dpxdtReadiness) { return null; }'
+    'return window.dpxdtReadiness.check(arguments[0]);')
+
+RESET_READINESS_SCRIPT = (
+    'if (window.dpxdtReadiness) { window.dpxdtReadiness.reset(); }')
+
+# Storage may be unavailable, like on pages with opaque origins.
+CLEAR_STORAGE_SCRIPT = (
+    'try { window.localStorage.clear(); } catch (e) {}'
+    'try { window.sessionStorage.clear(); } catch (e) {}')
+
+# How long past its deadline a job may take to notice it before it's
+# abandoned, for WebDriver calls the browser's own timeouts don't cover.
+DEADLINE_GRACE_SECONDS = 5
 
-# optional configs
-resourceTimeoutMs = config.get('resourceTimeoutMs', 60 * 1000)
 
 def getProfile(desired_capabilities, config):
     profile = None
@@ -68,18 +75,305 @@ def injectCSSandJS(driver, config):
         driver.execute_script(config['injectJs'])
 
 
-driver = webdriver.Remote(
-    browser_profile=getProfile(desired_capabilities, config),
-    command_executor=config['command_executor'],
-    desired_capabilities=config['desired_capabilities'],
-)
-driver.get(config['targetUrl'])
-injectCSSandJS(driver, config)
+def readConfig(config_file_path):
+    with open(config_file_path) as config_file:
+        config = json.load(config_file)
+    print "config: "
+    pprint(config)
+
+    assert config['command_executor']
+    assert config['desired_capabilities']
+    assert config['targetUrl']
+    return config
+
+
+def getSessionKey(config):
+    """Returns what a WebDriver session must match to be reused."""
+    return json.dumps([
+        config['command_executor'],
+        config['desired_capabilities'],
+        config.get('userAgent'),
+    ], sort_keys=True)
+
+
+def makeDriver(config):
+    return webdriver.Remote(
+        browser_profile=getProfile(config['desired_capabilities'], config),
+        command_executor=config['command_executor'],
+        desired_capabilities=config['desired_capabilities'],
+    )
+
+
+def waitForReady(driver, readiness, deadline):
+    """Waits until the page is stable or the deadline passes."""
+    with open(READINESS_SCRIPT_PATH) as script_file:
+        readinessScript = script_file.read()
+
+    while True:
+        status = driver.execute_script(CHECK_READINESS_SCRIPT, readiness)
+        if status is None:
+            # This is a new document, so the readiness script is needed.
+            driver.execute_script(readinessScript)
+        elif status['ready']:
+            print 'Page is ready: %s' % json.dumps(status)
+            return
+        elif time.time() >= deadline:
+            print 'Page still not ready at the deadline: %s' % json.dumps(
+                status)
+            return
+        time.sleep(0.1)
+
+
+def getViewportOutputPath(output_file, index):
+    """Returns where the screenshot for one of viewportSizes goes, like
+    capture.js does: capture.png becomes capture.1.png.
+    """
+    base, extension = os.path.splitext(output_file)
+    return '%s.%d%s' % (base, index, extension)
+
+
+def getReadyDeadline(maxWaitMs, deadline):
+    """Returns when to stop waiting for the page, which is no later than
+    the job's deadline.
+    """
+    readyDeadline = time.time() + maxWaitMs / 1000.0
+    if deadline:
+        return min(readyDeadline, deadline)
+    return readyDeadline
+
+
+def checkDeadline(deadline):
+    """Raises TimeoutException if the job's deadline has passed."""
+    if deadline and time.time() >= deadline:
+        raise TimeoutException('Capture did not finish before its deadline')
+
+
+def capture(driver, config, output_file, deadline=None):
+    # optional configs
+    readiness = config.get('readiness') or {}
+    maxWaitMs = readiness.get('maxWaitMs') or 30000
+    viewportSizes = config.get('viewportSizes')
+
+    if deadline:
+        # Let the browser give up on loads and scripts at the deadline too.
+        remaining = max(deadline - time.time(), 1)
+        driver.set_page_load_timeout(remaining)
+        driver.set_script_timeout(remaining)
+
+    # WebDriver sizes the whole window, so this is close to the viewport
+    # size but not exact.
+    if viewportSizes:
+        driver.set_window_size(
+            viewportSizes[0]['width'], viewportSizes[0]['height'])
+
+    driver.get(config['targetUrl'])
+    readyDeadline = getReadyDeadline(maxWaitMs, deadline)
+    waitForReady(driver, readiness, readyDeadline)
+    injectCSSandJS(driver, config)
+    waitForReady(driver, readiness, readyDeadline)
+
+    if not viewportSizes:
+        checkDeadline(deadline)
+        driver.save_screenshot(output_file)
+        return
+
+    # Take every size from the one page load, letting the page settle
+    # again after each resize.
+    for index, size in enumerate(viewportSizes):
+        if index:
+            print 'Resizing window to %(width)dx%(height)d' % size
+            driver.set_window_size(size['width'], size['height'])
+            driver.execute_script(RESET_READINESS_SCRIPT)
+            waitForReady(driver, readiness,
+                         getReadyDeadline(maxWaitMs, deadline))
+        checkDeadline(deadline)
+        driver.save_screenshot(getViewportOutputPath(output_file, index))
+
+
+class Session(object):
+    """A WebDriver session that is reused for captures with the same
+    executor, capabilities and user agent. The browser is reset before each
+    job, and the session is thrown away if a capture fails.
+    """
+
+    def __init__(self):
+        self.driver = None
+        self.session_key = None
+        self.window_size = None
+
+    def runJob(self, job, timeoutMs=None):
+        """Runs one capture job and returns its exit code.
+
+        The job is a dictionary like:
+
+            {"configPath": "...", "outputPath": "...", "logPath": "..."}
+
+        With timeoutMs, the job fails if it takes longer than that.
+        """
+        deadline = None
+        if timeoutMs:
+            deadline = time.time() + timeoutMs / 1000.0
+        stdout = sys.stdout
+        if job.get('logPath'):
+            sys.stdout = open(job['logPath'], 'a')
+        try:
+            config = readConfig(job['configPath'])
+            session_key = getSessionKey(config)
+            if self.driver and self.session_key != session_key:
+                self.quit()
+            if self.driver:
+                try:
+                    self.reset()
+                except Exception, e:
+                    print 'Could not reset the browser: %s: %s' % (
+                        e.__class__.__name__, e)
+                    self.quit()
+            if not self.driver:
+                self.driver = makeDriver(config)
+                self.session_key = session_key
+                self.window_size = self.driver.get_window_size()
+            self.capture(config, job['outputPath'], deadline)
+        except Exception, e:
+            print 'Capture failed: %s: %s' % (e.__class__.__name__, e)
+            if isinstance(e, TimeoutException):
+                # The browser may be hung, so don't wait for it to quit.
+                self.abandon()
+            else:
+                self.quit()
+            return 1
+        finally:
+            if sys.stdout is not stdout:
+                sys.stdout.close()
+            sys.stdout = stdout
+        return 0
+
+    def capture(self, config, output_file, deadline):
+        """Captures with this session's browser, giving up at the deadline
+        even if a WebDriver call hangs.
+        """
+        if not deadline:
+            capture(self.driver, config, output_file)
+            return
+
+        errors = []
+        def run():
+            try:
+                capture(self.driver, config, output_file, deadline)
+            except Exception, e:
+                errors.append(e)
+
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        thread.join(max(deadline - time.time(), 0) + DEADLINE_GRACE_SECONDS)
+        if thread.isAlive():
+            raise TimeoutException('Capture hung past its deadline')
+        if errors:
+            raise errors[0]
+
+    def reset(self):
+        """Undoes what the last job did to the browser, so it can't change
+        the screenshot of the next one.
+        """
+        # Cookies and storage belong to the site, so clear them before
+        # leaving the last job's page.
+        self.driver.delete_all_cookies()
+        self.driver.execute_script(CLEAR_STORAGE_SCRIPT)
+        self.driver.get('about:blank')
+        self.driver.set_window_size(
+            self.window_size['width'], self.window_size['height'])
+
+    def abandon(self):
+        """Quits the browser in the background and forgets it."""
+        driver = self.driver
+        self.driver = None
+        self.session_key = None
+        self.window_size = None
+        if not driver:
+            return
+
+        def quit():
+            try:
+                driver.quit()
+            except Exception:
+                pass
+
+        thread = threading.Thread(target=quit)
+        thread.daemon = True
+        thread.start()
+
+    def quit(self):
+        if self.driver:
+            try:
+                self.driver.quit()
+            except Exception:
+                pass
+        self.driver = None
+        self.session_key = None
+        self.window_size = None
+
+
+class CaptureHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Takes capture jobs like capture.js does in server mode."""
+
+    session = Session()
+
+    def do_POST(self):
+        job = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        returncode = self.session.runJob(job)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(json.dumps({'returncode': returncode}))
+
+
+def serve(port):
+    server = BaseHTTPServer.HTTPServer(('127.0.0.1', port), CaptureHandler)
+    print 'Capture server listening on port %d' % port
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    finally:
+        CaptureHandler.session.quit()
+
+
+def runManifest(manifest_path, results_path):
+    """Captures every job in a manifest like capture.js does. A job that
+    fails or takes longer than the manifest's timeoutMs doesn't stop the
+    jobs after it.
+    """
+    with open(manifest_path) as manifest_file:
+        manifest = json.load(manifest_file)
+
+    session = Session()
+    returncodes = []
+    try:
+        for job in manifest['jobs']:
+            returncodes.append(
+                session.runJob(job, timeoutMs=manifest.get('timeoutMs')))
+            with open(results_path, 'w') as results_file:
+                json.dump({'returncodes': returncodes}, results_file)
+    finally:
+        session.quit()
+
+
+def main(argv):
+    if len(argv) == 3 and argv[1] == '--server':
+        serve(int(argv[2]))
+        return
+    if len(argv) == 4 and argv[1] == '--manifest':
+        runManifest(argv[2], argv[3])
+        return
+
+    config_file_path = argv[1]
+    output_file = argv[2]
+    config = readConfig(config_file_path)
+    driver = makeDriver(config)
+    try:
+        capture(driver, config, output_file)
+    finally:
+        driver.quit()
 
-# Wait for any jQuery AJAX loading to finish.
-wait = WebDriverWait(driver, resourceTimeoutMs)
-areResourcesDoneScript = "return typeof jQuery !== 'undefined' && jQuery.active === 0"
-wait.until(lambda driver: driver.execute_script(areResourcesDoneScript))
 
-driver.save_screenshot(output_file)
-driver.quit()
+if __name__ == '__main__':
+    main(sys.argv)
@@ -16,23 +16,37 @@
 """Background worker that screenshots URLs, possibly from a queue."""
 
 import Queue
+import httplib
 import json
 import logging
+import multiprocessing
 import os
 import shutil
+import signal
+import socket
+import subprocess
 import tempfile
 import time
 import urllib2
 
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
 # Local Libraries
 import gflags
 FLAGS = gflags.FLAGS
 
 # Local modules
 from dpxdt import constants
+from dpxdt.client import cache_proxy
+from dpxdt.client import concurrency
+from dpxdt.client import masks
 from dpxdt.client import process_worker
 from dpxdt.client import queue_worker
 from dpxdt.client import release_worker
+from dpxdt.client import timer_worker
 from dpxdt.client import utils
 from dpxdt.client import workers
 
@@ -77,7 +91,26 @@ gflags.DEFINE_integer(
 
 gflags.DEFINE_string(
     'capture_format', 'png',
-    'Screenshot format, e.g. png or bmp')
+    'Screenshot format, e.g. png or bmp. The capture script picks the '
+    'format from the file extension. Formats like bmp and ppm are much '
+    'faster for the browser to write than png, but should be used with '
+    '--capture_encode_format so they aren\'t uploaded as is.')
+
+gflags.DEFINE_enum(
+    'capture_encode_format', None, ['png', 'webp'],
+    'Re-encode each screenshot to this format before uploading it, in a '
+    'stage separate from the capture: png for optimized PNG, webp for '
+    'lossless WebP. Requires the Pillow package. When not set, '
+    'screenshots are uploaded in --capture_format.')
+
+gflags.DEFINE_integer(
+    'capture_encode_processes', 0,
+    'With --capture_encode_format, encode screenshots in a pool of this '
+    'many worker processes, so encoding doesn\'t hold the interpreter lock '
+    'that other tasks\' threads need. Encoding and reporting a capture '
+    'run after its task slot is freed, in parallel with the next capture. '
+    'An encode running longer than --capture_timeout fails its run. Zero '
+    'encodes in threads of this process.')
 
 gflags.DEFINE_string(
     'capture_binary', 'phantomjs',
@@ -92,15 +125,118 @@ gflags.DEFINE_integer(
     'capture_timeout', 120,
     'Seconds until giving up on a capture sub-process and trying again.')
 
+gflags.DEFINE_integer(
+    'capture_servers', 0,
+    'Number of long-lived capture processes to keep running. Each one '
+    'takes screenshots one at a time over a local socket, which saves '
+    'starting a new browser for every capture. Zero starts a new capture '
+    'process for each screenshot.')
+
+gflags.DEFINE_integer(
+    'capture_server_max_jobs', 50,
+    'Restart a capture server after it has taken this many screenshots, '
+    'to bound memory growth and leftover state in the browser.')
+
+gflags.DEFINE_integer(
+    'capture_server_start_seconds', 30,
+    'Seconds to wait for a new capture server to start listening.')
+
+gflags.DEFINE_integer(
+    'capture_batch_size', 1,
+    'How many capture tasks from the same release to lease together. '
+    'Tasks with configs that only differ in their URL are captured by one '
+    'capture process from a manifest, sharing its startup and cache. Up '
+    'to --capture_threads batches are in flight at a time. Can\'t be used '
+    'with --capture_servers.')
+
+
+# Caching proxy shared by every phantomjs capture process, if enabled with
+# --capture_proxy_cache_dir. Started by register().
+CAPTURE_PROXY = None
+
+# Pool of processes for encoding screenshots, if enabled with
+# --capture_encode_processes. Started by start_processes().
+ENCODE_POOL = None
+
 
 class CaptureFailedError(queue_worker.GiveUpAfterAttemptsError):
     """Capturing a webpage screenshot failed for some reason."""
 
 
+class CaptureServerError(Exception):
+    """A capture server could not start, crashed or gave a bad response."""
+
+
+def write_log(log_path, message):
+    """Adds a line to a capture log, and to this process's log."""
+    logging.info('%s: %s', log_path, message)
+    with open(log_path, 'a') as log_file:
+        log_file.write(message + '\n')
+
+
+def get_phantomjs_flags():
+    """Returns the flags for every phantomjs capture process."""
+    flags = list(DEFAULT_PHANTOMJS_FLAGS)
+    if CAPTURE_PROXY is not None:
+        flags.append('--proxy=%s' % CAPTURE_PROXY.address)
+    return flags
+
+
+def get_capture_args(*script_args):
+    """Returns the command line for running the capture script.
+
+    Args:
+        *script_args: Arguments to pass to the capture script.
+    """
+    if FLAGS.phantomjs_binary:
+        logging.info(
+            'Using FLAGS.phantomjs_binary which is deprecated in favor'
+            'of FLAGS.capture_binary - please update your config')
+        return ([FLAGS.phantomjs_binary] + get_phantomjs_flags() +
+                [FLAGS.phantomjs_script] + list(script_args))
+    else:
+        args = [FLAGS.capture_binary]
+        # Injects some default flags if we think this is phantomjs
+        if FLAGS.capture_binary.endswith('phantomjs'):
+            args += get_phantomjs_flags()
+        return args + [FLAGS.capture_script] + list(script_args)
+
+
+def get_capture_timeout(viewport_count=1):
+    """Returns how many seconds a single capture may take.
+
+    Args:
+        viewport_count: How many viewport sizes the capture screenshots.
+            Each size after the first needs time to settle again.
+    """
+    if FLAGS.phantomjs_timeout is not None:
+        logging.info(
+            'Using FLAGS.phantomjs_timeout which is deprecated in favor'
+            'of FLAGS.capture_timeout - please update your config')
+        return FLAGS.phantomjs_timeout * viewport_count
+    return FLAGS.capture_timeout * viewport_count
+
+
+def get_viewport_count(viewport_runs):
+    """Returns how many screenshots a capture task takes."""
+    return max(1, len(viewport_runs or []))
+
+
+def get_viewport_image_path(image_path, index):
+    """Returns where the capture script writes the screenshot for one
+    viewport size of a config with "viewportSizes".
+
+    The index goes before the extension, like capture.js does, so the
+    format of the screenshot stays the same.
+    """
+    base, extension = os.path.splitext(image_path)
+    return '%s.%d%s' % (base, index, extension)
+
+
 class CaptureWorkflow(process_worker.ProcessWorkflow):
     """Workflow for capturing a website screenshot using PhantomJs."""
 
-    def __init__(self, log_path, config_path, output_path):
+    def __init__(self, log_path, config_path, output_path, viewport_count=1):
         """Initializer.
 
         Args:
@@ -108,39 +244,464 @@ class CaptureWorkflow(process_worker.ProcessWorkflow):
             config_path: Path to the screenshot config file to pass
                 to PhantomJs.
             output_path: Where the output screenshot should be written.
+            viewport_count: How many viewport sizes the config captures.
         """
-        if FLAGS.phantomjs_timeout is not None:
-            logging.info(
-                'Using FLAGS.phantomjs_timeout which is deprecated in favor'
-                'of FLAGS.capture_timeout - please update your config')
-            capture_timeout = FLAGS.phantomjs_timeout
-        else:
-            capture_timeout = FLAGS.capture_timeout
         process_worker.ProcessWorkflow.__init__(
-            self, log_path, timeout_seconds=capture_timeout)
+            self, log_path,
+            timeout_seconds=get_capture_timeout(viewport_count))
         self.config_path = config_path
         self.output_path = output_path
 
     def get_args(self):
-        if FLAGS.phantomjs_binary:
-            logging.info(
-                'Using FLAGS.phantomjs_binary which is deprecated in favor'
-                'of FLAGS.capture_binary - please update your config')
-            return [FLAGS.phantomjs_binary] + DEFAULT_PHANTOMJS_FLAGS + [
-                FLAGS.phantomjs_script,
-                self.config_path,
-                self.output_path,
-            ]
+        return get_capture_args(self.config_path, self.output_path)
+
+
+class CaptureServer(object):
+    """A long-lived capture process that takes screenshots over HTTP.
+
+    The capture script is started with "--server <port>" and listens on
+    localhost. Each job is POSTed as JSON with the config, output and log
+    paths, and the response has the returncode the capture would have had
+    in its own process. The process is restarted after max_jobs captures
+    and whenever a job crashes or times out.
+    """
+
+    def __init__(self, max_jobs):
+        self.max_jobs = max_jobs
+        self.process = None
+        self.port = None
+        self.jobs = 0
+        self.log_path = None
+
+    @property
+    def alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def start(self):
+        """Starts the capture process and waits for it to listen.
+
+        Raises:
+            CaptureServerError if the server did not start in time.
+        """
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        self.port = sock.getsockname()[1]
+        sock.close()
+
+        output_file = tempfile.NamedTemporaryFile(
+            prefix='capture_server', suffix='.log', delete=False)
+        self.log_path = output_file.name
+        args = get_capture_args('--server', str(self.port))
+        logging.info('Starting capture server: %r', args)
+        try:
+            self.process = subprocess.Popen(
+                args,
+                stderr=subprocess.STDOUT,
+                stdout=output_file,
+                close_fds=True,
+                # No CPU limit since the server lives for many captures.
+                preexec_fn=process_worker.limit_resources(
+                    FLAGS.process_memory_limit_mb))
+        finally:
+            output_file.close()
+        self.jobs = 0
+
+        deadline = time.time() + FLAGS.capture_server_start_seconds
+        while time.time() < deadline:
+            if not self.alive:
+                break
+            try:
+                socket.create_connection(('127.0.0.1', self.port), 1).close()
+            except socket.error:
+                time.sleep(0.1)
+            else:
+                logging.info('Capture server pid=%r listening on port %d',
+                             self.process.pid, self.port)
+                return
+
+        self.stop()
+        raise CaptureServerError(
+            'Capture server did not start listening on port %d' % self.port)
+
+    def stop(self):
+        """Kills the capture process, if it's running."""
+        if self.process is None:
+            return
+        if self.alive:
+            logging.info('Stopping capture server pid=%r after %d jobs',
+                         self.process.pid, self.jobs)
+            process_worker.kill_process_group(self.process)
+        self.process.wait()
+        self.process = None
+        if self.log_path:
+            try:
+                os.remove(self.log_path)
+            except OSError:
+                pass
+            self.log_path = None
+
+    def capture(self, log_path, config_path, output_path, timeout_seconds):
+        """Takes a screenshot, starting the server first if needed.
+
+        Returns:
+            The returncode of the capture.
+
+        Raises:
+            process_worker.TimeoutError if the capture took too long.
+            CaptureServerError if the server could not take the job.
+        """
+        if not self.alive:
+            self.stop()
+            self.start()
+
+        self.jobs += 1
+        job = json.dumps(dict(
+            configPath=config_path,
+            outputPath=output_path,
+            logPath=log_path))
+        request = urllib2.Request(
+            'http://127.0.0.1:%d/' % self.port, job,
+            {'Content-Type': 'application/json'})
+        try:
+            conn = urllib2.urlopen(request, timeout=timeout_seconds)
+            try:
+                result = json.loads(conn.read())
+            finally:
+                conn.close()
+        except socket.timeout:
+            pid = self.process.pid
+            self.stop()
+            raise process_worker.TimeoutError(
+                'Killed capture server pid=%s after %s seconds' %
+                (pid, timeout_seconds))
+        except (urllib2.URLError, socket.error, httplib.HTTPException,
+                ValueError), e:
+            self.stop()
+            raise CaptureServerError(
+                'Capture server failed: %s: %s' % (e.__class__.__name__, e))
+
+        if self.jobs >= self.max_jobs:
+            self.stop()
+
+        return result.get('returncode', 1)
+
+
+class CaptureServerItem(workers.WorkItem):
+    """Work item for taking a screenshot with a long-lived capture server.
+
+    Args:
+        log_path: Where to write the verbose logging output.
+        config_path: Path to the screenshot config file.
+        output_path: Where the output screenshot should be written.
+        viewport_count: How many viewport sizes the config captures.
+
+    Attributes:
+        returncode: Return code of the capture.
+    """
+
+    def __init__(self, log_path, config_path, output_path, viewport_count=1):
+        workers.WorkItem.__init__(self)
+        self.log_path = log_path
+        self.config_path = config_path
+        self.output_path = output_path
+        self.viewport_count = viewport_count
+        self.returncode = None
+
+
+class CaptureServerThread(workers.WorkerThread):
+    """Worker thread that owns one capture server and feeds it jobs."""
+
+    def __init__(self, input_queue, output_queue):
+        workers.WorkerThread.__init__(self, input_queue, output_queue)
+        self.server = CaptureServer(FLAGS.capture_server_max_jobs)
+
+    def stop(self):
+        workers.WorkerThread.stop(self)
+        self.server.stop()
+
+    def handle_item(self, item):
+        item.returncode = self.server.capture(
+            item.log_path, item.config_path, item.output_path,
+            get_capture_timeout(item.viewport_count))
+        return item
+
+
+def get_encoded_image_path(image_path, image_format):
+    """Returns where the encoded copy of a screenshot goes."""
+    base, _ = os.path.splitext(image_path)
+    return '%s.encoded.%s' % (base, image_format)
+
+
+def encode_image(source_path, dest_path, image_format):
+    """Re-encodes a screenshot losslessly in the given format.
+
+    Only takes and returns small values so it can run in a worker process.
+
+    Returns:
+        Tuple (seconds, source_bytes, dest_bytes).
+    """
+    start = time.time()
+    image = Image.open(source_path)
+    if image_format == 'webp':
+        image.save(dest_path, 'WEBP', lossless=True)
+    else:
+        image.save(dest_path, 'PNG', optimize=True)
+    return (time.time() - start,
+            os.path.getsize(source_path),
+            os.path.getsize(dest_path))
+
+
+def _init_encode_process():
+    """Initializes an encode process to leave interrupts to the parent."""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+class EncodeImageItem(workers.WorkItem):
+    """Work item for re-encoding a screenshot with encode_image.
+
+    Args:
+        source_path: Path of the screenshot as captured.
+        dest_path: Where to write the encoded screenshot.
+        image_format: Format to encode to, png or webp.
+
+    Attributes:
+        seconds: How long encoding took.
+        source_bytes, dest_bytes: Sizes of the screenshot before and after.
+        failure_reason: Why encoding failed, if it did.
+    """
+
+    def __init__(self, source_path, dest_path, image_format):
+        workers.WorkItem.__init__(self)
+        self.source_path = source_path
+        self.dest_path = dest_path
+        self.image_format = image_format
+        self.seconds = None
+        self.source_bytes = None
+        self.dest_bytes = None
+        self.failure_reason = None
+
+
+class EncodeImageThread(workers.WorkerThread):
+    """Worker thread that runs EncodeImageItems.
+
+    Args:
+        pool: Optional multiprocessing.Pool to encode in. The thread waits
+            for the result without holding the interpreter lock, and gives
+            up on it after --capture_timeout seconds.
+    """
+
+    def __init__(self, input_queue, output_queue, pool=None):
+        workers.WorkerThread.__init__(self, input_queue, output_queue)
+        self.pool = pool
+
+    def handle_item(self, item):
+        args = (item.source_path, item.dest_path, item.image_format)
+        try:
+            if self.pool:
+                result = self.pool.apply_async(encode_image, args).get(
+                    FLAGS.capture_timeout)
+            else:
+                result = encode_image(*args)
+        except multiprocessing.TimeoutError:
+            item.failure_reason = 'Encoding %s timed out after %d seconds' % (
+                os.path.basename(item.source_path), FLAGS.capture_timeout)
+        except Exception, e:
+            # A bad screenshot only fails its own run.
+            item.failure_reason = 'Encoding %s failed: %s: %s' % (
+                os.path.basename(item.source_path), e.__class__.__name__, e)
+        else:
+            item.seconds, item.source_bytes, item.dest_bytes = result
+        return item
+
+
+class ManifestCaptureWorkflow(process_worker.ProcessWorkflow):
+    """Workflow for capturing many screenshots in one capture process.
+
+    Returns the process's return code. Each capture's own result is
+    written to results_path; see read_manifest_results.
+    """
+
+    def __init__(self, log_path, manifest_path, results_path, job_count,
+                 viewport_count=1):
+        """Initializer.
+
+        Args:
+            log_path: Where to write output from the process that isn't
+                for a particular capture.
+            manifest_path: Path to the JSON manifest of capture jobs.
+            results_path: Where the capture process writes the result of
+                each job.
+            job_count: Number of jobs in the manifest.
+            viewport_count: Most viewport sizes captured by any job.
+        """
+        process_worker.ProcessWorkflow.__init__(
+            self, log_path,
+            timeout_seconds=get_capture_timeout(viewport_count) * job_count)
+        self.manifest_path = manifest_path
+        self.results_path = results_path
+
+    def get_args(self):
+        return get_capture_args(
+            '--manifest', self.manifest_path, self.results_path)
+
+
+def write_manifest(manifest_path, job_list, viewport_count=1):
+    """Writes a manifest of capture jobs for ManifestCaptureWorkflow.
+
+    Args:
+        manifest_path: Where to write the manifest.
+        job_list: List of (log_path, config_path, output_path) tuples.
+        viewport_count: Most viewport sizes captured by any job.
+    """
+    manifest = dict(
+        timeoutMs=get_capture_timeout(viewport_count) * 1000,
+        jobs=[
+            dict(logPath=log_path, configPath=config_path,
+                 outputPath=output_path)
+            for log_path, config_path, output_path in job_list])
+    with open(manifest_path, 'w') as manifest_file:
+        json.dump(manifest, manifest_file)
+
+
+def read_manifest_results(results_path, job_count):
+    """Returns the return code of each job in a manifest.
+
+    Jobs the capture process never got to, because it crashed or timed
+    out, have a return code of None.
+    """
+    returncodes = []
+    if os.path.isfile(results_path):
+        try:
+            with open(results_path) as results_file:
+                returncodes = json.load(results_file)['returncodes']
+        except (ValueError, KeyError):
+            pass
+    returncodes = returncodes[:job_count]
+    return returncodes + [None] * (job_count - len(returncodes))
+
+
+def get_config_group_key(config_path):
+    """Returns a key that's the same for configs that can share a process.
+
+    Configs are compatible when they only differ in the URL to capture
+    and the regions to ignore afterwards.
+    """
+    with open(config_path) as config_file:
+        config = json.load(config_file)
+    config.pop('targetUrl', None)
+    config.pop('ignoreRegions', None)
+    return json.dumps(config, sort_keys=True)
+
+
+class ReportCaptureWorkflow(workers.WorkflowItem):
+    """Uploads the result of a capture and reports it to the server.
+
+    Args:
+        build_id: ID of the build.
+        release_name: Name of the release.
+        release_number: Number of the release candidate.
+        run_name: Run the capture was for.
+        baseline: True when the capture is for the reference baseline.
+        output_path: Directory with the capture's files.
+        image_path: Path of the screenshot.
+        log_path: Path of the capture log.
+        config_path: Path of the capture config.
+        capture_failed: True if the capture failed.
+        failure_reason: Why the capture failed, if it did.
+        heartbeat: Function to call with progress status.
+        viewport_runs: Optional. List of dictionaries with the run_name of
+            each viewport size the capture took, in order. Each screenshot
+            is reported to its own run instead of run_name.
+
+    Raises:
+        CaptureFailedError if the capture failed.
+    """
+
+    def run(self, build_id, release_name, release_number, run_name, baseline,
+            output_path, image_path, log_path, config_path, capture_failed,
+            failure_reason, heartbeat, viewport_runs=None):
+        if viewport_runs:
+            report_list = [
+                (viewport_run['run_name'],
+                 get_viewport_image_path(image_path, i),
+                 os.path.join(output_path, 'mask.%d.json' % i))
+                for i, viewport_run in enumerate(viewport_runs)]
         else:
-            args = [FLAGS.capture_binary]
-            # Injects some default flags if we think this is phantomjs
-            if FLAGS.capture_binary.endswith('phantomjs'):
-                args += DEFAULT_PHANTOMJS_FLAGS
-            return args + [
-                FLAGS.capture_script,
-                self.config_path,
-                self.output_path,
-            ]
+            report_list = [
+                (run_name, image_path, os.path.join(output_path, 'mask.json'))]
+
+        run_list = []
+        for report_run_name, report_image_path, mask_path in report_list:
+            run = dict(run_name=report_run_name, image_path=report_image_path,
+                       failed=capture_failed, failure_reason=failure_reason)
+            if not run['failed'] and not os.path.exists(report_image_path):
+                run['failed'] = True
+                run['failure_reason'] = 'Capture did not write %s' % (
+                    os.path.basename(report_image_path))
+
+            if not run['failed']:
+                try:
+                    mask_path = masks.build_mask(
+                        config_path, report_image_path, mask_path)
+                except (masks.Error, ValueError), e:
+                    run['failed'] = True
+                    run['failure_reason'] = str(e)
+            run['mask_path'] = mask_path
+            run_list.append(run)
+
+        encode_list = []
+        if FLAGS.capture_encode_format:
+            for run in run_list:
+                if not run['failed']:
+                    encode_list.append((run, EncodeImageItem(
+                        run['image_path'],
+                        get_encoded_image_path(
+                            run['image_path'], FLAGS.capture_encode_format),
+                        FLAGS.capture_encode_format)))
+
+        if encode_list:
+            yield heartbeat('Encoding screenshots as %s' %
+                            FLAGS.capture_encode_format)
+            yield [item for _, item in encode_list]
+            for run, item in encode_list:
+                if item.failure_reason:
+                    run['failed'] = True
+                    run['failure_reason'] = item.failure_reason
+                    write_log(log_path, item.failure_reason)
+                    continue
+                run['image_path'] = item.dest_path
+                write_log(log_path, 'Encoded %s as %s in %.3f seconds, '
+                          '%d bytes -> %d bytes' % (
+                              os.path.basename(item.source_path),
+                              item.image_format, item.seconds,
+                              item.source_bytes, item.dest_bytes))
+
+        workflow_list = []
+        failure_list = []
+        for run in run_list:
+            # Don't upload bad captures, but always upload the error log.
+            if run['failed']:
+                run['image_path'] = None
+                run['mask_path'] = None
+                failure_list.append(run['failure_reason'])
+
+            workflow_list.append(queue_worker.CatchErrorWorkflow(
+                release_worker.ReportRunWorkflow(
+                    build_id, release_name, release_number, run['run_name'],
+                    image_path=run['image_path'], log_path=log_path,
+                    mask_path=run['mask_path'], baseline=baseline,
+                    run_failed=run['failed'])))
+
+        yield heartbeat('Reporting capture status to server')
+        error_list = yield workflow_list
+        for error in error_list:
+            if error is not None:
+                raise error
+
+        if failure_list:
+            raise CaptureFailedError(
+                FLAGS.capture_task_max_attempts,
+                failure_list[0])
 
 
 class DoCaptureQueueWorkflow(workers.WorkflowItem):
@@ -155,16 +716,23 @@ class DoCaptureQueueWorkflow(workers.WorkflowItem):
         config_sha1sum: Content hash of the config for the new screenshot.
         baseline: Optional. When specified and True, this capture is for
             the reference baseline of the specified run, not the new capture.
+        viewport_runs: Optional. List of dictionaries with the run_name and
+            viewport_size of each screenshot, when the config captures
+            many viewport sizes from one page load.
         heartbeat: Function to call with progress status.
 
-    Raises:
-        CaptureFailedError if the screenshot process failed.
+    Returns:
+        queue_worker.FollowOn that encodes and reports the screenshots, so
+        the task's slot can start the next capture in the meantime. It
+        raises CaptureFailedError if the screenshot process failed.
     """
 
     def run(self, build_id=None, release_name=None, release_number=None,
             run_name=None, url=None, config_sha1sum=None, baseline=None,
-            heartbeat=None):
+            viewport_runs=None, heartbeat=None):
+        viewport_count = get_viewport_count(viewport_runs)
         output_path = tempfile.mkdtemp()
+        report = None
         try:
             image_path = os.path.join(output_path, 'capture.%s' % FLAGS.capture_format)
             log_path = os.path.join(output_path, 'log.txt')
@@ -177,31 +745,258 @@ class DoCaptureQueueWorkflow(workers.WorkflowItem):
                 build_id, config_sha1sum, result_path=config_path)
 
             yield heartbeat('Running webpage capture process')
+            start = time.time()
             try:
-                returncode = yield CaptureWorkflow(
-                    log_path, config_path, image_path)
-            except (process_worker.TimeoutError, OSError), e:
+                if FLAGS.capture_servers:
+                    item = yield CaptureServerItem(
+                        log_path, config_path, image_path, viewport_count)
+                    returncode = item.returncode
+                else:
+                    returncode = yield CaptureWorkflow(
+                        log_path, config_path, image_path, viewport_count)
+            except (process_worker.TimeoutError, OSError,
+                    CaptureServerError), e:
                 failure_reason = str(e)
             else:
                 capture_failed = returncode != 0
                 failure_reason = 'returncode=%s' % returncode
+            write_log(log_path, 'Capture took %.3f seconds' % (
+                time.time() - start))
 
-            # Don't upload bad captures, but always upload the error log.
-            if capture_failed:
-                image_path = None
-
-            yield heartbeat('Reporting capture status to server')
-            yield release_worker.ReportRunWorkflow(
-                build_id, release_name, release_number, run_name,
-                image_path=image_path, log_path=log_path, baseline=baseline,
-                run_failed=capture_failed)
-
-            if capture_failed:
-                raise CaptureFailedError(
-                    FLAGS.capture_task_max_attempts,
-                    failure_reason)
+            report = ReportCaptureWorkflow(
+                build_id, release_name, release_number, run_name, baseline,
+                output_path, image_path, log_path, config_path,
+                capture_failed, failure_reason, heartbeat,
+                viewport_runs=viewport_runs)
+        finally:
+            if report is None:
+                shutil.rmtree(output_path, True)
+
+        raise workers.Return(queue_worker.FollowOn(
+            CleanupWorkflow(report, output_path)))
+
+
+class ReportCaptureBatchWorkflow(workers.WorkflowItem):
+    """Reports the captures of a DoCaptureBatchWorkflow.
+
+    Args:
+        report_list: ReportCaptureWorkflows to run, each wrapped in a
+            queue_worker.CatchErrorWorkflow.
+        report_indexes: Index of the task each report is for.
+        error_list: The exception raised for each task so far, or None.
+
+    Returns:
+        error_list updated with the exceptions raised by the reports.
+    """
+
+    def run(self, report_list, report_indexes, error_list):
+        report_errors = yield report_list
+        for i, error in zip(report_indexes, report_errors):
+            error_list[i] = error
+        raise workers.Return(error_list)
+
+
+class CleanupWorkflow(workers.WorkflowItem):
+    """Runs a workflow and then removes the directory of its files.
+
+    Args:
+        workflow: WorkflowItem to run.
+        path: Directory to remove once workflow is done.
+
+    Returns:
+        What workflow returns.
+    """
+
+    def run(self, workflow, path):
+        try:
+            result = yield workflow
+        finally:
+            shutil.rmtree(path, True)
+        raise workers.Return(result)
+
+
+def _heartbeat_manifests(payload_list, manifest_list, group_list):
+    """Returns heartbeat workflows for every job in running manifests.
+
+    Args:
+        payload_list: List of DoCaptureQueueWorkflow parameters.
+        manifest_list: Path of the manifest for each group.
+        group_list: List of the indexes into payload_list in each manifest.
+    """
+    heartbeat_list = []
+    for manifest_path, index_list in zip(manifest_list, group_list):
+        returncodes = read_manifest_results(
+            manifest_path + '.results', len(index_list))
+        for i, returncode in zip(index_list, returncodes):
+            if returncode is None:
+                message = ('Running webpage capture process with %d others' %
+                           (len(index_list) - 1))
+            else:
+                message = 'Captured, waiting for the rest of its process'
+            heartbeat_list.append(payload_list[i]['heartbeat'](message))
+    return heartbeat_list
+
+
+class DoCaptureBatchWorkflow(workers.WorkflowItem):
+    """Runs many webpage captures from the queue in shared processes.
+
+    Tasks with compatible configs are captured one after another by a
+    single capture process from a manifest, so they share its startup
+    and its warm cache. Each task still gets its own log and result.
+    Every task is heartbeated each --queue_update_flush_seconds while the
+    capture processes run, so the leases of jobs late in a manifest don't
+    expire while the jobs before them are captured.
+
+    Args:
+        payload_list: List of dictionaries of DoCaptureQueueWorkflow
+            parameters, each with its own heartbeat function.
+
+    Returns:
+        queue_worker.FollowOn that encodes and reports the screenshots, so
+        the tasks' slot can start the next captures in the meantime. It
+        returns a list with the exception raised by each task, or None if
+        the task succeeded, in the same order as payload_list.
+    """
+
+    def run(self, payload_list):
+        batch_path = tempfile.mkdtemp()
+        report = None
+        try:
+            path_list = []
+            for i, payload in enumerate(payload_list):
+                output_path = os.path.join(batch_path, str(i))
+                os.mkdir(output_path)
+                log_path = os.path.join(output_path, 'log.txt')
+                open(log_path, 'w').close()
+                path_list.append(dict(
+                    output_path=output_path,
+                    image_path=os.path.join(
+                        output_path, 'capture.%s' % FLAGS.capture_format),
+                    log_path=log_path,
+                    config_path=os.path.join(output_path, 'config.json')))
+
+            yield [payload['heartbeat']('Fetching webpage capture config')
+                   for payload in payload_list]
+            fetch_errors = yield [
+                queue_worker.CatchErrorWorkflow(
+                    release_worker.DownloadArtifactWorkflow(
+                        payload['build_id'], payload['config_sha1sum'],
+                        result_path=paths['config_path']))
+                for payload, paths in zip(payload_list, path_list)]
+
+            error_list = list(fetch_errors)
+            groups = {}
+            for i, paths in enumerate(path_list):
+                if error_list[i] is not None:
+                    continue
+                try:
+                    key = get_config_group_key(paths['config_path'])
+                except ValueError:
+                    # Let the capture process report the bad config.
+                    key = i
+                groups.setdefault(key, []).append(i)
+
+            group_list = groups.values()
+            manifest_list = []
+            viewport_count_list = []
+            for group_index, index_list in enumerate(group_list):
+                manifest_path = os.path.join(
+                    batch_path, 'manifest%d.json' % group_index)
+                viewport_count = max(
+                    get_viewport_count(payload_list[i].get('viewport_runs'))
+                    for i in index_list)
+                write_manifest(manifest_path, [
+                    (path_list[i]['log_path'], path_list[i]['config_path'],
+                     path_list[i]['image_path'])
+                    for i in index_list], viewport_count)
+                manifest_list.append(manifest_path)
+                viewport_count_list.append(viewport_count)
+
+            start = time.time()
+            process_list = [
+                queue_worker.CatchErrorWorkflow(ManifestCaptureWorkflow(
+                    manifest_path + '.log', manifest_path,
+                    manifest_path + '.results', len(index_list),
+                    viewport_count))
+                for manifest_path, index_list, viewport_count
+                in zip(manifest_list, group_list, viewport_count_list)]
+            running = list(process_list)
+            timer = None
+            while running:
+                if timer is None or timer.done:
+                    # A task whose lease was lost fails on its first
+                    # heartbeat when its capture is reported.
+                    yield [queue_worker.CatchErrorWorkflow(workflow)
+                           for workflow in _heartbeat_manifests(
+                               payload_list, manifest_list, group_list)]
+                    timer = timer_worker.TimerItem(
+                        FLAGS.queue_update_flush_seconds)
+                yield workers.WaitAny(running + [timer])
+                running = [x for x in running if not x.done]
+
+            process_results = [x.result for x in process_list]
+            capture_seconds = time.time() - start
+
+            report_list = []
+            report_indexes = []
+            for manifest_path, index_list, process_result in zip(
+                    manifest_list, group_list, process_results):
+                returncodes = read_manifest_results(
+                    manifest_path + '.results', len(index_list))
+                for i, returncode in zip(index_list, returncodes):
+                    write_log(path_list[i]['log_path'],
+                              'Capture process for %d jobs took %.3f seconds'
+                              % (len(index_list), capture_seconds))
+                    if returncode is None:
+                        capture_failed = True
+                        failure_reason = (
+                            'Capture process for %d jobs ended before '
+                            'finishing this one' % len(index_list))
+                        if process_result is not None:
+                            failure_reason += '. %s: %s' % (
+                                process_result.__class__.__name__,
+                                process_result)
+                        write_log(path_list[i]['log_path'], failure_reason)
+                    else:
+                        capture_failed = returncode != 0
+                        failure_reason = 'returncode=%s' % returncode
+
+                    payload = payload_list[i]
+                    paths = path_list[i]
+                    report_indexes.append(i)
+                    report_list.append(queue_worker.CatchErrorWorkflow(
+                        ReportCaptureWorkflow(
+                            payload['build_id'], payload['release_name'],
+                            payload['release_number'], payload['run_name'],
+                            payload.get('baseline'), paths['output_path'],
+                            paths['image_path'], paths['log_path'],
+                            paths['config_path'], capture_failed,
+                            failure_reason, payload['heartbeat'],
+                            viewport_runs=payload.get('viewport_runs'))))
+
+            report = ReportCaptureBatchWorkflow(
+                report_list, report_indexes, error_list)
         finally:
-            shutil.rmtree(output_path, True)
+            if report is None:
+                shutil.rmtree(batch_path, True)
+
+        raise workers.Return(queue_worker.FollowOn(
+            CleanupWorkflow(report, batch_path)))
+
+
+def start_processes():
+    """Starts the pool of encode processes for --capture_encode_processes.
+
+    The processes are forked from this one, so this should be called
+    before anything starts a thread; run_server does so before it
+    registers any workers. Otherwise register() starts them.
+    """
+    global ENCODE_POOL
+    if (FLAGS.capture_encode_format and FLAGS.capture_encode_processes > 0 and
+            ENCODE_POOL is None):
+        ENCODE_POOL = multiprocessing.Pool(
+            FLAGS.capture_encode_processes,
+            initializer=_init_encode_process)
 
 
 def register(coordinator):
@@ -218,10 +1013,58 @@ def register(coordinator):
     assert FLAGS.capture_threads > 0
     assert FLAGS.queue_server_prefix
 
+    assert FLAGS.capture_batch_size > 0
+    assert not (FLAGS.capture_servers and FLAGS.capture_batch_size > 1)
+
+    if FLAGS.capture_encode_format:
+        assert Image is not None, (
+            '--capture_encode_format requires the Pillow package')
+        assert FLAGS.capture_encode_processes >= 0
+
+        start_processes()
+        pool = ENCODE_POOL
+
+        # Each encode in flight ties up a thread waiting on the pool, so
+        # have enough threads to keep every process busy.
+        encode_queue = Queue.Queue()
+        coordinator.register(EncodeImageItem, encode_queue)
+        for i in xrange(max(FLAGS.capture_threads,
+                            FLAGS.capture_encode_processes)):
+            coordinator.worker_threads.append(
+                EncodeImageThread(encode_queue, coordinator.input_queue,
+                                  pool=pool))
+
+    global CAPTURE_PROXY
+    if FLAGS.capture_proxy_cache_dir and CAPTURE_PROXY is None:
+        assert FLAGS.capture_proxy_cache_mb > 0
+        CAPTURE_PROXY = cache_proxy.start(
+            FLAGS.capture_proxy_cache_dir,
+            FLAGS.capture_proxy_cache_mb * 1024 * 1024,
+            port=FLAGS.capture_proxy_port)
+    local_batch_workflow = None
+    if FLAGS.capture_batch_size > 1:
+        local_batch_workflow = DoCaptureBatchWorkflow
+
+    if FLAGS.capture_servers:
+        assert FLAGS.capture_server_max_jobs > 0
+        server_queue = Queue.Queue()
+        coordinator.register(CaptureServerItem, server_queue)
+        for i in xrange(FLAGS.capture_servers):
+            coordinator.worker_threads.append(
+                CaptureServerThread(server_queue, coordinator.input_queue))
+
+    controller = None
+    if FLAGS.adaptive_concurrency:
+        controller = concurrency.ConcurrencyController(
+            constants.CAPTURE_QUEUE_NAME, FLAGS.capture_threads)
+
     item = queue_worker.RemoteQueueWorkflow(
         constants.CAPTURE_QUEUE_NAME,
         DoCaptureQueueWorkflow,
         max_tasks=FLAGS.capture_threads,
-        wait_seconds=FLAGS.capture_wait_seconds)
+        controller=controller,
+        wait_seconds=FLAGS.capture_wait_seconds,
+        local_batch_workflow=local_batch_workflow,
+        batch_size=FLAGS.capture_batch_size)
     item.root = True
     coordinator.input_queue.put(item)
@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+# Copyright 2013 Brett Slatkin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Adaptive control of how many queue tasks a worker runs at once."""
+
+import json
+import logging
+import multiprocessing
+import os
+import tempfile
+import time
+
+# Local Libraries
+import gflags
+FLAGS = gflags.FLAGS
+
+
+gflags.DEFINE_bool(
+    'adaptive_concurrency', False,
+    'Adjust the number of concurrent tasks for each queue based on host '
+    'CPU load, memory pressure, and task latency. When set, flags like '
+    '--capture_threads become the upper bound instead of a fixed count.')
+
+gflags.DEFINE_integer(
+    'adaptive_min_tasks', 1,
+    'Lower bound on concurrent tasks per queue with --adaptive_concurrency.')
+
+gflags.DEFINE_integer(
+    'adaptive_interval_seconds', 30,
+    'How often to reconsider the number of concurrent tasks per queue.')
+
+gflags.DEFINE_float(
+    'adaptive_max_cpu_load', 0.9,
+    'One-minute load average per CPU above which concurrency is reduced.')
+
+gflags.DEFINE_float(
+    'adaptive_min_free_memory', 0.1,
+    'Fraction of available memory below which concurrency is reduced.')
+
+gflags.DEFINE_float(
+    'adaptive_max_latency_ratio', 2.0,
+    'Reduce concurrency when recent task latency is more than this many '
+    'times the long-term average task latency.')
+
+gflags.DEFINE_string(
+    'worker_metrics_path', None,
+    'When set, a JSON snapshot of each concurrency controller\'s state '
+    'and decisions is written to this path after every adjustment.')
+
+
+# All controllers in this process by queue name, for the metrics file.
+CONTROLLERS = {}
+
+
+def get_cpu_load():
+    """Returns the one-minute load average per CPU, or None if unknown."""
+    try:
+        return os.getloadavg()[0] / multiprocessing.cpu_count()
+    except (AttributeError, OSError, NotImplementedError):
+        return None
+
+
+def get_free_memory():
+    """Returns the fraction of memory available, or None if unknown."""
+    info = {}
+    try:
+        with open('/proc/meminfo') as meminfo:
+            for line in meminfo:
+                name, value = line.split(':', 1)
+                info[name] = int(value.split()[0])
+    except (IOError, ValueError):
+        return None
+
+    total = info.get('MemTotal')
+    available = info.get('MemAvailable')
+    if available is None and 'MemFree' in info:
+        # Older kernels don't report MemAvailable.
+        available = (
+            info['MemFree'] + info.get('Buffers', 0) + info.get('Cached', 0))
+    if not total or available is None:
+        return None
+    return float(available) / total
+
+
+def write_metrics():
+    """Writes the state of all controllers to --worker_metrics_path."""
+    if not FLAGS.worker_metrics_path:
+        return
+
+    data = dict(
+        (queue_name, controller.metrics())
+        for queue_name, controller in CONTROLLERS.iteritems())
+
+    # Write to a temporary file and rename so readers never see a
+    # partially written file.
+    output_dir = os.path.dirname(os.path.abspath(FLAGS.worker_metrics_path))
+    handle, temp_path = tempfile.mkstemp(dir=output_dir)
+    try:
+        with os.fdopen(handle, 'w') as output:
+            json.dump(data, output, indent=2, sort_keys=True)
+        os.rename(temp_path, FLAGS.worker_metrics_path)
+    except (IOError, OSError):
+        logging.exception('Could not write worker metrics to %r',
+                          FLAGS.worker_metrics_path)
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+class ConcurrencyController(object):
+    """Raises and lowers the number of task slots for a queue.
+
+    Uses additive increase and multiplicative decrease: while every slot is
+    busy and the host has spare capacity the limit goes up by one each
+    interval. When the host is overloaded or tasks slow down, the limit
+    drops by a quarter. The limit always stays within [min_tasks,
+    max_tasks].
+    """
+
+    # Smoothing factors for the recent and long-term task latency.
+    FAST_ALPHA = 0.3
+    SLOW_ALPHA = 0.02
+
+    # Ignore latency until this many tasks have finished.
+    MIN_LATENCY_SAMPLES = 5
+
+    def __init__(self, queue_name, max_tasks, min_tasks=None,
+                 get_cpu_load=get_cpu_load, get_free_memory=get_free_memory,
+                 clock=time.time):
+        """Initializer.
+
+        Args:
+            queue_name: Name of the queue this controls, for logs and metrics.
+            max_tasks: Upper bound on concurrent tasks. Also the initial limit.
+            min_tasks: Lower bound on concurrent tasks. Defaults to the
+                --adaptive_min_tasks flag.
+            get_cpu_load, get_free_memory, clock: Overridable for tests.
+        """
+        if min_tasks is None:
+            min_tasks = FLAGS.adaptive_min_tasks
+        assert 0 < min_tasks <= max_tasks
+
+        self.queue_name = queue_name
+        self.min_tasks = min_tasks
+        self.max_tasks = max_tasks
+        self.limit = max_tasks
+        self.running = 0
+
+        self.get_cpu_load = get_cpu_load
+        self.get_free_memory = get_free_memory
+        self.clock = clock
+        self.last_adjust = clock()
+
+        self.latency_samples = 0
+        self.fast_latency = None
+        self.slow_latency = None
+        self.busy = False
+
+        self.cpu_load = None
+        self.free_memory = None
+        self.increases = 0
+        self.decreases = 0
+        self.last_decision = 'hold'
+        self.last_reason = 'starting'
+
+        CONTROLLERS[queue_name] = self
+
+    def acquire(self):
+        """Claims a slot to start a task; returns False if at the limit."""
+        if self.running >= self.limit:
+            return False
+        self.running += 1
+        if self.running == self.limit:
+            self.busy = True
+        return True
+
+    def release(self, latency_seconds):
+        """Returns a slot after a task finishes.
+
+        Args:
+            latency_seconds: How long the task took to run.
+        """
+        self.running -= 1
+        self.latency_samples += 1
+        if self.fast_latency is None:
+            self.fast_latency = self.slow_latency = latency_seconds
+        else:
+            self.fast_latency += (
+                self.FAST_ALPHA * (latency_seconds - self.fast_latency))
+            self.slow_latency += (
+                self.SLOW_ALPHA * (latency_seconds - self.slow_latency))
+
+    def _get_overload_reason(self):
+        """Returns why the host is overloaded, or None if it isn't."""
+        if (self.cpu_load is not None and
+                self.cpu_load > FLAGS.adaptive_max_cpu_load):
+            return 'cpu_load=%.2f' % self.cpu_load
+        if (self.free_memory is not None and
+                self.free_memory < FLAGS.adaptive_min_free_memory):
+            return 'free_memory=%.2f' % self.free_memory
+        if (self.latency_samples >= self.MIN_LATENCY_SAMPLES and
+                self.slow_latency > 0 and
+                self.fast_latency / self.slow_latency >
+                    FLAGS.adaptive_max_latency_ratio):
+            return 'latency=%.1fs average=%.1fs' % (
+                self.fast_latency, self.slow_latency)
+        return None
+
+    def maybe_adjust(self):
+        """Adjusts the limit if the adjustment interval has passed.
+
+        Returns:
+            The current limit.
+        """
+        now = self.clock()
+        if now - self.last_adjust < FLAGS.adaptive_interval_seconds:
+            return self.limit
+        self.last_adjust = now
+
+        self.cpu_load = self.get_cpu_load()
+        self.free_memory = self.get_free_memory()
+
+        previous = self.limit
+        reason = self._get_overload_reason()
+        if reason:
+            decrease = max(1, self.limit / 4)
+            self.limit = max(self.min_tasks, self.limit - decrease)
+        elif self.busy:
+            self.limit = min(self.max_tasks, self.limit + 1)
+            reason = 'all slots busy'
+        else:
+            reason = 'spare slots'
+
+        if self.limit > previous:
+            self.increases += 1
+            self.last_decision = 'increase'
+        elif self.limit < previous:
+            self.decreases += 1
+            self.last_decision = 'decrease'
+        else:
+            self.last_decision = 'hold'
+        self.last_reason = reason
+
+        if self.limit != previous:
+            logging.info('Concurrency for queue=%r changed from %d to %d: %s',
+                         self.queue_name, previous, self.limit, reason)
+
+        # Only count the slots as busy if they fill up again.
+        self.busy = self.running >= self.limit
+
+        write_metrics()
+        return self.limit
+
+    def metrics(self):
+        """Returns a JSON-able dictionary of the controller's state."""
+        return dict(
+            limit=self.limit,
+            min_tasks=self.min_tasks,
+            max_tasks=self.max_tasks,
+            running=self.running,
+            cpu_load=self.cpu_load,
+            free_memory=self.free_memory,
+            fast_latency=self.fast_latency,
+            slow_latency=self.slow_latency,
+            increases=self.increases,
+            decreases=self.decreases,
+            last_decision=self.last_decision,
+            last_reason=self.last_reason)
@@ -0,0 +1,611 @@
+#!/usr/bin/env python
+# Copyright 2013 Brett Slatkin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""In-process perceptual diffs of screenshots using NumPy and PIL.
+
+Produces the same results as the ImageMagick pipeline in pdiff_worker:
+the reference image is anchored at the top-left and padded with
+transparent pixels or cropped to the size of the run image, then the
+normalized root mean squared error is computed across all channels.
+
+Images are compared in horizontal strips of a fixed number of rows, so
+the temporary arrays used for the comparison are bounded by the strip
+size instead of the page height, and the highlight image is compressed
+and written to disk one strip at a time. The decoded input images are
+not bounded: both stay in memory whole because PIL can't decode a PNG
+one part at a time, though at a byte per channel instead of the 16-bit
+quantum of ImageMagick.
+
+NumPy and PIL are optional dependencies, only needed when this engine is
+selected with --pdiff_engine=numpy.
+"""
+
+import hashlib
+import json
+import math
+import struct
+import zlib
+
+try:
+    import numpy
+    from PIL import Image
+except ImportError:
+    numpy = None
+    Image = None
+
+
+# Colors used by "compare -highlight-color Red -compose Src".
+HIGHLIGHT_COLOR = (255, 0, 0, 255)
+LOWLIGHT_COLOR = (255, 255, 255, 204)
+
+# ImageMagick reports absolute distortion in units of a 16-bit quantum.
+QUANTUM_RANGE = 65535
+
+CHANNEL_NAMES = ('red', 'green', 'blue', 'alpha')
+
+# Default number of rows compared at a time.
+TILE_HEIGHT = 512
+
+# Changed pixels are grouped into square cells of this many pixels on a
+# side before finding connected regions, so nearby changes are merged and
+# region bounding boxes are accurate to within a cell.
+REGION_CELL_SIZE = 8
+
+# Only the largest regions are listed in the region summary.
+MAX_REGIONS = 500
+
+
+class Error(Exception):
+    """Base class for exceptions in this module."""
+
+
+class MissingDependencyError(Error):
+    """NumPy or PIL is not installed."""
+
+
+def check_available():
+    """Raises MissingDependencyError if NumPy or PIL are missing."""
+    if numpy is None or Image is None:
+        raise MissingDependencyError(
+            'The numpy pdiff engine requires the numpy and Pillow packages')
+
+
+def open_image(path):
+    """Opens and decodes an image file."""
+    image = Image.open(path)
+    image.load()
+    return image
+
+
+def get_strip(image, top, bottom, width):
+    """Returns some rows of an image as an RGBA array.
+
+    The image is anchored at the top-left corner, the same as
+    "composite -compose src -gravity NorthWest". Pixels outside of the
+    image are transparent.
+
+    Args:
+        image: PIL image.
+        top, bottom: Range of rows to return, bottom exclusive.
+        width: Width of the strip to return.
+
+    Returns:
+        Array of shape (bottom - top, width, 4).
+    """
+    result = numpy.zeros((bottom - top, width, 4), dtype=numpy.uint8)
+    copy_width = min(width, image.size[0])
+    copy_bottom = min(bottom, image.size[1])
+    if top < copy_bottom and copy_width > 0:
+        strip = image.crop((0, top, copy_width, copy_bottom))
+        if strip.mode != 'RGBA':
+            strip = strip.convert('RGBA')
+        result[:copy_bottom - top, :copy_width] = numpy.asarray(strip)
+    return result
+
+
+def load_image(path):
+    """Decodes an image file into an RGBA array of shape (height, width, 4)."""
+    image = open_image(path)
+    return get_strip(image, 0, image.size[1], image.size[0])
+
+
+def iter_tiles(height, tile_height):
+    """Yields (top, bottom) row ranges covering the given height."""
+    for top in xrange(0, height, tile_height):
+        yield top, min(height, top + tile_height)
+
+
+def new_pixel_digest(width, height):
+    """Returns a hash object for pixel_hash, before any rows are added.
+
+    The rows of the image must be added in order, each as the bytes of an
+    RGBA array from get_strip.
+    """
+    digest = hashlib.sha1()
+    digest.update('rgba8:%dx%d:' % (width, height))
+    return digest
+
+
+def pixel_hash(image, tile_height=TILE_HEIGHT):
+    """Returns a content hash of an image's decoded pixels and dimensions.
+
+    Unlike the SHA1 of the file, this ignores how the image was encoded, so
+    PNGs that differ only in metadata or compression have the same hash.
+
+    Args:
+        image: PIL image.
+        tile_height: Number of rows to convert to RGBA at a time.
+    """
+    width, height = image.size
+    digest = new_pixel_digest(width, height)
+    for top, bottom in iter_tiles(height, tile_height):
+        digest.update(get_strip(image, top, bottom, width).tobytes())
+    return digest.hexdigest()
+
+
+def uses_alpha(pixels):
+    """Returns True if any pixel in the RGBA array isn't fully opaque."""
+    return not numpy.all(pixels[..., 3] == 255)
+
+
+def squared_delta(ref_pixels, run_pixels):
+    """Returns the squared difference of each channel of each pixel."""
+    delta = ref_pixels.astype(numpy.int32) - run_pixels.astype(numpy.int32)
+    return delta * delta
+
+
+def apply_ignore_regions(squared, top, region_list):
+    """Zeroes the squared differences inside regions that are ignored.
+
+    Args:
+        squared: Squared differences for a strip of rows.
+        top: First row of the strip in the image.
+        region_list: List of (left, top, width, height) tuples in image
+            coordinates.
+    """
+    bottom = top + squared.shape[0]
+    for left, region_top, width, height in region_list:
+        start = max(top, region_top)
+        end = min(bottom, region_top + height)
+        if start < end and width > 0:
+            squared[start - top:end - top, max(0, left):left + width] = 0
+
+
+def channel_sums(squared):
+    """Returns the sum of squared differences for each RGBA channel."""
+    # Sum over rows first so each partial sum fits comfortably in int64.
+    return squared.sum(axis=0, dtype=numpy.int64).sum(axis=0).tolist()
+
+
+def normalize(sums, pixel_count, channels):
+    """Returns the normalized RMSE for each channel and for all of them.
+
+    Args:
+        sums: Sums of squared differences for each RGBA channel.
+        pixel_count: Number of pixels the sums are over.
+        channels: Number of channels to compare, 3 or 4.
+
+    Returns:
+        Tuple (channel_list, total) where channel_list is a list of
+        normalized RMSE values for each channel and total is the normalized
+        RMSE across all of the channels. Values range from 0 to 1.
+    """
+    if not pixel_count:
+        return [0.0] * channels, 0.0
+    scale = 255.0 * 255.0 * pixel_count
+    channel_list = [
+        numpy.sqrt(total / scale) for total in sums[:channels]]
+    total = numpy.sqrt(sum(sums[:channels]) / (scale * channels))
+    return channel_list, float(total)
+
+
+def highlight(squared):
+    """Returns palette indexes marking pixels that differ with a 1."""
+    return numpy.any(squared, axis=2).astype(numpy.uint8)
+
+
+class RegionGrid(object):
+    """Accumulates changed pixels into cells for finding changed regions.
+
+    Memory is proportional to the number of cells, which is 1/64th of the
+    number of pixels with the default cell size.
+    """
+
+    def __init__(self, width, height, cell_size=REGION_CELL_SIZE):
+        self.width = width
+        self.height = height
+        self.cell_size = cell_size
+        self.grid_width = -(-width // cell_size)
+        self.grid_height = -(-height // cell_size)
+        shape = (self.grid_height, self.grid_width)
+        self.pixels = numpy.zeros(shape, dtype=numpy.int32)
+        self.squared = numpy.zeros(shape, dtype=numpy.float64)
+
+    def add(self, top, squared):
+        """Adds the changes in a strip of rows.
+
+        Args:
+            top: First row of the strip in the image.
+            squared: Squared differences for the strip from squared_delta.
+        """
+        bottom = top + squared.shape[0]
+        first_row = top // self.cell_size
+        last_row = (bottom - 1) // self.cell_size
+
+        # Index every pixel by its cell relative to the first row of cells,
+        # then total up each cell in one pass.
+        rows = numpy.arange(top, bottom) // self.cell_size - first_row
+        columns = numpy.arange(self.width) // self.cell_size
+        index = (rows[:, None] * self.grid_width + columns[None, :]).ravel()
+        size = (last_row - first_row + 1) * self.grid_width
+        shape = (last_row - first_row + 1, self.grid_width)
+
+        pixel_squared = squared.sum(axis=2)
+        self.pixels[first_row:last_row + 1] += numpy.bincount(
+            index, weights=(pixel_squared > 0).ravel(),
+            minlength=size).astype(numpy.int32).reshape(shape)
+        self.squared[first_row:last_row + 1] += numpy.bincount(
+            index, weights=pixel_squared.ravel(),
+            minlength=size).reshape(shape)
+
+    def _find_runs(self):
+        """Returns (row, start, end) for each run of changed cells in a row."""
+        changed = (self.pixels > 0).astype(numpy.int8)
+        padded = numpy.zeros(
+            (self.grid_height, self.grid_width + 2), dtype=numpy.int8)
+        padded[:, 1:-1] = changed
+        edges = numpy.diff(padded, axis=1)
+        start_rows, start_columns = numpy.nonzero(edges == 1)
+        _, end_columns = numpy.nonzero(edges == -1)
+        return zip(start_rows.tolist(), start_columns.tolist(),
+                   end_columns.tolist())
+
+    def find_regions(self, channels):
+        """Finds connected regions of changed cells.
+
+        Cells that touch, including diagonally, are in the same region.
+
+        Args:
+            channels: Number of channels that were compared, 3 or 4.
+
+        Returns:
+            List of dictionaries with the keys left, top, width and height
+            of the region's bounding box in pixels; pixels, the number of
+            changed pixels; and intensity, the normalized RMSE of the
+            changed pixels from 0 to 1. Largest regions first.
+        """
+        runs = self._find_runs()
+
+        # Union-find over runs of cells; runs in consecutive rows are
+        # connected when they overlap or touch at a corner.
+        parent = range(len(runs))
+
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        previous_start = 0
+        previous_end = 0
+        for i, (row, start, end) in enumerate(runs):
+            if i and runs[i - 1][0] != row:
+                previous_start, previous_end = previous_end, i
+            j = previous_start
+            while j < previous_end:
+                other_row, other_start, other_end = runs[j]
+                if other_row != row - 1:
+                    break
+                if other_start <= end and other_end >= start:
+                    parent[find(j)] = find(i)
+                j += 1
+
+        totals = {}
+        for i, (row, start, end) in enumerate(runs):
+            pixels = int(self.pixels[row, start:end].sum())
+            squared = float(self.squared[row, start:end].sum())
+            root = find(i)
+            if root not in totals:
+                totals[root] = [start, row, end, row + 1, pixels, squared]
+            else:
+                region = totals[root]
+                region[0] = min(region[0], start)
+                region[1] = min(region[1], row)
+                region[2] = max(region[2], end)
+                region[3] = max(region[3], row + 1)
+                region[4] += pixels
+                region[5] += squared
+
+        region_list = []
+        for left, top, right, bottom, pixels, squared in totals.itervalues():
+            left *= self.cell_size
+            top *= self.cell_size
+            right = min(right * self.cell_size, self.width)
+            bottom = min(bottom * self.cell_size, self.height)
+            region_list.append(dict(
+                left=left,
+                top=top,
+                width=right - left,
+                height=bottom - top,
+                pixels=pixels,
+                intensity=math.sqrt(
+                    squared / (255.0 * 255.0 * pixels * channels))))
+
+        region_list.sort(key=lambda r: (-r['pixels'], r['top'], r['left']))
+        return region_list
+
+
+def write_regions(regions_path, grid, channels, total, stopped_row=None):
+    """Writes a JSON summary of the changed regions of a diff.
+
+    Args:
+        regions_path: Where to write the JSON.
+        grid: RegionGrid with all of the changes.
+        channels: Number of channels that were compared, 3 or 4.
+        total: Normalized distortion of the whole image.
+        stopped_row: Row where the comparison stopped early, if it did.
+    """
+    region_list = grid.find_regions(channels)
+    data = dict(
+        width=grid.width,
+        height=grid.height,
+        cell_size=grid.cell_size,
+        distortion=total,
+        changed_pixels=int(grid.pixels.sum()),
+        region_count=len(region_list),
+        regions=region_list[:MAX_REGIONS])
+    if stopped_row is not None:
+        data['stopped_row'] = stopped_row
+
+    with open(regions_path, 'w') as regions_file:
+        json.dump(data, regions_file, sort_keys=True, separators=(',', ':'))
+
+
+class HighlightWriter(object):
+    """Writes a highlight image to a PNG file one strip of rows at a time.
+
+    The image has a palette of LOWLIGHT_COLOR and HIGHLIGHT_COLOR at one
+    bit per pixel. Rows are compressed as they are written, so memory use
+    doesn't grow with the height of the image.
+
+    Args:
+        path: Where to write the PNG.
+        width, height: Size of the image.
+    """
+
+    SIGNATURE = '\x89PNG\r\n\x1a\n'
+
+    def __init__(self, path, width, height):
+        self.width = width
+        self.height = height
+        self.rows = 0
+        self.compressor = zlib.compressobj()
+        self.output = open(path, 'wb')
+        self.output.write(self.SIGNATURE)
+        # Bit depth 1, color type 3 (palette), no interlacing.
+        self._write_chunk(
+            'IHDR', struct.pack('>IIBBBBB', width, height, 1, 3, 0, 0, 0))
+        self._write_chunk(
+            'PLTE', bytes(bytearray(LOWLIGHT_COLOR[:3] + HIGHLIGHT_COLOR[:3])))
+        self._write_chunk(
+            'tRNS', bytes(bytearray([LOWLIGHT_COLOR[3], HIGHLIGHT_COLOR[3]])))
+
+    def _write_chunk(self, kind, data):
+        self.output.write(struct.pack('>I', len(data)))
+        self.output.write(kind)
+        self.output.write(data)
+        self.output.write(
+            struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff))
+
+    def _write_rows(self, packed):
+        # Each row starts with filter type zero, meaning no filtering.
+        rows = numpy.zeros(
+            (packed.shape[0], packed.shape[1] + 1), dtype=numpy.uint8)
+        rows[:, 1:] = packed
+        data = self.compressor.compress(rows.tobytes())
+        if data:
+            self._write_chunk('IDAT', data)
+        self.rows += packed.shape[0]
+
+    def write(self, mask):
+        """Appends rows from an array of shape (rows, width).
+
+        Non-zero values are highlighted, as returned by highlight().
+        """
+        self._write_rows(numpy.packbits(mask != 0, axis=1))
+
+    def write_blank(self, count, tile_height=TILE_HEIGHT):
+        """Appends count rows with nothing highlighted."""
+        row_bytes = -(-self.width // 8)
+        while count > 0:
+            rows = min(count, tile_height)
+            self._write_rows(numpy.zeros((rows, row_bytes), dtype=numpy.uint8))
+            count -= rows
+
+    def close(self):
+        """Fills in any rows that weren't written and closes the file."""
+        self.write_blank(self.height - self.rows)
+        self._write_chunk('IDAT', self.compressor.flush())
+        self._write_chunk('IEND', '')
+        self.output.close()
+
+
+def format_log(ref_path, run_path, channel_list, total,
+               tile_list=(), stopped_row=None, ignored_regions=0):
+    """Formats the result like the output of "compare -verbose".
+
+    The "all:" line has the same format, so pdiff_worker.DIFF_REGEX can
+    parse logs from either engine.
+
+    Args:
+        ref_path, run_path: Paths of the images that were compared.
+        channel_list, total: Normalized distortion for each channel and for
+            all of them.
+        tile_list: List of (top, bottom, distortion) tuples for each strip
+            of rows that was compared.
+        stopped_row: Row where the comparison stopped early, if it did.
+        ignored_regions: Number of regions that were ignored.
+    """
+    def format_value(value):
+        return '%g (%g)' % (value * QUANTUM_RANGE, value)
+
+    lines = ['%s %s' % (ref_path, run_path)]
+    if ignored_regions:
+        lines.append('  Ignored regions: %d' % ignored_regions)
+    if tile_list:
+        lines.append('  Tile distortion: RMSE')
+        for top, bottom, value in tile_list:
+            lines.append('    rows %d-%d: %s' % (
+                top, bottom - 1, format_value(value)))
+    if stopped_row is not None:
+        lines.append('  Stopped early at row %d, distortion is at least:' %
+                     stopped_row)
+    lines.append('  Channel distortion: RMSE')
+    for name, value in zip(CHANNEL_NAMES, channel_list):
+        lines.append('    %s: %s' % (name, format_value(value)))
+    lines.append('    all: %s' % format_value(total))
+    return '\n'.join(lines) + '\n'
+
+
+def diff_open_images(ref_image, run_image, ref_path, run_path,
+                     diff_path, log_path, regions_path=None,
+                     tile_height=TILE_HEIGHT, max_distortion=None,
+                     ignore_regions=(), hash_pixels=False):
+    """Compares two decoded screenshots and writes a highlight image and log.
+
+    Args:
+        ref_image: PIL image of the reference screenshot.
+        run_image: PIL image of the new screenshot. The reference is fit to
+            the size of this image before comparing.
+        ref_path, run_path: Paths to the screenshots, for the log.
+        diff_path: Where to write the highlight image as a PNG. Only written
+            when the images are different.
+        log_path: Where to write the distortion log.
+        regions_path: Where to write a JSON summary of the changed regions,
+            if any. Only written when the images are different.
+        tile_height: Number of rows to compare at a time.
+        max_distortion: When set, stop comparing once the distortion is
+            known to be above this value. The returned distortion is then a
+            lower bound and the highlight image only covers the rows that
+            were compared.
+        ignore_regions: List of (left, top, width, height) tuples of areas
+            that never count as different, such as ads or carousels.
+        hash_pixels: When True, also compute the pixel_hash of each image
+            from the strips converted for the comparison, instead of making
+            another pass over the images.
+
+    Returns:
+        The normalized RMSE distortion between the images, from 0 to 1.
+        When hash_pixels is True, a tuple (distortion, ref_pixel_hash,
+        run_pixel_hash) instead. The hashes are None when the comparison
+        stopped early.
+    """
+    width, height = run_image.size
+    pixel_count = width * height
+    sums = [0, 0, 0, 0]
+    alpha = False
+    tile_sums = []
+    stopped_row = None
+    writer = None
+    grid = None
+
+    ref_digest = None
+    run_digest = None
+    if hash_pixels:
+        run_digest = new_pixel_digest(width, height)
+        # The strips of a reference of another size are padded or cropped,
+        # so its hash needs a pass of its own. It can't match anyway.
+        if ref_image.size == run_image.size:
+            ref_digest = new_pixel_digest(width, height)
+
+    for top, bottom in iter_tiles(height, tile_height):
+        ref_pixels = get_strip(ref_image, top, bottom, width)
+        run_pixels = get_strip(run_image, top, bottom, width)
+        alpha = alpha or uses_alpha(ref_pixels) or uses_alpha(run_pixels)
+        if ref_digest:
+            ref_digest.update(ref_pixels.tobytes())
+        if run_digest:
+            run_digest.update(run_pixels.tobytes())
+
+        squared = squared_delta(ref_pixels, run_pixels)
+        apply_ignore_regions(squared, top, ignore_regions)
+        tile = channel_sums(squared)
+        tile_sums.append((top, bottom, tile))
+        sums = [a + b for a, b in zip(sums, tile)]
+
+        if any(tile):
+            if writer is None:
+                writer = HighlightWriter(diff_path, width, height)
+                writer.write_blank(top, tile_height)
+                grid = RegionGrid(width, height)
+            writer.write(highlight(squared))
+            grid.add(top, squared)
+        elif writer is not None:
+            writer.write_blank(bottom - top, tile_height)
+
+        # The alpha sum is zero until alpha is used, so this is a lower
+        # bound on the distortion whether or not alpha is compared.
+        if (max_distortion is not None and bottom < height and
+                normalize(sums, pixel_count, 4)[1] > max_distortion):
+            stopped_row = bottom
+            break
+
+    channels = 4 if alpha else 3
+    channel_list, total = normalize(sums, pixel_count, channels)
+    tile_list = [
+        (top, bottom,
+         normalize(tile, (bottom - top) * width, channels)[1])
+        for top, bottom, tile in tile_sums]
+
+    with open(log_path, 'w') as log_file:
+        log_file.write(format_log(
+            ref_path, run_path, channel_list, total,
+            tile_list=tile_list, stopped_row=stopped_row,
+            ignored_regions=len(ignore_regions)))
+
+    if writer is not None:
+        writer.close()
+        if regions_path:
+            write_regions(regions_path, grid, channels, total,
+                          stopped_row=stopped_row)
+
+    if not hash_pixels:
+        return total
+    if stopped_row is not None:
+        return total, None, None
+    if ref_digest:
+        ref_pixel_hash = ref_digest.hexdigest()
+    else:
+        ref_pixel_hash = pixel_hash(ref_image, tile_height)
+    return total, ref_pixel_hash, run_digest.hexdigest()
+
+
+def diff_images(ref_path, run_path, diff_path, log_path, **kwargs):
+    """Compares two screenshot files and writes a highlight image and a log.
+
+    Args:
+        ref_path: Path to the reference screenshot.
+        run_path: Path to the new screenshot.
+        diff_path: Where to write the highlight image, if any.
+        log_path: Where to write the distortion log.
+        **kwargs: Passed to diff_open_images.
+
+    Returns:
+        The normalized RMSE distortion between the images, from 0 to 1.
+    """
+    check_available()
+    return diff_open_images(
+        open_image(ref_path), open_image(run_path), ref_path, run_path,
+        diff_path, log_path, **kwargs)
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# Copyright 2013 Brett Slatkin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Regions of a screenshot to ignore when computing perceptual diffs.
+
+A capture config may have an "ignoreRegions" list. Each entry is either a
+rectangle in page coordinates:
+
+    {"left": 0, "top": 100, "width": 1280, "height": 400}
+
+or a CSS selector whose matching elements are ignored wherever they are
+on the page:
+
+    {"selector": ".carousel, #ad-slot"}
+
+Selectors are resolved by the capture script when the screenshot is
+taken. The capture worker combines the result with the fixed rectangles
+into a mask file that is uploaded with the screenshot, so each mask is
+tied to the config it was captured with. The pdiff worker then ignores
+every region in the masks of both screenshots.
+"""
+
+import json
+import os
+
+
+# Version of the mask file format.
+MASK_VERSION = 1
+
+# The capture script writes rectangles for selectors next to the
+# screenshot in a file with this suffix.
+BROWSER_MASK_SUFFIX = '.mask.json'
+
+
+class Error(Exception):
+    """Base class for exceptions in this module."""
+
+
+class BadRegionError(Error):
+    """An ignore region is not a valid rectangle."""
+
+
+def parse_region(region):
+    """Returns a region as a (left, top, width, height) tuple of ints.
+
+    Raises:
+        BadRegionError if the region is not a valid rectangle.
+    """
+    try:
+        rect = tuple(
+            int(round(float(region[key])))
+            for key in ('left', 'top', 'width', 'height'))
+    except (KeyError, TypeError, ValueError), e:
+        raise BadRegionError('Bad ignore region %r: %s' % (region, e))
+    if rect[2] < 0 or rect[3] < 0:
+        raise BadRegionError('Ignore region %r has a negative size' % region)
+    return rect
+
+
+def get_config_regions(config):
+    """Returns the fixed rectangles to ignore from a capture config."""
+    return [
+        parse_region(region)
+        for region in config.get('ignoreRegions') or []
+        if 'selector' not in region]
+
+
+def read_mask(path):
+    """Returns the list of rectangles in a mask file, or [] if missing."""
+    if not path or not os.path.isfile(path):
+        return []
+    with open(path) as mask_file:
+        data = json.load(mask_file)
+    return [parse_region(region) for region in data.get('regions') or []]
+
+
+def write_mask(path, region_list):
+    """Writes a mask file with the given (left, top, width, height) tuples."""
+    data = dict(
+        version=MASK_VERSION,
+        regions=[
+            dict(left=left, top=top, width=width, height=height)
+            for left, top, width, height in region_list])
+    with open(path, 'w') as mask_file:
+        json.dump(data, mask_file, sort_keys=True)
+
+
+def build_mask(config_path, image_path, mask_path):
+    """Writes the mask for a screenshot, if its config ignores any regions.
+
+    Args:
+        config_path: Path to the capture config.
+        image_path: Path to the screenshot. The capture script writes the
+            rectangles of selectors next to it.
+        mask_path: Where to write the combined mask.
+
+    Returns:
+        mask_path if a mask was written, otherwise None.
+    """
+    with open(config_path) as config_file:
+        config = json.load(config_file)
+    if not config.get('ignoreRegions'):
+        return None
+
+    region_list = get_config_regions(config)
+    region_list.extend(read_mask(image_path + BROWSER_MASK_SUFFIX))
+    if not region_list:
+        return None
+
+    write_mask(mask_path, region_list)
+    return mask_path
@@ -17,8 +17,11 @@
 
 import Queue
 import json
+import logging
+import multiprocessing
 import os
 import shutil
+import signal
 import subprocess
 import sys
 import tempfile
@@ -33,9 +36,13 @@ FLAGS = gflags.FLAGS
 
 # Local modules
 from dpxdt import constants
+from dpxdt.client import concurrency
+from dpxdt.client import image_diff
+from dpxdt.client import masks
 from dpxdt.client import process_worker
 from dpxdt.client import queue_worker
 from dpxdt.client import release_worker
+from dpxdt.client import timer_worker
 from dpxdt.client import utils
 from dpxdt.client import workers
 
@@ -62,15 +69,75 @@ gflags.DEFINE_integer(
 
 gflags.DEFINE_integer(
     'pdiff_timeout', 60,
-    'Seconds until we should give up on a pdiff sub-process and try again.')
+    'Seconds until we should give up on a pdiff sub-process, or on a diff '
+    'in a --pdiff_processes worker process, and try again.')
+
+gflags.DEFINE_enum(
+    'pdiff_engine', 'imagemagick', ['imagemagick', 'numpy'],
+    'How to compute perceptual diffs. "imagemagick" runs the compare and '
+    'composite binaries in subprocesses. "numpy" decodes both images once '
+    'and diffs them in-process; it requires the numpy and Pillow packages.')
+
+gflags.DEFINE_integer(
+    'pdiff_tile_height', 512,
+    'With --pdiff_engine=numpy, compare images this many rows at a time '
+    'and write the diff image as each strip is done, so the comparison '
+    'arrays and the diff image don\'t grow with the page height. Both '
+    'decoded screenshots are still held in memory whole.')
+
+gflags.DEFINE_float(
+    'pdiff_max_distortion', None,
+    'With --pdiff_engine=numpy, stop comparing once the distortion is '
+    'known to be above this value, from 0 to 1. The reported distortion '
+    'is then a lower bound and the diff image only covers the rows that '
+    'were compared. Useful for very tall screenshots that changed a lot.')
+
+gflags.DEFINE_integer(
+    'pdiff_processes', 0,
+    'With --pdiff_engine=numpy, decode and diff images in a pool of this '
+    'many long-lived worker processes so diffs aren\'t serialized on the '
+    'interpreter lock. Each process reads the images from the downloaded '
+    'files and only sends back the distortion and pixel hashes. Zero means '
+    'diff in the pdiff threads. Usually set to the number of cores, with '
+    '--pdiff_threads or --pdiff_batch_size high enough to keep every '
+    'process busy.')
+
+gflags.DEFINE_integer(
+    'pdiff_batch_size', 1,
+    'How many pdiff tasks from the same release to lease and process '
+    'together. Images shared by tasks in a batch, like a common reference '
+    'screenshot, are only downloaded once. Batches share the budget of '
+    '--pdiff_threads diffs running at a time.')
 
 DIFF_REGEX = re.compile(".*all:.*\(([0-9e\-\.]*)\).*")
 
+# Number of pdiff tasks skipped by this process because the reference and
+# run images were byte-identical.
+IDENTICAL_DIFFS_SKIPPED = 0
+
+# Pool of processes for --pdiff_processes. Started by start_processes().
+DIFF_POOL = None
+
 
 class PdiffFailedError(queue_worker.GiveUpAfterAttemptsError):
     """Running a perceptual diff failed for some reason."""
 
 
+def passes_threshold(distortion, distortion_threshold):
+    """Returns True if a diff is small enough to count as no difference.
+
+    Args:
+        distortion: Distortion of the diff as a float or string.
+        distortion_threshold: The build's threshold from 0 to 1, if any.
+    """
+    if not distortion_threshold or distortion is None:
+        return False
+    try:
+        return 0 < float(distortion) < distortion_threshold
+    except ValueError:
+        return False
+
+
 class ResizeWorkflow(process_worker.ProcessWorkflow):
     """Workflow for making images to be diffed the same size."""
 
@@ -137,6 +204,93 @@ class PdiffWorkflow(process_worker.ProcessWorkflow):
         ]
 
 
+class ImageDiffItem(workers.WorkItem):
+    """Work item for diffing two images in-process with the numpy engine.
+
+    Args:
+        ref_path: Path to reference screenshot to diff.
+        run_path: Path to the most recent run screenshot to diff.
+        diff_path: Where the diff image should be written, if any.
+        log_path: Where to write the distortion log.
+        regions_path: Where to write the summary of changed regions, if any.
+        ignore_regions: List of (left, top, width, height) tuples of areas
+            to ignore when comparing.
+
+    Attributes:
+        distortion: Normalized RMSE between the images, from 0 to 1.
+        ref_pixel_hash, run_pixel_hash: Hashes of the decoded pixels of
+            each image; see image_diff.pixel_hash.
+    """
+
+    def __init__(self, ref_path, run_path, diff_path, log_path,
+                 regions_path=None, ignore_regions=()):
+        workers.WorkItem.__init__(self)
+        self.ref_path = ref_path
+        self.run_path = run_path
+        self.diff_path = diff_path
+        self.log_path = log_path
+        self.regions_path = regions_path
+        self.ignore_regions = ignore_regions
+        self.distortion = None
+        self.ref_pixel_hash = None
+        self.run_pixel_hash = None
+
+
+def run_image_diff(ref_path, run_path, diff_path, log_path, regions_path,
+                   ignore_regions, tile_height, max_distortion):
+    """Diffs two image files with the numpy engine.
+
+    Only takes and returns small values so it can run in a worker process.
+
+    Returns:
+        Tuple (distortion, ref_pixel_hash, run_pixel_hash).
+    """
+    return image_diff.diff_open_images(
+        image_diff.open_image(ref_path), image_diff.open_image(run_path),
+        ref_path, run_path, diff_path, log_path,
+        regions_path=regions_path,
+        ignore_regions=ignore_regions,
+        tile_height=tile_height,
+        max_distortion=max_distortion,
+        hash_pixels=True)
+
+
+def _init_diff_process():
+    """Initializes a diff process to leave interrupts to the parent."""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+class ImageDiffThread(workers.WorkerThread):
+    """Worker thread that runs ImageDiffItems.
+
+    Args:
+        pool: Optional multiprocessing.Pool to run the diffs in. The thread
+            waits for the result without holding the interpreter lock, for
+            up to --pdiff_timeout seconds.
+    """
+
+    def __init__(self, input_queue, output_queue, pool=None):
+        workers.WorkerThread.__init__(self, input_queue, output_queue)
+        self.pool = pool
+
+    def handle_item(self, item):
+        args = (item.ref_path, item.run_path, item.diff_path, item.log_path,
+                item.regions_path, list(item.ignore_regions),
+                FLAGS.pdiff_tile_height, FLAGS.pdiff_max_distortion)
+        if self.pool:
+            try:
+                result = self.pool.apply_async(run_image_diff, args).get(
+                    FLAGS.pdiff_timeout)
+            except multiprocessing.TimeoutError:
+                raise PdiffFailedError(
+                    FLAGS.pdiff_task_max_attempts,
+                    'Diff took longer than %d seconds' % FLAGS.pdiff_timeout)
+        else:
+            result = run_image_diff(*args)
+        item.distortion, item.ref_pixel_hash, item.run_pixel_hash = result
+        return item
+
+
 class DoPdiffQueueWorkflow(workers.WorkflowItem):
     """Runs the perceptual diff from queue parameters.
 
@@ -147,7 +301,16 @@ class DoPdiffQueueWorkflow(workers.WorkflowItem):
         run_name: Run to run perceptual diff for.
         reference_sha1sum: Content hash of the previously good image.
         run_sha1sum: Content hash of the new image.
+        mask_sha1sum: Content hash of the regions to ignore in the new
+            image, if any; see the masks module.
+        reference_mask_sha1sum: Content hash of the regions to ignore in the
+            previously good image, if any.
+        distortion_threshold: Diffs with less distortion than this count
+            as the same, so their diff images aren't uploaded.
         heartbeat: Function to call with progress status.
+        downloads: Optional dictionary mapping content hashes to paths of
+            artifacts that were already downloaded, which are used instead
+            of downloading them again. The files are not modified.
 
     Raises:
         PdiffFailedError if the perceptual diff process failed.
@@ -155,25 +318,106 @@ class DoPdiffQueueWorkflow(workers.WorkflowItem):
 
     def run(self, build_id=None, release_name=None, release_number=None,
             run_name=None, reference_sha1sum=None, run_sha1sum=None,
-            heartbeat=None):
+            mask_sha1sum=None, reference_mask_sha1sum=None,
+            distortion_threshold=None, heartbeat=None, downloads=None):
+        if reference_sha1sum == run_sha1sum:
+            # The same content hash means identical bytes, so there's no
+            # need to download anything. The server marks the run as having
+            # no diff when it sees the run and reference images match.
+            global IDENTICAL_DIFFS_SKIPPED
+            IDENTICAL_DIFFS_SKIPPED += 1
+            logging.info('Skipping pdiff of identical images %r, '
+                         '%d skipped so far', run_sha1sum,
+                         IDENTICAL_DIFFS_SKIPPED)
+
+            yield heartbeat('Reporting identical images to server')
+            yield release_worker.ReportPdiffWorkflow(
+                build_id, release_name, release_number, run_name)
+            return
+
         output_path = tempfile.mkdtemp()
         try:
-            ref_path = os.path.join(output_path, 'ref')
+            downloads = downloads or {}
+            ref_path = downloads.get(reference_sha1sum)
+            run_path = downloads.get(run_sha1sum)
             ref_resized_path = os.path.join(output_path, 'ref_resized')
-            run_path = os.path.join(output_path, 'run')
             diff_path = os.path.join(output_path, 'diff.png')
             log_path = os.path.join(output_path, 'log.txt')
-
-            yield heartbeat('Fetching reference and run images')
-            yield [
-                release_worker.DownloadArtifactWorkflow(
-                    build_id, reference_sha1sum, result_path=ref_path),
-                release_worker.DownloadArtifactWorkflow(
-                    build_id, run_sha1sum, result_path=run_path)
-            ]
+            regions_path = os.path.join(output_path, 'regions.json')
+
+            fetch_list = []
+            if not ref_path:
+                ref_path = os.path.join(output_path, 'ref')
+                fetch_list.append(release_worker.DownloadArtifactWorkflow(
+                    build_id, reference_sha1sum, result_path=ref_path))
+            if not run_path:
+                run_path = os.path.join(output_path, 'run')
+                fetch_list.append(release_worker.DownloadArtifactWorkflow(
+                    build_id, run_sha1sum, result_path=run_path))
+            if fetch_list:
+                yield heartbeat('Fetching reference and run images')
+                yield fetch_list
+
+            # Ignore the regions masked in either screenshot.
+            ignore_regions = []
+            for i, sha1sum in enumerate(
+                    (reference_mask_sha1sum, mask_sha1sum)):
+                if not sha1sum:
+                    continue
+                mask_path = downloads.get(sha1sum)
+                if not mask_path:
+                    mask_path = os.path.join(output_path, 'mask%d.json' % i)
+                    yield release_worker.DownloadArtifactWorkflow(
+                        build_id, sha1sum, result_path=mask_path)
+                ignore_regions.extend(masks.read_mask(mask_path))
 
             max_attempts = FLAGS.pdiff_task_max_attempts
 
+            if FLAGS.pdiff_engine == 'numpy':
+                yield heartbeat('Running perceptual diff in-process')
+                try:
+                    item = yield ImageDiffItem(
+                        ref_path, run_path, diff_path, log_path,
+                        regions_path=regions_path,
+                        ignore_regions=ignore_regions)
+                except Exception, e:
+                    # Undecodable images and the like fail the same way
+                    # on every attempt, so report them like a failed
+                    # compare process instead of retrying forever.
+                    logging.exception('Could not diff run_name=%r', run_name)
+                    message = '%s: %s' % (e.__class__.__name__, e)
+                    with open(log_path, 'a') as log_file:
+                        log_file.write(message + '\n')
+
+                    yield heartbeat('Reporting diff result to server')
+                    yield release_worker.ReportPdiffWorkflow(
+                        build_id, release_name, release_number, run_name,
+                        None, log_path, True)
+                    raise PdiffFailedError(
+                        max_attempts, 'Comparison failed. %s' % message)
+
+                distortion = None
+                if item.distortion > 0:
+                    distortion = '%g' % item.distortion
+                if (not distortion or
+                        passes_threshold(distortion, distortion_threshold)):
+                    diff_path = None
+                    regions_path = None
+
+                yield heartbeat('Reporting diff result to server')
+                yield release_worker.ReportPdiffWorkflow(
+                    build_id, release_name, release_number, run_name,
+                    diff_path, log_path, False, distortion,
+                    ref_pixel_hash=item.ref_pixel_hash,
+                    run_pixel_hash=item.run_pixel_hash,
+                    regions_path=regions_path)
+                return
+
+            if ignore_regions:
+                logging.warning('Ignore regions are only supported by '
+                                '--pdiff_engine=numpy; diffing all of '
+                                'run_name=%r', run_name)
+
             yield heartbeat('Resizing reference image')
             returncode = yield ResizeWorkflow(
                 log_path, ref_path, run_path, ref_resized_path)
@@ -210,6 +454,9 @@ class DoPdiffQueueWorkflow(workers.WorkflowItem):
                         diff_failed = False
                         distortion = r[0]
 
+            if passes_threshold(distortion, distortion_threshold):
+                diff_path = None
+
             yield heartbeat('Reporting diff result to server')
             yield release_worker.ReportPdiffWorkflow(
                 build_id, release_name, release_number, run_name,
@@ -223,18 +470,152 @@ class DoPdiffQueueWorkflow(workers.WorkflowItem):
             shutil.rmtree(output_path, True)
 
 
+class DoPdiffBatchWorkflow(workers.WorkflowItem):
+    """Runs perceptual diffs for many tasks from the same release.
+
+    Every distinct image and mask needed by the batch is downloaded once
+    and shared by the tasks that use it. Then the diffs run, at most
+    --pdiff_threads at a time, each reporting its own result to the server.
+    Tasks waiting for a diff thread are heartbeated every
+    --queue_update_flush_seconds so their leases don't expire.
+
+    Args:
+        payload_list: List of dictionaries of DoPdiffQueueWorkflow
+            parameters, each with its own heartbeat function.
+
+    Returns:
+        List with the exception raised by each task, or None if the task
+        succeeded, in the same order as payload_list.
+    """
+
+    def run(self, payload_list):
+        output_path = tempfile.mkdtemp()
+        try:
+            downloads = {}
+            fetch_sha1sums = []
+            fetch_list = []
+            for payload in payload_list:
+                if payload['reference_sha1sum'] == payload['run_sha1sum']:
+                    continue
+                for key in ('reference_sha1sum', 'run_sha1sum',
+                            'mask_sha1sum', 'reference_mask_sha1sum'):
+                    sha1sum = payload.get(key)
+                    if not sha1sum or sha1sum in downloads:
+                        continue
+                    path = os.path.join(output_path, sha1sum)
+                    downloads[sha1sum] = path
+                    fetch_sha1sums.append(sha1sum)
+                    fetch_list.append(queue_worker.CatchErrorWorkflow(
+                        release_worker.DownloadArtifactWorkflow(
+                            payload['build_id'], sha1sum, result_path=path)))
+
+            if fetch_list:
+                message = 'Fetching %d images for %d tasks' % (
+                    len(fetch_list), len(payload_list))
+                yield [payload['heartbeat'](message)
+                       for payload in payload_list]
+
+                # Tasks whose downloads failed fetch the images themselves
+                # so the error is reported for each of them.
+                fetch_errors = yield fetch_list
+                for sha1sum, error in zip(fetch_sha1sums, fetch_errors):
+                    if error is not None:
+                        del downloads[sha1sum]
+
+            workflow_list = [
+                queue_worker.CatchErrorWorkflow(
+                    DoPdiffQueueWorkflow(downloads=downloads, **payload))
+                for payload in payload_list]
+            waiting = zip(payload_list, workflow_list)
+            running = []
+            timer = None
+            while waiting or running:
+                while waiting and len(running) < FLAGS.pdiff_threads:
+                    _, workflow = waiting.pop(0)
+                    running.append(workflow)
+
+                if not waiting:
+                    yield workers.WaitAny(running)
+                else:
+                    if timer is None or timer.done:
+                        # A task whose lease was lost fails on its own first
+                        # heartbeat once it runs.
+                        yield [queue_worker.CatchErrorWorkflow(
+                                   payload['heartbeat'](
+                                       'Waiting for a free diff thread'))
+                               for payload, _ in waiting]
+                        timer = timer_worker.TimerItem(
+                            FLAGS.queue_update_flush_seconds)
+                    yield workers.WaitAny(running + [timer])
+
+                running = [x for x in running if not x.done]
+
+            raise workers.Return([x.result for x in workflow_list])
+        finally:
+            shutil.rmtree(output_path, True)
+
+
+def start_processes():
+    """Starts the pool of diff processes for --pdiff_processes, if any.
+
+    The processes are forked from this one, so this should be called
+    before anything starts a thread; run_server does so before it
+    registers any workers. Otherwise register() starts them.
+    """
+    global DIFF_POOL
+    if (FLAGS.pdiff_engine == 'numpy' and FLAGS.pdiff_processes > 0 and
+            DIFF_POOL is None):
+        DIFF_POOL = multiprocessing.Pool(
+            FLAGS.pdiff_processes, initializer=_init_diff_process)
+
+
 def register(coordinator):
     """Registers this module as a worker with the given coordinator."""
-    utils.verify_binary('pdiff_compare_binary', ['-version'])
-    utils.verify_binary('pdiff_composite_binary', ['-version'])
-
     assert FLAGS.pdiff_threads > 0
+
+    if FLAGS.pdiff_engine == 'numpy':
+        image_diff.check_available()
+        assert FLAGS.pdiff_tile_height > 0
+        assert FLAGS.pdiff_processes >= 0
+
+        start_processes()
+        pool = DIFF_POOL
+
+        # Each diff in flight ties up a thread waiting on the pool, so have
+        # enough threads to keep every process busy.
+        diff_queue = Queue.Queue()
+        coordinator.register(ImageDiffItem, diff_queue)
+        for i in xrange(max(FLAGS.pdiff_threads, FLAGS.pdiff_processes)):
+            coordinator.worker_threads.append(
+                ImageDiffThread(diff_queue, coordinator.input_queue,
+                                pool=pool))
+    else:
+        utils.verify_binary('pdiff_compare_binary', ['-version'])
+        utils.verify_binary('pdiff_composite_binary', ['-version'])
+
     assert FLAGS.queue_server_prefix
 
+    assert FLAGS.pdiff_batch_size > 0
+    max_tasks = FLAGS.pdiff_threads
+    local_batch_workflow = None
+    if FLAGS.pdiff_batch_size > 1:
+        local_batch_workflow = DoPdiffBatchWorkflow
+        # Each batch runs up to --pdiff_threads diffs at once, so fewer
+        # batches keep the total within the same budget.
+        max_tasks = max(1, FLAGS.pdiff_threads // FLAGS.pdiff_batch_size)
+
+    controller = None
+    if FLAGS.adaptive_concurrency:
+        controller = concurrency.ConcurrencyController(
+            constants.PDIFF_QUEUE_NAME, max_tasks)
+
     item = queue_worker.RemoteQueueWorkflow(
         constants.PDIFF_QUEUE_NAME,
         DoPdiffQueueWorkflow,
-        max_tasks=FLAGS.pdiff_threads,
-        wait_seconds=FLAGS.pdiff_wait_seconds)
+        max_tasks=max_tasks,
+        controller=controller,
+        wait_seconds=FLAGS.pdiff_wait_seconds,
+        local_batch_workflow=local_batch_workflow,
+        batch_size=FLAGS.pdiff_batch_size)
     item.root = True
     coordinator.input_queue.put(item)
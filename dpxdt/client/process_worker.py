@@ -16,22 +16,56 @@
 """Workers for driving screen captures, perceptual diffs, and related work."""
 
 import Queue
+import errno
+import heapq
 import logging
+import os
+import select
+import signal
 import subprocess
-import time
 import sys
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
 
 # Local Libraries
 import gflags
 FLAGS = gflags.FLAGS
 
 # Local modules
-from dpxdt.client import timer_worker
 from dpxdt.client import workers
 
 
+gflags.DEFINE_integer(
+    'process_memory_limit_mb', 0,
+    'Largest address space, in megabytes, that each subprocess may use. '
+    'Allocations past the limit fail, which usually makes the process '
+    'crash. Zero means no limit.')
+
+gflags.DEFINE_integer(
+    'process_cpu_limit_seconds', 0,
+    'Most CPU time, in seconds, that each subprocess may use before it '
+    'is killed. Zero means no limit.')
+
+
 LOGGER = workers.LOGGER
 
+# How often to check for exited subprocesses when SIGCHLD can't be used to
+# find out right away.
+REAP_POLL_SECONDS = 0.05
+
+# Reaps every subprocess started by ProcessWorkflows. Created by register().
+REAPER = None
+
 
 class Error(Exception):
     """Base class for exceptions in this module."""
@@ -40,12 +74,295 @@ class TimeoutError(Exception):
     """Subprocess has taken too long to complete and was terminated."""
 
 
+def limit_resources(memory_limit_mb=None, cpu_limit_seconds=None):
+    """Returns a preexec_fn that sets up a subprocess before it runs.
+
+    The subprocess is put in a new session, so it leads its own process
+    group and kill_process_group can reach anything it starts. The given
+    limits apply to the subprocess and are inherited by its children.
+
+    Args:
+        memory_limit_mb: Optional limit on the address space in megabytes.
+        cpu_limit_seconds: Optional limit on CPU time in seconds.
+
+    Returns:
+        A function for the preexec_fn argument of subprocess.Popen.
+    """
+    def preexec_fn():
+        os.setsid()
+        if resource is None:
+            return
+        if memory_limit_mb:
+            limit = memory_limit_mb * 1024 * 1024
+            resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+        if cpu_limit_seconds:
+            # Soft limit sends SIGXCPU, hard limit a second later SIGKILL.
+            resource.setrlimit(
+                resource.RLIMIT_CPU,
+                (cpu_limit_seconds, cpu_limit_seconds + 1))
+
+    return preexec_fn
+
+
+def kill_process_group(process):
+    """Kills a subprocess started with limit_resources and all its children.
+
+    The subprocess must not have been waited for yet, otherwise its process
+    group ID may have been reused.
+    """
+    if sys.platform == 'win32':
+        process.kill()
+        return
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except OSError:
+        # The group is already gone.
+        pass
+
+
+def wait_for_usage(process, block=True):
+    """Waits for a subprocess to exit and returns its resource usage.
+
+    Args:
+        process: subprocess.Popen instance to wait for.
+        block: When False, return None right away if the subprocess is
+            still running.
+
+    Returns:
+        Tuple (returncode, usage) where usage is the resource.struct_rusage
+        of the subprocess and its waited-for children, or None if it is not
+        available on this platform. None if block is False and the
+        subprocess hasn't exited.
+    """
+    if not hasattr(os, 'wait4'):
+        if block:
+            return process.wait(), None
+        returncode = process.poll()
+        if returncode is None:
+            return None
+        return returncode, None
+
+    options = 0
+    if not block:
+        options = os.WNOHANG
+
+    while True:
+        try:
+            pid, status, usage = os.wait4(process.pid, options)
+        except OSError, e:
+            if e.errno == errno.EINTR:
+                continue
+            if e.errno == errno.ECHILD:
+                # Someone else already reaped it.
+                return process.wait(), None
+            raise
+        if not pid:
+            return None
+        # NOTE: Use the undocumented method so the Popen object knows its
+        # returncode without waiting for the process again.
+        process._handle_exitstatus(status)
+        return process.returncode, usage
+
+
+def format_usage(usage):
+    """Returns a one line summary of a resource.struct_rusage."""
+    # ru_maxrss is in kilobytes on Linux and bytes on Mac OS X.
+    peak_rss = usage.ru_maxrss * 1024
+    if sys.platform == 'darwin':
+        peak_rss = usage.ru_maxrss
+    return ('peak_rss_mb=%.1f, user_cpu_seconds=%.2f, '
+            'system_cpu_seconds=%.2f' % (
+                peak_rss / (1024.0 * 1024.0), usage.ru_utime, usage.ru_stime))
+
+
+class ProcessItem(workers.WorkItem):
+    """Work item for waiting until a subprocess exits.
+
+    Args:
+        process: subprocess.Popen instance to wait for.
+        timeout_seconds: How long before the process should be force killed.
+
+    Attributes:
+        returncode: Return code of the subprocess once it has exited.
+        usage: resource.struct_rusage of the subprocess once it has exited,
+            or None if it isn't available.
+        timed_out: True if the subprocess was killed for running too long.
+    """
+
+    def __init__(self, process, timeout_seconds):
+        workers.WorkItem.__init__(self)
+        self.process = process
+        self.deadline = time.time() + timeout_seconds
+        self.returncode = None
+        self.usage = None
+        self.timed_out = False
+
+
+def _ignore_signal(signum, frame):
+    """Signal handler that lets the wakeup fd do the work."""
+
+
+class Reaper(object):
+    """Reaps subprocesses as they exit and kills those past their deadline.
+
+    A single thread waits for SIGCHLD, through signal.set_wakeup_fd, or for
+    a new subprocess to track. Each time it wakes it reaps every tracked
+    subprocess that exited, then kills the process group of any that are
+    still running past their deadline, which are kept in one heap. Since
+    the same thread kills and reaps, a process group is never killed after
+    its subprocess was reaped, when its ID may already belong to another
+    process.
+
+    SIGCHLD can only be watched when the Reaper is created on the main
+    thread. Otherwise, and on platforms without SIGCHLD, it checks for
+    exited subprocesses every REAP_POLL_SECONDS instead.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.children = []
+        self.deadlines = []
+        self.thread = None
+        self.read_fd = None
+        self.write_fd = None
+        self.poll_seconds = REAP_POLL_SECONDS
+
+        if sys.platform == 'win32':
+            return
+
+        self.read_fd, self.write_fd = os.pipe()
+        for fd in (self.read_fd, self.write_fd):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+        if signal.getsignal(signal.SIGCHLD) != signal.SIG_DFL:
+            # Someone else is handling SIGCHLD; leave it to them.
+            return
+        try:
+            old_fd = signal.set_wakeup_fd(self.write_fd)
+        except ValueError:
+            # Not the main thread.
+            return
+        if old_fd != -1:
+            signal.set_wakeup_fd(old_fd)
+            return
+        signal.signal(signal.SIGCHLD, _ignore_signal)
+        # Restart system calls the signal interrupts instead of failing.
+        signal.siginterrupt(signal.SIGCHLD, False)
+        self.poll_seconds = FLAGS.polltime
+
+    def add(self, item, output_queue):
+        """Tracks a ProcessItem and puts it on output_queue once it exits."""
+        with self.lock:
+            self.children.append((item, output_queue))
+            heapq.heappush(self.deadlines, (item.deadline, item))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run)
+                self.thread.daemon = True
+                self.thread.start()
+        self.wake()
+
+    def wake(self):
+        """Wakes up the reaper thread."""
+        if self.write_fd is None:
+            return
+        try:
+            os.write(self.write_fd, 'x')
+        except OSError, e:
+            # A full pipe already has a wakeup waiting.
+            if e.errno not in (errno.EAGAIN, errno.EINTR):
+                raise
+
+    def wait(self, timeout):
+        """Waits for a wakeup or for timeout seconds to pass."""
+        if self.read_fd is None:
+            time.sleep(timeout)
+            return
+        try:
+            select.select([self.read_fd], [], [], timeout)
+        except select.error, e:
+            if e.args[0] != errno.EINTR:
+                raise
+        try:
+            while os.read(self.read_fd, 4096):
+                pass
+        except OSError, e:
+            if e.errno not in (errno.EAGAIN, errno.EINTR):
+                raise
+
+    def run(self):
+        while True:
+            self.wait(self.reap())
+
+    def reap(self):
+        """Reaps exited subprocesses and kills those past their deadline.
+
+        Returns:
+            Seconds until the reaper should check again.
+        """
+        with self.lock:
+            children = list(self.children)
+
+        running = set()
+        for item, output_queue in children:
+            result = wait_for_usage(item.process, block=False)
+            if result is None:
+                running.add(item)
+                continue
+
+            item.returncode, item.usage = result
+            LOGGER.debug('Subprocess exited pid=%r, returncode=%r',
+                         item.process.pid, item.returncode)
+            with self.lock:
+                self.children.remove((item, output_queue))
+            # Mark the item done before handing it back, otherwise the
+            # coordinator may see it before its worker thread does.
+            item.done = True
+            output_queue.put(item)
+
+        now = time.time()
+        with self.lock:
+            while self.deadlines:
+                deadline, item = self.deadlines[0]
+                if item.returncode is not None:
+                    heapq.heappop(self.deadlines)
+                elif deadline > now:
+                    return min(deadline - now, self.poll_seconds)
+                elif item not in running:
+                    # Added since the sweep above, so it may have exited
+                    # already. Sweep again before killing it.
+                    return 0
+                else:
+                    heapq.heappop(self.deadlines)
+                    item.timed_out = True
+                    LOGGER.info('Killing process group of subprocess pid=%r',
+                                item.process.pid)
+                    kill_process_group(item.process)
+
+        return self.poll_seconds
+
+
+class ProcessThread(workers.WorkerThread):
+    """Worker thread that hands ProcessItems to the Reaper."""
+
+    def handle_item(self, item):
+        REAPER.add(item, self.output_queue)
+
+
 class ProcessWorkflow(workers.WorkflowItem):
     """Workflow that runs a subprocess.
 
+    The subprocess runs in its own process group, and everything in the
+    group is killed when it times out. Its peak memory and CPU time are
+    written to the end of the log when available.
+
     Args:
         log_path: Path to where output from this subprocess should be written.
         timeout_seconds: How long before the process should be force killed.
+        memory_limit_mb: Optional address space limit in megabytes. Defaults
+            to the --process_memory_limit_mb flag.
+        cpu_limit_seconds: Optional CPU time limit in seconds. Defaults to
+            the --process_cpu_limit_seconds flag.
 
     Returns:
         The return code of the subprocess.
@@ -55,7 +372,13 @@ class ProcessWorkflow(workers.WorkflowItem):
         """Return the arguments for running the subprocess."""
         raise NotImplemented
 
-    def run(self, log_path, timeout_seconds=30):
+    def run(self, log_path, timeout_seconds=30, memory_limit_mb=None,
+            cpu_limit_seconds=None):
+        if memory_limit_mb is None:
+            memory_limit_mb = FLAGS.process_memory_limit_mb
+        if cpu_limit_seconds is None:
+            cpu_limit_seconds = FLAGS.process_cpu_limit_seconds
+
         start_time = time.time()
         with open(log_path, 'a') as output_file:
             args = self.get_args()
@@ -72,32 +395,43 @@ class ProcessWorkflow(workers.WorkflowItem):
                         args,
                         stderr=subprocess.STDOUT,
                         stdout=output_file,
-                        close_fds=True)
+                        close_fds=True,
+                        preexec_fn=limit_resources(
+                            memory_limit_mb, cpu_limit_seconds))
             except:
                 LOGGER.error('item=%r Failed to run subprocess: %r',
                              self, args)
                 raise
 
-            while True:
-                LOGGER.info('item=%r Polling pid=%r', self, process.pid)
-                # NOTE: Use undocumented polling method to work around a
-                # bug in subprocess for handling defunct zombie processes:
-                # http://bugs.python.org/issue2475
-                process._internal_poll(_deadstate=127)
-                if process.returncode is not None:
-                    LOGGER.info(
-                        'item=%r Subprocess finished pid=%r, returncode=%r',
-                        self, process.pid, process.returncode)
-                    raise workers.Return(process.returncode)
-
-                now = time.time()
-                run_time = now - start_time
-                if run_time > timeout_seconds:
-                    LOGGER.info('item=%r Subprocess timed out pid=%r',
-                                self, process.pid)
-                    process.kill()
-                    raise TimeoutError(
-                        'Sent SIGKILL to item=%r, pid=%s, run_time=%s' %
-                        (self, process.pid, run_time))
-
-                yield timer_worker.TimerItem(FLAGS.polltime)
+            LOGGER.info('item=%r Waiting for pid=%r', self, process.pid)
+            item = yield ProcessItem(process, timeout_seconds)
+
+            if item.usage is not None:
+                usage_message = format_usage(item.usage)
+                LOGGER.info('item=%r Subprocess usage pid=%r, %s',
+                            self, process.pid, usage_message)
+                output_file.write('\nProcess usage: %s\n' % usage_message)
+
+            if item.timed_out:
+                LOGGER.info('item=%r Subprocess timed out pid=%r',
+                            self, process.pid)
+                raise TimeoutError(
+                    'Sent SIGKILL to item=%r, pid=%s, run_time=%s' %
+                    (self, process.pid, time.time() - start_time))
+
+            LOGGER.info(
+                'item=%r Subprocess finished pid=%r, returncode=%r',
+                self, process.pid, item.returncode)
+            raise workers.Return(item.returncode)
+
+
+def register(coordinator):
+    """Registers this module as a worker with the given coordinator."""
+    global REAPER
+    if REAPER is None:
+        REAPER = Reaper()
+
+    process_queue = Queue.Queue()
+    coordinator.register(ProcessItem, process_queue)
+    coordinator.worker_threads.append(
+        ProcessThread(process_queue, coordinator.input_queue))
@@ -15,7 +15,10 @@
 
 """Workers that consumer a release server's work queue."""
 
+import collections
+import json
 import logging
+import time
 
 # Local Libraries
 import gflags
@@ -46,6 +49,19 @@ gflags.DEFINE_integer(
     'How often to poll tasks running locally to see if they have completed '
     'and then go back to the server to look for more work.')
 
+gflags.DEFINE_float(
+    'queue_update_flush_seconds', 2.0,
+    'How often to send coalesced heartbeat and finish updates for all '
+    'in-flight tasks to the work queue in a single batch request. Must be '
+    'well below the lease timeout of the queue.')
+
+gflags.DEFINE_integer(
+    'queue_prefetch_tasks', 0,
+    'How many extra tasks to lease ahead of free capacity. Prefetched tasks '
+    'start as soon as a running task finishes instead of waiting for the '
+    'next poll of the work queue. Their leases are kept alive while they '
+    'wait and are released when the worker shuts down.')
+
 
 class Error(Exception):
     """Base-class for exceptions in this module."""
@@ -99,21 +115,328 @@ class HeartbeatWorkflow(workers.WorkflowItem):
             raise HeartbeatError('Bad response: %r' % call)
 
 
+class TaskUpdateBatch(object):
+    """Coalesces heartbeats and finishes for tasks leased from one queue.
+
+    Only the most recent heartbeat for each task is kept. Pending updates
+    are sent to the server periodically by FlushTaskUpdatesWorkflow.
+    Heartbeats the server rejects for running tasks are kept in lost, so
+    the next heartbeat from the task raises a HeartbeatError.
+    """
+
+    def __init__(self):
+        self.heartbeats = {}
+        self.finishes = {}
+        self.running = set()
+        self.lost = {}
+
+    def __len__(self):
+        return len(self.heartbeats) + len(self.finishes)
+
+    def heartbeat(self, task_id, message, index):
+        """Records a heartbeat, replacing any older one for the task."""
+        current = self.heartbeats.get(task_id)
+        if current is None or current[1] <= index:
+            self.heartbeats[task_id] = (message, index)
+
+    def finish(self, task_id, error=False):
+        """Records that a task is finished."""
+        self.finishes[task_id] = error
+
+    def take(self):
+        """Removes and returns all pending (heartbeats, finishes)."""
+        heartbeats, finishes = self.heartbeats, self.finishes
+        self.heartbeats = {}
+        self.finishes = {}
+        return heartbeats, finishes
+
+    def restore(self, heartbeats, finishes):
+        """Puts back updates that could not be sent, keeping newer ones."""
+        for task_id, (message, index) in heartbeats.iteritems():
+            self.heartbeat(task_id, message, index)
+        for task_id, error in finishes.iteritems():
+            self.finishes.setdefault(task_id, error)
+
+    def start(self, task_id):
+        """Records that a task has started running."""
+        self.running.add(task_id)
+
+    def stop(self, task_id):
+        """Records that a task is no longer running."""
+        self.running.discard(task_id)
+        self.lost.pop(task_id, None)
+
+    def lose(self, task_id, error):
+        """Records that the server rejected a heartbeat for a task.
+
+        Pending updates for the task are dropped since the server would
+        reject them too.
+        """
+        self.heartbeats.pop(task_id, None)
+        self.finishes.pop(task_id, None)
+        if task_id in self.running:
+            self.lost[task_id] = error
+
+
+class BatchHeartbeatWorkflow(workers.WorkflowItem):
+    """Records a task's heartbeat in a TaskUpdateBatch without waiting.
+
+    Raises HeartbeatError if the server rejected an earlier heartbeat for
+    the task, like HeartbeatWorkflow does, so the task stops working once
+    its lease is lost.
+
+    Args:
+        batch: TaskUpdateBatch for the queue the task was leased from.
+        task_id: ID of the task to update the heartbeat status message for.
+        message: Heartbeat status message to report.
+        index: Index for the heartbeat message.
+    """
+
+    def run(self, batch, task_id, message, index):
+        yield []  # Make this into a generator
+        error = batch.lost.get(task_id)
+        if error:
+            raise HeartbeatError(error)
+        batch.heartbeat(task_id, message, index)
+
+
+class SendTaskUpdatesWorkflow(workers.WorkflowItem):
+    """Sends all pending updates in a TaskUpdateBatch to the work queue.
+
+    Heartbeats are sent before finishes so a task's final status message is
+    saved before it is marked done. Updates that could not be delivered
+    because of a transport error are put back in the batch to be retried.
+    Heartbeats rejected by the server (e.g., expired leases) are reported
+    back to their tasks through the batch; rejected finishes are dropped.
+
+    Args:
+        queue_url: Base URL of the work queue.
+        batch: TaskUpdateBatch to flush.
+    """
+
+    def run(self, queue_url, batch):
+        heartbeats, finishes = batch.take()
+
+        if heartbeats:
+            task_list = [
+                dict(task_id=task_id, message=message, index=index)
+                for task_id, (message, index) in heartbeats.iteritems()]
+            errors = yield _SendTaskListWorkflow(
+                queue_url + '/heartbeat_batch', task_list)
+            if errors is None:
+                batch.restore(heartbeats, finishes)
+                return
+            for task_id, error in errors.iteritems():
+                batch.lose(task_id, error)
+                finishes.pop(task_id, None)
+
+        if finishes:
+            task_list = [
+                dict(task_id=task_id, error='1' if error else '')
+                for task_id, error in finishes.iteritems()]
+            errors = yield _SendTaskListWorkflow(
+                queue_url + '/finish_batch', task_list)
+            if errors is None:
+                batch.restore({}, finishes)
+                return
+            LOGGER.info('Finished %d work items with queue_url=%r',
+                        len(finishes), queue_url)
+
+
+class _SendTaskListWorkflow(workers.WorkflowItem):
+    """Posts a list of task updates to the server.
+
+    Returns a dictionary mapping task IDs to the error for each update the
+    server rejected, or None if the server did not get the updates.
+    """
+
+    def run(self, url, task_list):
+        try:
+            call = yield fetch_worker.FetchItem(
+                url,
+                post={'tasks': json.dumps(task_list)},
+                username=FLAGS.release_client_id,
+                password=FLAGS.release_client_secret)
+        except Exception, e:
+            LOGGER.error('Could not send %d task updates to url=%r. %s: %s',
+                         len(task_list), url, e.__class__.__name__, e)
+            raise workers.Return(None)
+
+        if not call.json or not call.json.get('success'):
+            LOGGER.error('Could not send %d task updates to url=%r. %r',
+                         len(task_list), url, call)
+            raise workers.Return(None)
+
+        errors = call.json.get('errors', {})
+        for task_id, error in errors.iteritems():
+            LOGGER.error('Task update rejected for url=%r, task_id=%r. %s',
+                         url, task_id, error)
+
+        raise workers.Return(errors)
+
+
+class FlushTaskUpdatesWorkflow(workers.WorkflowItem):
+    """Periodically sends a TaskUpdateBatch until stopped.
+
+    Args:
+        queue_url: Base URL of the work queue.
+        batch: TaskUpdateBatch to flush.
+    """
+
+    fire_and_forget = True
+
+    def run(self, queue_url, batch):
+        while not self.interrupted:
+            yield timer_worker.TimerItem(FLAGS.queue_update_flush_seconds)
+            if batch:
+                yield SendTaskUpdatesWorkflow(queue_url, batch)
+
+
+def _make_heartbeat(batch, task_id):
+    """Returns a function that makes heartbeat workflows for a task.
+
+    The function auto-increments the index on each call, so only the
+    latest update will be saved.
+    """
+    index = [0]
+    def heartbeat(message):
+        next_index = index[0]
+        index[0] = next_index + 1
+        return BatchHeartbeatWorkflow(batch, task_id, message, next_index)
+    return heartbeat
+
+
+def _should_give_up(task, e):
+    """Returns True if a task that raised an exception should be retired."""
+    if (isinstance(e, GiveUpAfterAttemptsError) and
+            task['lease_attempts'] >= e.max_attempts):
+        LOGGER.warning(
+            'Hit max attempts on task=%r, marking task as error', task)
+        return True
+    return False
+
+
+class CatchErrorWorkflow(workers.WorkflowItem):
+    """Runs a workflow and returns the exception it raised, or None.
+
+    Useful for running many workflows in parallel where one failing should
+    not interrupt the others.
+
+    Args:
+        workflow: WorkflowItem to run.
+    """
+
+    def run(self, workflow):
+        try:
+            yield workflow
+        except Exception, e:
+            LOGGER.exception('Exception in workflow=%r', workflow)
+            raise workers.Return(e)
+
+
+class FollowOn(object):
+    """Returned by a local queue workflow to give up its task slot early.
+
+    The workflow runs outside of the slot, so the slot can start its next
+    task right away, and the task is finished once the workflow is done.
+    Useful for the end of a task, like uploading results, that doesn't need
+    what a slot stands for.
+
+    Args:
+        workflow: WorkflowItem that does the rest of the task. It should
+            return or raise what the local queue workflow would have.
+    """
+
+    def __init__(self, workflow):
+        self.workflow = workflow
+
+
+class FinishTaskWorkflow(workers.WorkflowItem):
+    """Runs a workflow for a task and marks the task done in the queue.
+
+    Args:
+        queue_url: Base URL of the work queue.
+        workflow: WorkflowItem that executes the task.
+        task: JSON payload of the task.
+        batch: TaskUpdateBatch where the final status of the task is
+            recorded for sending to the remote queue.
+        heartbeat: The task's heartbeat function.
+
+    Returns:
+        The FollowOn the workflow returned, if any, in which case the task
+        is left running.
+    """
+
+    def run(self, queue_url, workflow, task, batch, heartbeat):
+        task_id = task['task_id']
+        error = False
+        follow_on = None
+
+        try:
+            try:
+                result = yield workflow
+            except Exception, e:
+                LOGGER.exception('Exception while processing work from '
+                                 'queue_url=%r, task=%r', queue_url, task)
+                if task_id in batch.lost:
+                    LOGGER.warning('Lost lease on task_id=%r, not finishing',
+                                   task_id)
+                    return
+
+                yield heartbeat('%s: %s' % (e.__class__.__name__, str(e)))
+
+                if _should_give_up(task, e):
+                    error = True
+                else:
+                    # The task has legimiately failed. Do not mark the task
+                    # as finished. Let it retry in the queue again.
+                    return
+            else:
+                if isinstance(result, FollowOn):
+                    follow_on = result
+
+            if follow_on is None and task_id in batch.lost:
+                LOGGER.warning('Lost lease on task_id=%r, not finishing',
+                               task_id)
+                return
+        finally:
+            if follow_on is None:
+                batch.stop(task_id)
+
+        if follow_on is not None:
+            raise workers.Return(follow_on)
+
+        batch.finish(task_id, error=error)
+        LOGGER.info('Done with work item from queue_url=%r, task_id=%r, '
+                    'error=%r', queue_url, task_id, error)
+
+
+class FollowOnTaskWorkflow(FinishTaskWorkflow):
+    """Finishes a task with its FollowOn workflow outside of its slot."""
+
+    fire_and_forget = True
+
+
 class DoTaskWorkflow(workers.WorkflowItem):
     """Runs a local workflow for a task and marks it done in the remote queue.
 
     Args:
         queue_url: Base URL of the work queue.
         local_queue_workflow: WorkflowItem sub-class to create using parameters
-            from the remote work payload that will execute the task.
+            from the remote work payload that will execute the task. It may
+            return a FollowOn to finish the task outside of its slot.
         task: JSON payload of the task.
+        batch: TaskUpdateBatch where heartbeats and the final status of the
+            task are recorded for sending to the remote queue.
         wait_seconds: Wait this many seconds before starting work.
             Defaults to zero.
-    """
 
-    fire_and_forget = True
+    Returns:
+        The FollowOnTaskWorkflow that is finishing the task, if any.
+    """
 
-    def run(self, queue_url, local_queue_workflow, task, wait_seconds=0):
+    def run(self, queue_url, local_queue_workflow, task, batch,
+            wait_seconds=0):
         LOGGER.info('Starting work item from queue_url=%r, '
                     'task=%r, workflow=%r, wait_seconds=%r',
                     queue_url, task, local_queue_workflow, wait_seconds)
@@ -121,62 +444,225 @@ class DoTaskWorkflow(workers.WorkflowItem):
         if wait_seconds > 0:
             yield timer_worker.TimerItem(wait_seconds)
 
-        # Define a heartbeat closure that will return a workflow for
-        # reporting status. This will auto-increment the index on each
-        # call, so only the latest update will be saved.
-        index = [0]
         task_id = task['task_id']
-        def heartbeat(message):
-            next_index = index[0]
-            index[0] = next_index + 1
-            return HeartbeatWorkflow(
-                queue_url, task_id, message, next_index)
+        heartbeat = _make_heartbeat(batch, task_id)
 
         payload = task['payload']
         payload.update(heartbeat=heartbeat)
 
-        error = False
+        batch.start(task_id)
+        follow_on = yield FinishTaskWorkflow(
+            queue_url, local_queue_workflow(**payload), task, batch,
+            heartbeat)
+        if follow_on is not None:
+            item = yield FollowOnTaskWorkflow(
+                queue_url, follow_on.workflow, task, batch, heartbeat)
+            raise workers.Return(item)
+
+
+class FinishTaskBatchWorkflow(workers.WorkflowItem):
+    """Runs a workflow for many tasks and marks each one done in the queue.
+
+    Args:
+        queue_url: Base URL of the work queue.
+        workflow: WorkflowItem that executes the tasks. It should return a
+            list with the exception raised while processing each task, or
+            None if it succeeded.
+        task_list: List of JSON payloads of the tasks.
+        heartbeat_list: The heartbeat function of each task.
+        batch: TaskUpdateBatch where the final status of each task is
+            recorded for sending to the remote queue.
+
+    Returns:
+        The FollowOn the workflow returned, if any, in which case the tasks
+        are left running.
+    """
+
+    def run(self, queue_url, workflow, task_list, heartbeat_list, batch):
+        task_ids = [task['task_id'] for task in task_list]
+        follow_on = None
 
         try:
-            yield local_queue_workflow(**payload)
-        except Exception, e:
-            LOGGER.exception('Exception while processing work from '
-                             'queue_url=%r, task=%r', queue_url, task)
-            yield heartbeat('%s: %s' % (e.__class__.__name__, str(e)))
-
-            if (isinstance(e, GiveUpAfterAttemptsError) and
-                    task['lease_attempts'] >= e.max_attempts):
-                LOGGER.warning(
-                    'Hit max attempts on task=%r, marking task as error',
-                    task)
-                error = True
+            try:
+                error_list = yield workflow
+            except Exception, e:
+                LOGGER.exception('Exception while processing work from '
+                                 'queue_url=%r, task_ids=%r',
+                                 queue_url, task_ids)
+                error_list = [e] * len(task_list)
             else:
-                # The task has legimiately failed. Do not mark the task as
-                # finished. Let it retry in the queue again.
-                return
+                if isinstance(error_list, FollowOn):
+                    follow_on = error_list
 
-        finish_params = {'task_id': task_id}
-        if error:
-            finish_params['error'] = '1'
+            lost_ids = set(batch.lost).intersection(task_ids)
+        finally:
+            if follow_on is None:
+                for task_id in task_ids:
+                    batch.stop(task_id)
 
-        try:
-            finish_item = yield fetch_worker.FetchItem(
-                queue_url + '/finish',
-                post=finish_params,
-                username=FLAGS.release_client_id,
-                password=FLAGS.release_client_secret)
-        except Exception, e:
-            LOGGER.error('Could not finish work with '
-                         'queue_url=%r, task=%r. %s: %s',
-                         queue_url, task, e.__class__.__name__, e)
+        if follow_on is not None:
+            raise workers.Return(follow_on)
+
+        if lost_ids:
+            LOGGER.warning('Lost leases on task_ids=%r, not finishing',
+                           sorted(lost_ids))
+
+        error_count = 0
+        for task, heartbeat, e in zip(task_list, heartbeat_list, error_list):
+            if task['task_id'] in lost_ids:
+                continue
+            if e is not None:
+                yield heartbeat('%s: %s' % (e.__class__.__name__, str(e)))
+                if not _should_give_up(task, e):
+                    # Let the task retry in the queue again.
+                    continue
+                error_count += 1
+            batch.finish(task['task_id'], error=e is not None)
+
+        LOGGER.info('Done with %d work items from queue_url=%r, errors=%d',
+                    len(task_list), queue_url, error_count)
+
+
+class FollowOnTaskBatchWorkflow(FinishTaskBatchWorkflow):
+    """Finishes tasks with their FollowOn workflow outside of their slot."""
+
+    fire_and_forget = True
+
+
+class DoTaskBatchWorkflow(workers.WorkflowItem):
+    """Runs a local workflow for many tasks at once and marks each one done.
+
+    Args:
+        queue_url: Base URL of the work queue.
+        local_batch_workflow: WorkflowItem sub-class to create with a list
+            of the remote work payloads, each with its own heartbeat
+            function. It should return a list with the exception raised
+            while processing each payload, or None if it succeeded. It may
+            return a FollowOn to finish the tasks outside of their slot.
+        task_list: List of JSON payloads of the tasks.
+        batch: TaskUpdateBatch where heartbeats and the final status of
+            each task are recorded for sending to the remote queue.
+
+    Returns:
+        The FollowOnTaskBatchWorkflow that is finishing the tasks, if any.
+    """
+
+    def run(self, queue_url, local_batch_workflow, task_list, batch):
+        task_ids = [task['task_id'] for task in task_list]
+        LOGGER.info('Starting %d work items from queue_url=%r, '
+                    'task_ids=%r, workflow=%r', len(task_list), queue_url,
+                    task_ids, local_batch_workflow)
+
+        heartbeat_list = []
+        payload_list = []
+        for task in task_list:
+            heartbeat = _make_heartbeat(batch, task['task_id'])
+            heartbeat_list.append(heartbeat)
+            payload = task['payload']
+            payload.update(heartbeat=heartbeat)
+            payload_list.append(payload)
+
+        for task_id in task_ids:
+            batch.start(task_id)
+        follow_on = yield FinishTaskBatchWorkflow(
+            queue_url, local_batch_workflow(payload_list), task_list,
+            heartbeat_list, batch)
+        if follow_on is not None:
+            item = yield FollowOnTaskBatchWorkflow(
+                queue_url, follow_on.workflow, task_list, heartbeat_list,
+                batch)
+            raise workers.Return(item)
+
+
+def _take_task_batch(buffer, batch_size):
+    """Removes up to batch_size tasks from the same release from a buffer.
+
+    The first task in the buffer always starts the batch. Tasks from other
+    releases are left in the buffer in order.
+    """
+    first = buffer.popleft()
+    task_list = [first]
+    release_id = first.get('release_id')
+    if release_id is None:
+        return task_list
+
+    skipped = []
+    while buffer and len(task_list) < batch_size:
+        task = buffer.popleft()
+        if task.get('release_id') == release_id:
+            task_list.append(task)
         else:
-            if finish_item.json and finish_item.json.get('error'):
-                LOGGER.error('Could not finish work with '
-                             'queue_url=%r, task=%r. %s',
-                             queue_url, finish_item.json['error'], task)
-            else:
-                LOGGER.info('Finished work item with queue_url=%r, '
-                            'task_id=%r', queue_url, task_id)
+            skipped.append(task)
+    buffer.extendleft(reversed(skipped))
+    return task_list
+
+
+class TaskSlotWorkflow(workers.WorkflowItem):
+    """Runs tasks from a buffer one at a time until the buffer is empty.
+
+    Each slot is one unit of task concurrency. When its current task
+    finishes it immediately starts the next buffered task, without waiting
+    for the RemoteQueueWorkflow to poll again. A task that returns a
+    FollowOn frees the slot early, but the slot waits for follow-on work
+    to catch up before starting another task if too much is in flight.
+
+    Args:
+        queue_url: Base URL of the work queue.
+        local_queue_workflow: WorkflowItem sub-class to create using parameters
+            from the remote work payload that will execute the task.
+        buffer: collections.deque of leased tasks that haven't started.
+        batch: TaskUpdateBatch for the queue.
+        wait_seconds: Wait this many seconds before starting the first task.
+            Defaults to zero.
+        controller: Optional concurrency.ConcurrencyController. When
+            present, the slot exits instead of starting another task if
+            the controller has lowered its limit.
+        local_batch_workflow: Optional WorkflowItem sub-class for running
+            many tasks at once; see DoTaskBatchWorkflow. When present, the
+            slot takes up to batch_size tasks from the same release at a
+            time instead of running local_queue_workflow for each.
+        batch_size: Maximum number of tasks to give local_batch_workflow.
+        follow_ons: Optional list of the follow-on workflows started by
+            every slot of the queue, shared between them.
+        max_follow_ons: Most follow-on workflows to have in flight before
+            starting another task.
+    """
+
+    fire_and_forget = True
+
+    def run(self, queue_url, local_queue_workflow, buffer, batch,
+            wait_seconds=0, controller=None, local_batch_workflow=None,
+            batch_size=1, follow_ons=None, max_follow_ons=1):
+        if follow_ons is None:
+            follow_ons = []
+        while buffer:
+            if controller and not controller.acquire():
+                return
+
+            start = time.time()
+            try:
+                if local_batch_workflow:
+                    if wait_seconds > 0:
+                        yield timer_worker.TimerItem(wait_seconds)
+                    task_list = _take_task_batch(buffer, batch_size)
+                    follow_on = yield DoTaskBatchWorkflow(
+                        queue_url, local_batch_workflow, task_list, batch)
+                else:
+                    task = buffer.popleft()
+                    follow_on = yield DoTaskWorkflow(
+                        queue_url, local_queue_workflow, task, batch,
+                        wait_seconds=wait_seconds)
+            finally:
+                if controller:
+                    controller.release(time.time() - start - wait_seconds)
+            wait_seconds = 0
+
+            if follow_on is not None:
+                follow_ons.append(follow_on)
+            follow_ons[:] = [x for x in follow_ons if not x.done]
+            while len(follow_ons) > max_follow_ons:
+                yield timer_worker.TimerItem(FLAGS.queue_busy_poll_seconds)
+                follow_ons[:] = [x for x in follow_ons if not x.done]
 
 
 class RemoteQueueWorkflow(workers.WorkflowItem):
@@ -191,25 +677,50 @@ class RemoteQueueWorkflow(workers.WorkflowItem):
         wait_seconds: How many seconds should be between tasks starting to
             process locally. Defaults to 0. Can be used to spread out
             the load a new set of tasks has on the server.
+        controller: Optional concurrency.ConcurrencyController that adjusts
+            the number of tasks in flight. max_tasks is ignored when set.
+        local_batch_workflow: Optional WorkflowItem sub-class for running
+            many tasks from the same release at once; see
+            DoTaskBatchWorkflow. Tasks are leased grouped by release when
+            present.
+        batch_size: Maximum number of tasks in each batch. Up to max_tasks
+            batches will be in flight at any time.
     """
 
     def run(self, queue_name, local_queue_workflow,
-            max_tasks=1, wait_seconds=0):
+            max_tasks=1, wait_seconds=0, controller=None,
+            local_batch_workflow=None, batch_size=1):
         queue_url = '%s/%s' % (FLAGS.queue_server_prefix, queue_name)
-        outstanding = []
+        slots = []
+        follow_ons = []
+        buffer = collections.deque()
+
+        batch = TaskUpdateBatch()
+        flusher = yield FlushTaskUpdatesWorkflow(queue_url, batch)
 
         while not self.interrupted:
-            next_count = max_tasks - len(outstanding)
-            next_tasks = []
+            if controller:
+                max_tasks = controller.maybe_adjust()
+
+            slots[:] = [x for x in slots if not x.done]
+            LOGGER.debug('%d slots and %d prefetched tasks for %r: %r',
+                         len(slots), len(buffer), local_queue_workflow, slots)
+
+            next_count = (
+                (max_tasks - len(slots)) * batch_size +
+                FLAGS.queue_prefetch_tasks - len(buffer))
 
             if next_count > 0:
                 LOGGER.debug(
                     'Fetching %d tasks from queue_url=%r for workflow=%r',
                     next_count, queue_url, local_queue_workflow)
+                post = {'count': next_count}
+                if local_batch_workflow:
+                    post['group_by_release'] = '1'
                 try:
                     next_item = yield fetch_worker.FetchItem(
                         queue_url + '/lease',
-                        post={'count': next_count},
+                        post=post,
                         username=FLAGS.release_client_id,
                         password=FLAGS.release_client_secret)
                 except Exception, e:
@@ -223,23 +734,62 @@ class RemoteQueueWorkflow(workers.WorkflowItem):
                                 'Could not fetch work from queue_url=%r. %s',
                                 queue_url, next_item.json['error'])
                         elif next_item.json['tasks']:
-                            next_tasks = next_item.json['tasks']
-
-            for index, task in enumerate(next_tasks):
-                item = yield DoTaskWorkflow(
-                    queue_url, local_queue_workflow, task,
-                    wait_seconds=index * wait_seconds)
-                outstanding.append(item)
+                            buffer.extend(next_item.json['tasks'])
+
+            index = 0
+            while buffer and len(slots) < max_tasks:
+                item = yield TaskSlotWorkflow(
+                    queue_url, local_queue_workflow, buffer, batch,
+                    wait_seconds=index * wait_seconds,
+                    controller=controller,
+                    local_batch_workflow=local_batch_workflow,
+                    batch_size=batch_size,
+                    follow_ons=follow_ons,
+                    max_follow_ons=max_tasks)
+                slots.append(item)
+                index += 1
+
+            # Keep the leases alive for tasks waiting in the buffer. Each
+            # task's own heartbeats start again from index zero.
+            for task in buffer:
+                batch.heartbeat(
+                    task['task_id'], 'Prefetched, waiting for a free slot', 0)
 
             # Poll for new tasks frequently when we're currently handling
             # task load. Poll infrequently when there hasn't been anything
             # to do recently.
             poll_time = FLAGS.queue_idle_poll_seconds
-            if outstanding:
+            if slots or buffer:
                 poll_time = FLAGS.queue_busy_poll_seconds
 
             yield timer_worker.TimerItem(poll_time)
 
-            outstanding[:] = [x for x in outstanding if not x.done]
-            LOGGER.debug('%d items for %r still outstanding: %r',
-                         len(outstanding), local_queue_workflow, outstanding)
+        # Give back tasks that never started so other workers can take them
+        # right away instead of waiting for their leases to expire.
+        unstarted = list(buffer)
+        buffer.clear()
+        for task in unstarted:
+            batch.heartbeats.pop(task['task_id'], None)
+
+        if unstarted:
+            LOGGER.info('Releasing %d unstarted tasks from queue_url=%r',
+                        len(unstarted), queue_url)
+            yield _SendTaskListWorkflow(
+                queue_url + '/release_batch',
+                [dict(task_id=task['task_id']) for task in unstarted])
+
+        # Let the tasks that already started finish, including their
+        # follow-on work, otherwise their finishes would never be sent. The
+        # flusher keeps sending their heartbeats in the meantime.
+        slots[:] = [x for x in slots if not x.done]
+        while slots or batch.running:
+            LOGGER.info('Waiting for %d slots and %d tasks to finish for '
+                        'queue_url=%r', len(slots), len(batch.running),
+                        queue_url)
+            yield timer_worker.TimerItem(FLAGS.queue_busy_poll_seconds)
+            slots[:] = [x for x in slots if not x.done]
+
+        # Send any updates that are still pending before exiting.
+        flusher.stop()
+        if batch:
+            yield SendTaskUpdatesWorkflow(queue_url, batch)
@@ -0,0 +1,190 @@
+/*
+ * Copyright 2013 Brett Slatkin
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *     http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+
+// Detects when a page is stable enough to take a screenshot. This script is
+// injected into the page by both capture.js and capture.py once the page has
+// loaded, and defines window.dpxdtReadiness.check(options, network). After
+// resizing the viewport, window.dpxdtReadiness.reset() restarts the quiet
+// windows so the page has to settle again at the new size.
+//
+// A page is ready when the document has loaded, all images are complete,
+// the network has been idle and the DOM has not changed for a quiet window,
+// and web fonts have finished loading. The options come from the
+// "readiness" field of the capture config:
+//
+//     networkIdleMs: Quiet window with no requests starting or finishing.
+//     maxInflightRequests: Requests that may stay open while the network
+//         counts as idle, for long-polling connections.
+//     domQuietMs: Quiet window with no DOM mutations.
+//     waitForFonts: Whether to wait for web fonts to load.
+//
+// Network activity is tracked in the page by watching XMLHttpRequest, fetch
+// and the resource timing entries. A capture backend that can see every
+// request itself, like PhantomJS, passes its own view of the network as
+// {inflight: <count>, idleMs: <milliseconds>} instead.
+
+(function() {
+    if (window.dpxdtReadiness) {
+        return;
+    }
+
+    var DEFAULTS = {
+        networkIdleMs: 500,
+        maxInflightRequests: 0,
+        domQuietMs: 500,
+        waitForFonts: true
+    };
+
+    var now = function() {
+        return new Date().getTime();
+    };
+
+    var state = {
+        inflight: 0,
+        lastNetwork: now(),
+        lastMutation: now(),
+        resourceCount: 0
+    };
+
+    var onRequestStart = function() {
+        state.inflight++;
+        state.lastNetwork = now();
+    };
+
+    var onRequestEnd = function() {
+        state.inflight = Math.max(0, state.inflight - 1);
+        state.lastNetwork = now();
+    };
+
+    var Observer = window.MutationObserver || window.WebKitMutationObserver;
+    if (Observer) {
+        new Observer(function() {
+            state.lastMutation = now();
+        }).observe(document, {
+            attributes: true,
+            characterData: true,
+            childList: true,
+            subtree: true
+        });
+    }
+
+    if (window.XMLHttpRequest) {
+        var send = XMLHttpRequest.prototype.send;
+        XMLHttpRequest.prototype.send = function() {
+            var xhr = this;
+            var ended = false;
+            onRequestStart();
+            xhr.addEventListener('readystatechange', function() {
+                if (xhr.readyState == 4 && !ended) {
+                    ended = true;
+                    onRequestEnd();
+                }
+            });
+            try {
+                return send.apply(xhr, arguments);
+            } catch (e) {
+                if (!ended) {
+                    ended = true;
+                    onRequestEnd();
+                }
+                throw e;
+            }
+        };
+    }
+
+    if (window.fetch) {
+        var fetch = window.fetch;
+        window.fetch = function() {
+            onRequestStart();
+            return fetch.apply(this, arguments).then(function(response) {
+                onRequestEnd();
+                return response;
+            }, function(error) {
+                onRequestEnd();
+                throw error;
+            });
+        };
+    }
+
+    var imagesComplete = function() {
+        var images = document.getElementsByTagName('img');
+        for (var i = 0; i < images.length; i++) {
+            if (!images[i].complete || !images[i].naturalHeight) {
+                return false;
+            }
+        }
+        // Lazy loaded images are marked as unveiled once they load.
+        return (document.getElementsByClassName('lazy-load').length ==
+                document.getElementsByClassName('lazy-load is-unveiled').length);
+    };
+
+    var check = function(options, network) {
+        options = options || {};
+        for (var name in DEFAULTS) {
+            if (options[name] === undefined || options[name] === null) {
+                options[name] = DEFAULTS[name];
+            }
+        }
+
+        var time = now();
+        var status = {};
+
+        if (network) {
+            status.inflight = network.inflight;
+            status.networkIdleMs = network.idleMs;
+        } else {
+            // New resource timing entries mean a resource just finished.
+            if (window.performance && performance.getEntriesByType) {
+                var count = performance.getEntriesByType('resource').length;
+                if (count != state.resourceCount) {
+                    state.resourceCount = count;
+                    state.lastNetwork = time;
+                }
+            }
+            status.inflight = state.inflight;
+            // Catch AJAX requests that started before this script was.
+            if (window.jQuery && jQuery.active > status.inflight) {
+                status.inflight = jQuery.active;
+            }
+            status.networkIdleMs = time - state.lastNetwork;
+        }
+
+        status.documentReady = document.readyState == 'complete';
+        status.imagesComplete = imagesComplete();
+        status.domQuietMs = time - state.lastMutation;
+        // Browsers without the font loading API have no way to tell.
+        status.fontsReady = !document.fonts || document.fonts.status == 'loaded';
+
+        status.ready = (
+            status.documentReady &&
+            status.imagesComplete &&
+            status.inflight <= options.maxInflightRequests &&
+            status.networkIdleMs >= options.networkIdleMs &&
+            status.domQuietMs >= options.domQuietMs &&
+            (status.fontsReady || !options.waitForFonts));
+        return status;
+    };
+
+    var reset = function() {
+        state.lastNetwork = now();
+        state.lastMutation = now();
+    };
+
+    window.dpxdtReadiness = {
+        check: check,
+        reset: reset
+    };
+})();
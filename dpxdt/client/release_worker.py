@@ -23,6 +23,7 @@ import gflags
 FLAGS = gflags.FLAGS
 
 # Local modules
+from dpxdt.client import artifact_cache
 from dpxdt.client import fetch_worker
 from dpxdt.client import workers
 
@@ -256,14 +257,17 @@ class ReportRunWorkflow(workers.WorkflowItem):
         image_path: Optional. Path to the screenshot to upload.
         url: Optional. URL that was fetched for the run.
         config_path: Optional. Path to the config to upload.
+        mask_path: Optional. Path to the mask of regions to ignore in the
+            screenshot to upload; see the masks module.
         ref_url: Optional. Previously fetched URL this is being compared to.
         ref_image: Optional. Asset ID of the image to compare to.
         ref_log: Optional. Asset ID of the reference image's log.
         ref_config: Optional. Asset ID of the reference image's config.
+        ref_mask: Optional. Asset ID of the reference image's mask.
         baseline: Optional. When specified and True, the log_path, url,
-            and image_path are for the reference baseline of the specified
-            run, not the new capture. If this is True, the ref_* parameters
-            must not be provided.
+            image_path, and mask_path are for the reference baseline of the
+            specified run, not the new capture. If this is True, the ref_*
+            parameters must not be provided.
         run_failed: Optional. When specified and True it means that this run
             has failed for some reason. The run may be tried again in the
             future but this will cause this run to immediately show up as
@@ -277,8 +281,9 @@ class ReportRunWorkflow(workers.WorkflowItem):
     def run(self, build_id, release_name, release_number, run_name,
             image_path=None, log_path=None, url=None, config_path=None,
             ref_url=None, ref_image=None, ref_log=None, ref_config=None,
-            baseline=None, run_failed=False):
-        if baseline and (ref_url or ref_image or ref_log or ref_config):
+            baseline=None, run_failed=False, mask_path=None, ref_mask=None):
+        if baseline and (ref_url or ref_image or ref_log or ref_config or
+                         ref_mask):
             raise ReportRunError(
                 'Cannot specify "baseline" along with any "ref_*" arguments.')
 
@@ -293,14 +298,21 @@ class ReportRunWorkflow(workers.WorkflowItem):
             config_index = len(upload_jobs)
             upload_jobs.append(UploadFileWorkflow(build_id, config_path))
 
+        if mask_path:
+            mask_index = len(upload_jobs)
+            upload_jobs.append(UploadFileWorkflow(build_id, mask_path))
+
         results = yield upload_jobs
         log_id = results[0]
         image_id = None
         config_id = None
+        mask_id = None
         if image_path:
             image_id = results[image_index]
         if config_path:
             config_id = results[config_index]
+        if mask_path:
+            mask_id = results[mask_index]
 
         post = {
             'build_id': build_id,
@@ -314,10 +326,12 @@ class ReportRunWorkflow(workers.WorkflowItem):
             ref_log = log_id
             ref_image = image_id
             ref_config = config_id
+            ref_mask = mask_id
             url = None
             log_id = None
             image_id = None
             config_id = None
+            mask_id = None
 
         if url:
             post.update(url=url)
@@ -327,6 +341,8 @@ class ReportRunWorkflow(workers.WorkflowItem):
             post.update(log=log_id)
         if config_id:
             post.update(config=config_id)
+        if mask_id:
+            post.update(mask=mask_id)
 
         if run_failed:
             post.update(run_failed='yes')
@@ -339,6 +355,8 @@ class ReportRunWorkflow(workers.WorkflowItem):
             post.update(ref_log=ref_log)
         if ref_config:
             post.update(ref_config=ref_config)
+        if ref_mask:
+            post.update(ref_mask=ref_mask)
 
         call = yield fetch_worker.FetchItem(
             FLAGS.release_server_prefix + '/report_run',
@@ -365,15 +383,22 @@ class ReportPdiffWorkflow(workers.WorkflowItem):
         log_path: Path to the diff log to upload.
         diff_failed: True when there was a problem computing the diff. False
             when the diff was computed successfully. Defaults to False.
+        distortion: Normalized distortion between the images, if any.
+        ref_pixel_hash, run_pixel_hash: Hashes of the decoded pixels of the
+            reference and run images, saved on their artifacts so later
+            diffs between images with the same pixels can be skipped.
+        regions_path: Path to the JSON summary of changed regions to upload.
 
     Raises:
         ReportPdiffError if the pdiff status could not be reported.
     """
 
     def run(self, build_id, release_name, release_number, run_name,
-            diff_path=None, log_path=None, diff_failed=False, distortion=None):
+            diff_path=None, log_path=None, diff_failed=False, distortion=None,
+            ref_pixel_hash=None, run_pixel_hash=None, regions_path=None):
         diff_id = None
         log_id = None
+        regions_id = None
         if (isinstance(diff_path, basestring) and
                 os.path.isfile(diff_path) and
                 isinstance(log_path, basestring) and
@@ -385,6 +410,10 @@ class ReportPdiffWorkflow(workers.WorkflowItem):
         elif isinstance(log_path, basestring) and os.path.isfile(log_path):
             log_id = yield UploadFileWorkflow(build_id, log_path)
 
+        if (diff_id and isinstance(regions_path, basestring) and
+                os.path.isfile(regions_path)):
+            regions_id = yield UploadFileWorkflow(build_id, regions_path)
+
         post = {
             'build_id': build_id,
             'release_name': release_name,
@@ -395,10 +424,16 @@ class ReportPdiffWorkflow(workers.WorkflowItem):
             post.update(diff_image=diff_id)
         if log_id:
             post.update(diff_log=log_id)
+        if regions_id:
+            post.update(diff_regions=regions_id)
         if diff_failed:
             post.update(diff_failed='yes')
         if distortion:
             post.update(distortion=distortion)
+        if ref_pixel_hash:
+            post.update(ref_pixel_hash=ref_pixel_hash)
+        if run_pixel_hash:
+            post.update(run_pixel_hash=run_pixel_hash)
 
         call = yield fetch_worker.FetchItem(
             FLAGS.release_server_prefix + '/report_run',
@@ -452,6 +487,10 @@ class RunsDoneWorkflow(workers.WorkflowItem):
 class DownloadArtifactWorkflow(workers.WorkflowItem):
     """Downloads an artifact to a given path.
 
+    Artifacts are kept in the local artifact cache, when enabled, and
+    hardlinked to the result path the next time they're needed. Files from
+    the cache are read-only.
+
     Args:
         build_id: ID of the build.
         sha1sum: Content hash of the artifact to fetch.
@@ -463,6 +502,10 @@ class DownloadArtifactWorkflow(workers.WorkflowItem):
     """
 
     def run(self, build_id, sha1sum, result_path):
+        cache = artifact_cache.get_cache()
+        if cache and cache.get(sha1sum, result_path):
+            return
+
         download_url = '%s/download?sha1sum=%s&build_id=%s' % (
             FLAGS.release_server_prefix, sha1sum, build_id)
         call = yield fetch_worker.FetchItem(
@@ -472,3 +515,6 @@ class DownloadArtifactWorkflow(workers.WorkflowItem):
             password=FLAGS.release_client_secret)
         if call.status_code != 200:
             raise DownloadArtifactError('Bad response: %r' % call)
+
+        if cache:
+            cache.put(sha1sum, result_path)
@@ -320,6 +320,8 @@ class PendingBarriers(object):
     def __init__(self):
         self.pending = {}
         self.work_map = {}
+        # Items that were put on a queue and haven't come back yet.
+        self.in_flight = set()
 
     def __len__(self):
         return len(self.pending)
@@ -351,11 +353,16 @@ class PendingBarriers(object):
                 # Don't reenqueue items that are already done.
                 continue
 
-            target_queue = self._find_target_queue(item)
-
             if not item.fire_and_forget:
                 self.pending[item] = barrier
 
+            if item in self.in_flight:
+                # Yielded again after a WaitAny returned without it. It will
+                # come back to this barrier once it's done.
+                continue
+
+            target_queue = self._find_target_queue(item)
+            self.in_flight.add(item)
             target_queue.put(item)
 
         # If the barrier has no oustanding items, immediately progress the
@@ -374,6 +381,7 @@ class PendingBarriers(object):
 
         # This is a WorkItem from a worker thread that has finished and
         # needs to be reinjected into a WorkflowItem generator.
+        self.in_flight.discard(item)
         barrier = self.pending.pop(item, None)
         if barrier is None:
             # Item was already finished in another barrier, or was
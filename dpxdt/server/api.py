@@ -103,6 +103,10 @@ from dpxdt.server import work_queue
 from dpxdt.server import utils
 
 
+# Workers may upload screenshots as lossless WebP; see capture_worker.
+mimetypes.add_type('image/webp', '.webp')
+
+
 @app.route('/api/create_release', methods=['POST'])
 @auth.build_api_access_required
 @utils.retryable_transaction()
@@ -206,10 +210,14 @@ def _get_release_params():
     return release_name, release_number
 
 
-def _find_last_good_run(build):
-    """Finds the last good release and run for a build."""
-    run_name = request.form.get('run_name', type=str)
-    utils.jsonify_assert(run_name, 'run_name required')
+def _find_last_good_run(build, run_name=None):
+    """Finds the last good release and run for a build.
+
+    The run name comes from the request unless one is given.
+    """
+    if run_name is None:
+        run_name = request.form.get('run_name', type=str)
+        utils.jsonify_assert(run_name, 'run_name required')
 
     last_good_release = (
         models.Release.query
@@ -257,16 +265,21 @@ def find_run():
             url=last_good_run.url,
             image=last_good_run.image,
             log=last_good_run.log,
-            config=last_good_run.config)
+            config=last_good_run.config,
+            mask=last_good_run.mask)
 
     return utils.jsonify_error('Run not found')
 
 
-def _get_or_create_run(build):
-    """Gets a run for a build or creates it if it does not exist."""
+def _get_or_create_run(build, run_name=None):
+    """Gets a run for a build or creates it if it does not exist.
+
+    The run name comes from the request unless one is given.
+    """
     release_name, release_number = _get_release_params()
-    run_name = request.form.get('run_name', type=str)
-    utils.jsonify_assert(run_name, 'run_name required')
+    if run_name is None:
+        run_name = request.form.get('run_name', type=str)
+        utils.jsonify_assert(run_name, 'run_name required')
 
     release = (
         models.Release.query
@@ -293,17 +306,75 @@ def _get_or_create_run(build):
     return release, run
 
 
-def _enqueue_capture(build, release, run, url, config_data, baseline=False):
-    """Enqueues a task to run a capture process."""
-    # Validate the JSON config parses.
+def _parse_config(config_data):
+    """Parses a capture config, aborting the request if it's invalid."""
     try:
         config_dict = json.loads(config_data)
     except Exception, e:
         abort(utils.jsonify_error(e))
+    utils.jsonify_assert(
+        isinstance(config_dict, dict), 'config must be a JSON object')
+    return config_dict
+
+
+def _get_viewport_sizes(config_dict):
+    """Returns the viewport sizes a capture config asks for, if any.
+
+    A config with "viewportSizes" is captured once per size from a single
+    page load, and each size gets a run of its own.
+    """
+    viewport_sizes = config_dict.get('viewportSizes')
+    if not viewport_sizes:
+        return []
+
+    utils.jsonify_assert(
+        isinstance(viewport_sizes, list), 'viewportSizes must be a list')
+    names = set()
+    for viewport_size in viewport_sizes:
+        utils.jsonify_assert(
+            isinstance(viewport_size, dict) and
+            isinstance(viewport_size.get('width'), int) and
+            isinstance(viewport_size.get('height'), int),
+            'viewportSizes entries require a width and height')
+        name = _get_viewport_run_name('', viewport_size)
+        utils.jsonify_assert(
+            name not in names, 'viewportSizes entries must be unique')
+        names.add(name)
+    return viewport_sizes
+
+
+def _get_viewport_run_name(run_name, viewport_size):
+    """Returns the name of the run for one size of a viewport matrix."""
+    name = viewport_size.get('name') or '%(width)dx%(height)d' % viewport_size
+    return '%s@%s' % (run_name, name)
+
+
+def _enqueue_capture(build, release, run, url, config_data, baseline=False,
+                     viewport_runs=None):
+    """Enqueues a task to run a capture process.
+
+    Args:
+        build: Build the capture is for.
+        release: Release the capture is for.
+        run: Run the capture is for. With viewport_runs, the run that owns
+            the task.
+        url: URL to capture.
+        config_data: JSON capture config.
+        baseline: True when the capture is for the reference baseline.
+        viewport_runs: Optional. List of (run, viewport_size) pairs, to
+            capture every size with one task and report each to its own run.
+    """
+    config_dict = _parse_config(config_data)
 
     # Rewrite the config JSON to include the URL specified in this request.
     # Blindly overwrite anything that was there.
     config_dict['targetUrl'] = url
+    if viewport_runs:
+        # The baseline must be captured at the same sizes.
+        config_dict['viewportSizes'] = [
+            viewport_size for _, viewport_size in viewport_runs]
+    else:
+        config_dict.pop('viewportSizes', None)
     config_data = json.dumps(config_dict)
 
     config_artifact = _save_artifact(build, config_data, 'application/json')
@@ -317,17 +388,23 @@ def _enqueue_capture(build, release, run, url, config_data, baseline=False):
     task_id = '%s:%s%s' % (run.id, hashlib.sha1(url).hexdigest(), suffix)
     logging.info('Enqueueing capture task=%r, baseline=%r', task_id, baseline)
 
+    payload = dict(
+        build_id=build.id,
+        release_name=release.name,
+        release_number=release.number,
+        run_name=run.name,
+        url=url,
+        config_sha1sum=config_artifact.id,
+        baseline=baseline,
+    )
+    if viewport_runs:
+        payload['viewport_runs'] = [
+            dict(run_name=viewport_run.name, viewport_size=viewport_size)
+            for viewport_run, viewport_size in viewport_runs]
+
     work_queue.add(
         constants.CAPTURE_QUEUE_NAME,
-        payload=dict(
-            build_id=build.id,
-            release_name=release.name,
-            release_number=release.number,
-            run_name=run.name,
-            url=url,
-            config_sha1sum=config_artifact.id,
-            baseline=baseline,
-        ),
+        payload=payload,
         build_id=build.id,
         release_id=release.id,
         run_id=run.id,
@@ -336,6 +413,24 @@ def _enqueue_capture(build, release, run, url, config_data, baseline=False):
 
     # Set the URL and config early to indicate to report_run that there is
     # still data pending even if 'image' and 'ref_image' are unset.
+    if not viewport_runs:
+        _set_run_config(run, url, config_artifact, baseline)
+        return
+
+    # Each run's config is for the one size it shows.
+    for viewport_run, viewport_size in viewport_runs:
+        run_config_dict = dict(config_dict)
+        del run_config_dict['viewportSizes']
+        run_config_dict['viewportSize'] = viewport_size
+        run_config_artifact = _save_artifact(
+            build, json.dumps(run_config_dict), 'application/json')
+        db.session.add(run_config_artifact)
+        _set_run_config(viewport_run, url, run_config_artifact, baseline)
+    db.session.flush()
+
+
+def _set_run_config(run, url, config_artifact, baseline):
+    """Sets the URL and config of a run that's waiting for a capture."""
     if baseline:
         run.ref_url = url
         run.ref_config = config_artifact.id
@@ -348,17 +443,37 @@ def _enqueue_capture(build, release, run, url, config_data, baseline=False):
 @auth.build_api_access_required
 @utils.retryable_transaction()
 def request_run():
-    """Requests a new run for a release candidate."""
+    """Requests a new run for a release candidate.
+
+    When the config has "viewportSizes", one capture task takes a screenshot
+    at each size and reports it to a run named "<run_name>@<size name>",
+    where the size name is its "name" or "<width>x<height>".
+    """
     build = g.build
-    current_release, current_run = _get_or_create_run(build)
+    run_name = request.form.get('run_name', type=str)
+    utils.jsonify_assert(run_name, 'run_name required')
 
     current_url = request.form.get('url', type=str)
     config_data = request.form.get('config', default='{}', type=str)
     utils.jsonify_assert(current_url, 'url to capture required')
     utils.jsonify_assert(config_data, 'config document required')
 
-    config_artifact = _enqueue_capture(
-        build, current_release, current_run, current_url, config_data)
+    viewport_sizes = _get_viewport_sizes(_parse_config(config_data))
+    viewport_runs = None
+    if viewport_sizes:
+        viewport_runs = []
+        for viewport_size in viewport_sizes:
+            current_release, viewport_run = _get_or_create_run(
+                build, _get_viewport_run_name(run_name, viewport_size))
+            viewport_runs.append((viewport_run, viewport_size))
+        run_list = [viewport_run for viewport_run, _ in viewport_runs]
+    else:
+        current_release, current_run = _get_or_create_run(build, run_name)
+        run_list = [current_run]
+
+    _enqueue_capture(
+        build, current_release, run_list[0], current_url, config_data,
+        viewport_runs=viewport_runs)
 
     ref_url = request.form.get('ref_url', type=str)
     ref_config_data = request.form.get('ref_config', type=str)
@@ -367,33 +482,143 @@ def request_run():
         'ref_url and ref_config must both be specified or not specified')
 
     if ref_url and ref_config_data:
-        ref_config_artifact = _enqueue_capture(
-            build, current_release, current_run, ref_url, ref_config_data,
-            baseline=True)
+        _enqueue_capture(
+            build, current_release, run_list[0], ref_url, ref_config_data,
+            baseline=True, viewport_runs=viewport_runs)
     else:
-        _, last_good_run = _find_last_good_run(build)
-        if last_good_run:
-            current_run.ref_url = last_good_run.url
-            current_run.ref_image = last_good_run.image
-            current_run.ref_log = last_good_run.log
-            current_run.ref_config = last_good_run.config
-
-    db.session.add(current_run)
+        for current_run in run_list:
+            _, last_good_run = _find_last_good_run(build, current_run.name)
+            if last_good_run:
+                current_run.ref_url = last_good_run.url
+                current_run.ref_image = last_good_run.image
+                current_run.ref_log = last_good_run.log
+                current_run.ref_config = last_good_run.config
+                current_run.ref_mask = last_good_run.mask
+
+    for current_run in run_list:
+        db.session.add(current_run)
     db.session.commit()
 
-    signals.run_updated_via_api.send(
-        app, build=build, release=current_release, run=current_run)
+    for current_run in run_list:
+        signals.run_updated_via_api.send(
+            app, build=build, release=current_release, run=current_run)
+
+    run_info_list = [
+        dict(run_name=current_run.name,
+             url=current_run.url,
+             config=current_run.config,
+             ref_url=current_run.ref_url,
+             ref_config=current_run.ref_config)
+        for current_run in run_list]
+
+    if viewport_runs:
+        return flask.jsonify(
+            success=True,
+            build_id=build.id,
+            release_name=current_release.name,
+            release_number=current_release.number,
+            run_name=run_name,
+            viewport_runs=run_info_list)
 
     return flask.jsonify(
         success=True,
         build_id=build.id,
         release_name=current_release.name,
         release_number=current_release.number,
-        run_name=current_run.name,
-        url=current_run.url,
-        config=current_run.config,
-        ref_url=current_run.ref_url,
-        ref_config=current_run.ref_config)
+        **run_info_list[0])
+
+
+def _save_pixel_hash(sha1sum, pixel_hash):
+    """Saves the hash of an image artifact's decoded pixels, if not set."""
+    if not sha1sum:
+        return
+    query = models.Artifact.query.filter_by(id=sha1sum, pixel_hash=None)
+    query.update(dict(pixel_hash=pixel_hash), synchronize_session=False)
+
+
+def _have_same_pixels(image, ref_image):
+    """Returns True if both image artifacts have the same pixel hash."""
+    # Only select the hashes to avoid loading the artifact data.
+    pixel_hashes = dict(
+        db.session.query(models.Artifact.id, models.Artifact.pixel_hash)
+        .filter(models.Artifact.id.in_([image, ref_image])))
+    return (pixel_hashes.get(image) is not None and
+            pixel_hashes.get(image) == pixel_hashes.get(ref_image))
+
+
+def _build_owns_artifact(build, sha1sum):
+    """Returns True if the build uploaded or was given the artifact."""
+    table = models.artifact_ownership_table
+    owned = (
+        db.session.query(table)
+        .filter_by(artifact=sha1sum, build_id=build.id)
+        .first())
+    return owned is not None
+
+
+def _grant_artifact_access(build, sha1sum):
+    """Makes an existing artifact downloadable by the given build."""
+    if not _build_owns_artifact(build, sha1sum):
+        db.session.execute(
+            models.artifact_ownership_table.insert().values(
+                artifact=sha1sum, build_id=build.id))
+
+
+def _passes_threshold(build, distortion):
+    """Returns True if a diff is small enough to count as no difference."""
+    return bool(build.distortion_threshold and distortion is not None and
+                distortion < build.distortion_threshold)
+
+
+def _save_diff_result(run):
+    """Remembers the pdiff result of a run for its pair of images."""
+    if run.distortion and not run.diff_image:
+        # The diff image was dropped because of the build's threshold,
+        # which other builds may not share.
+        return
+
+    result = models.DiffResult.query.get((run.ref_image, run.image))
+    if result:
+        return
+
+    db.session.add(models.DiffResult(
+        ref_image=run.ref_image,
+        run_image=run.image,
+        diff_image=run.diff_image,
+        diff_log=run.diff_log,
+        diff_regions=run.diff_regions,
+        distortion=run.distortion))
+
+
+def _load_diff_result(build, run):
+    """Fills in a run's pdiff result if its images were diffed before.
+
+    Returns:
+        True if a previous result was found, False otherwise.
+    """
+    result = models.DiffResult.query.get((run.ref_image, run.image))
+    if not result:
+        return False
+
+    # The diff could have come from another build. Only share it with
+    # builds that have both images, since the diff reveals their content.
+    if not (_build_owns_artifact(build, run.ref_image) and
+            _build_owns_artifact(build, run.image)):
+        return False
+
+    for sha1sum in (result.diff_image, result.diff_log, result.diff_regions):
+        if sha1sum:
+            _grant_artifact_access(build, sha1sum)
+
+    run.diff_image = result.diff_image
+    run.diff_log = result.diff_log
+    run.diff_regions = result.diff_regions
+    run.distortion = result.distortion
+    run.distortion_threshold = build.distortion_threshold
+    if _passes_threshold(build, run.distortion):
+        run.diff_image = None
+        run.diff_regions = None
+    return True
 
 
 @app.route('/api/report_run', methods=['POST'])
@@ -410,19 +635,25 @@ def report_run():
     current_image = request.form.get('image', type=str)
     current_log = request.form.get('log', type=str)
     current_config = request.form.get('config', type=str)
+    current_mask = request.form.get('mask', type=str)
 
     ref_url = request.form.get('ref_url', type=str)
     ref_image = request.form.get('ref_image', type=str)
     ref_log = request.form.get('ref_log', type=str)
     ref_config = request.form.get('ref_config', type=str)
+    ref_mask = request.form.get('ref_mask', type=str)
 
     diff_failed = request.form.get('diff_failed', type=str)
     diff_image = request.form.get('diff_image', type=str)
     diff_log = request.form.get('diff_log', type=str)
+    diff_regions = request.form.get('diff_regions', type=str)
 
     distortion = request.form.get('distortion', default=None, type=float)
     run_failed = request.form.get('run_failed', type=str)
 
+    ref_pixel_hash = request.form.get('ref_pixel_hash', type=str)
+    run_pixel_hash = request.form.get('run_pixel_hash', type=str)
+
     if current_url:
         run.url = current_url
     if current_image:
@@ -431,12 +662,15 @@ def report_run():
         run.log = current_log
     if current_config:
         run.config = current_config
+    if current_mask:
+        run.mask = current_mask
     if current_image or current_log or current_config:
         logging.info('Saving run data: build_id=%r, release_name=%r, '
                      'release_number=%d, run_name=%r, url=%r, '
-                     'image=%r, log=%r, config=%r, run_failed=%r',
+                     'image=%r, log=%r, config=%r, mask=%r, run_failed=%r',
                      build.id, release.name, release.number, run.name,
-                     run.url, run.image, run.log, run.config, run_failed)
+                     run.url, run.image, run.log, run.config, run.mask,
+                     run_failed)
 
     if ref_url:
         run.ref_url = ref_url
@@ -446,29 +680,89 @@ def report_run():
         run.ref_log = ref_log
     if ref_config:
         run.ref_config = ref_config
+    if ref_mask:
+        run.ref_mask = ref_mask
     if ref_image or ref_log or ref_config:
         logging.info('Saved reference data: build_id=%r, release_name=%r, '
                      'release_number=%d, run_name=%r, ref_url=%r, '
-                     'ref_image=%r, ref_log=%r, ref_config=%r',
+                     'ref_image=%r, ref_log=%r, ref_config=%r, ref_mask=%r',
+                     build.id, release.name, release.number, run.name,
+                     run.ref_url, run.ref_image, run.ref_log, run.ref_config,
+                     run.ref_mask)
+
+    if diff_image and _passes_threshold(build, distortion):
+        # Workers usually drop diffs under the threshold themselves, but
+        # the threshold may have changed since the task was enqueued.
+        logging.info('Ignoring pdiff under threshold: build_id=%r, '
+                     'release_name=%r, release_number=%d, run_name=%r, '
+                     'distortion=%r, distortion_threshold=%r',
                      build.id, release.name, release.number, run.name,
-                     run.ref_url, run.ref_image, run.ref_log, run.ref_config)
+                     distortion, build.distortion_threshold)
+        diff_image = None
+        diff_regions = None
 
     if diff_image:
         run.diff_image = diff_image
     if diff_log:
         run.diff_log = diff_log
+    if diff_regions:
+        run.diff_regions = diff_regions
     if distortion:
         run.distortion = distortion
+    if diff_image or diff_log:
+        run.distortion_threshold = build.distortion_threshold
 
     if diff_image or diff_log:
         logging.info('Saved pdiff: build_id=%r, release_name=%r, '
                      'release_number=%d, run_name=%r, diff_image=%r, '
-                     'diff_log=%r, diff_failed=%r, distortion=%r',
+                     'diff_log=%r, diff_regions=%r, diff_failed=%r, '
+                     'distortion=%r',
                      build.id, release.name, release.number, run.name,
-                     run.diff_image, run.diff_log, diff_failed, distortion)
+                     run.diff_image, run.diff_log, run.diff_regions,
+                     diff_failed, distortion)
+
+    # Results of diffs with masks depend on more than the two images, so
+    # don't share them with other runs.
+    masked = bool(run.mask or run.ref_mask)
+
+    if (diff_image or diff_log) and not diff_failed:
+        if run.image and run.ref_image and not masked:
+            _save_diff_result(run)
+    elif (run.image and run.ref_image and run.image != run.ref_image and
+            not run.diff_log and not diff_failed and not masked):
+        if _load_diff_result(build, run):
+            logging.info('Reusing pdiff: build_id=%r, release_name=%r, '
+                         'release_number=%d, run_name=%r, ref_image=%r, '
+                         'image=%r, diff_image=%r, diff_log=%r',
+                         build.id, release.name, release.number, run.name,
+                         run.ref_image, run.image, run.diff_image,
+                         run.diff_log)
+
+    if ref_pixel_hash:
+        _save_pixel_hash(run.ref_image, ref_pixel_hash)
+    if run_pixel_hash:
+        _save_pixel_hash(run.image, run_pixel_hash)
 
     if run.image and run.diff_image:
         run.status = models.Run.DIFF_FOUND
+    elif run.image and run.image == run.ref_image and not diff_failed:
+        # Byte-identical screenshots can't differ, so skip the pdiff.
+        if run.status != models.Run.DIFF_NOT_FOUND:
+            logging.info('Skipping pdiff for identical images: build_id=%r, '
+                         'release_name=%r, release_number=%d, run_name=%r, '
+                         'image=%r', build.id, release.name, release.number,
+                         run.name, run.image)
+        run.status = models.Run.DIFF_NOT_FOUND
+    elif (run.image and run.ref_image and not run.diff_log and
+            _have_same_pixels(run.image, run.ref_image)):
+        # Screenshots that only differ in encoding were already found to
+        # have the same pixels by an earlier pdiff, so skip it this time.
+        logging.info('Skipping pdiff for images with the same pixels: '
+                     'build_id=%r, release_name=%r, release_number=%d, '
+                     'run_name=%r, image=%r, ref_image=%r',
+                     build.id, release.name, release.number, run.name,
+                     run.image, run.ref_image)
+        run.status = models.Run.DIFF_NOT_FOUND
     elif run.image and run.ref_image and not run.diff_log:
         run.status = models.Run.NEEDS_DIFF
     elif run.image and run.ref_image and not diff_failed:
@@ -500,6 +794,9 @@ def report_run():
                 run_name=run.name,
                 run_sha1sum=run.image,
                 reference_sha1sum=run.ref_image,
+                mask_sha1sum=run.mask,
+                reference_mask_sha1sum=run.ref_mask,
+                distortion_threshold=build.distortion_threshold,
             ),
             build_id=build.id,
             release_id=release.id,
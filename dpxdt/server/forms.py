@@ -20,7 +20,8 @@ import datetime
 # Local libraries
 from flask.ext.wtf import Form
 from wtforms import (
-    BooleanField, HiddenField, IntegerField, SubmitField, TextField)
+    BooleanField, FloatField, HiddenField, IntegerField, SubmitField,
+    TextField)
 from wtforms.validators import (
     DataRequired, Email, Optional, Length, NumberRange, Required)
 
@@ -101,6 +102,12 @@ class ModifyWorkQueueTaskForm(Form):
     retry = SubmitField('Retry')
 
 
+class RebuildWorkQueueStatsForm(Form):
+    """Form for rebuilding the work queue counters from scratch."""
+
+    rebuild = SubmitField('Rebuild counters')
+
+
 class SettingsForm(Form):
     """Form for modifying build settings."""
 
@@ -109,5 +116,8 @@ class SettingsForm(Form):
     send_email = BooleanField('Send notification emails')
     email_alias = TextField('Mailing list for notifications',
                             validators=[Optional(), Email()])
+    distortion_threshold = FloatField(
+        'Distortion threshold',
+        validators=[Optional(), NumberRange(min=0, max=1)])
     build_id = HiddenField(validators=[NumberRange(min=1)])
     save = SubmitField('Save')
@@ -299,7 +299,9 @@ def view_run():
         db.session.add(run)
         db.session.commit()
 
-        ops.evict()
+        operations.CandidateListOps(build.id).evict()
+        operations.ReleaseOps(
+            build.id, run.release.name, run.release.number).evict()
 
         return redirect(url_for(
             request.endpoint,
@@ -325,7 +327,8 @@ def view_run():
         log_file=log_file,
         config_file=config_file,
         sha1sum=sha1sum,
-        approval_log=approval_log)
+        approval_log=approval_log,
+        tasks=operations.TaskOps(run.id).get_tasks())
 
     if file_type:
         template_name = 'view_artifact.html'
@@ -347,8 +350,11 @@ def build_settings():
     if settings_form.validate_on_submit():
         settings_form.populate_obj(build)
 
-        message = ('name=%s, send_email=%s, email_alias=%s' % (
-            build.name, build.send_email, build.email_alias))
+        message = (
+            'name=%s, send_email=%s, email_alias=%s, '
+            'distortion_threshold=%s' % (
+                build.name, build.send_email, build.email_alias,
+                build.distortion_threshold))
         auth.save_admin_log(build, changed_settings=True, message=message)
 
         db.session.add(build)
@@ -366,6 +372,7 @@ def build_settings():
     settings_form.build_id.data = build.id
     settings_form.email_alias.data = build.email_alias
     settings_form.send_email.data = build.send_email
+    settings_form.distortion_threshold.data = build.distortion_threshold
 
     return render_template(
         'view_settings.html',
@@ -102,6 +102,8 @@ class Build(db.Model):
                              lazy='dynamic')
     send_email = db.Column(db.Boolean, default=True)
     email_alias = db.Column(db.String(255))
+    # Diffs with less distortion than this, from 0 to 1, count as the same.
+    distortion_threshold = db.Column(db.Float())
 
     def is_owned_by(self, user_id):
         return self.owners.filter_by(id=user_id).first() is not None
@@ -150,11 +152,34 @@ class Artifact(db.Model):
     data = db.Column(db.LargeBinary(length=2**31))
     alternate = db.Column(db.Text)
     content_type = db.Column(db.String(255))
+    # Hash of the decoded pixels for images, reported by pdiff workers.
+    # Images with the same pixel_hash can't have a diff.
+    pixel_hash = db.Column(db.String(100))
     owners = db.relationship('Build', secondary=artifact_ownership_table,
                              backref=db.backref('artifacts', lazy='dynamic'),
                              lazy='dynamic')
 
 
+class DiffResult(db.Model):
+    """Result of a perceptual diff between a pair of image artifacts.
+
+    Keyed by the content hashes of the reference and run images, so any
+    other run that compares the same pair, in any release or build, can
+    reuse the result instead of doing the diff again.
+    """
+
+    ref_image = db.Column(db.String(100), db.ForeignKey('artifact.id'),
+                          primary_key=True)
+    run_image = db.Column(db.String(100), db.ForeignKey('artifact.id'),
+                          primary_key=True)
+    created = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+
+    diff_image = db.Column(db.String(100), db.ForeignKey('artifact.id'))
+    diff_log = db.Column(db.String(100), db.ForeignKey('artifact.id'))
+    diff_regions = db.Column(db.String(100), db.ForeignKey('artifact.id'))
+    distortion = db.Column(db.Float())
+
+
 class Run(db.Model):
     """Contains a set of screenshot records uploaded by a diff worker."""
 
@@ -189,20 +214,28 @@ class Run(db.Model):
     image = db.Column(db.String(100), db.ForeignKey('artifact.id'))
     log = db.Column(db.String(100), db.ForeignKey('artifact.id'))
     config = db.Column(db.String(100), db.ForeignKey('artifact.id'))
+    # JSON list of regions to ignore when diffing; see client/masks.py.
+    mask = db.Column(db.String(100), db.ForeignKey('artifact.id'))
     url = db.Column(db.String(2048))
 
     ref_image = db.Column(db.String(100), db.ForeignKey('artifact.id'))
     ref_log = db.Column(db.String(100), db.ForeignKey('artifact.id'))
     ref_config = db.Column(db.String(100), db.ForeignKey('artifact.id'))
+    ref_mask = db.Column(db.String(100), db.ForeignKey('artifact.id'))
     ref_url = db.Column(db.String(2048))
 
     diff_image = db.Column(db.String(100), db.ForeignKey('artifact.id'))
     diff_log = db.Column(db.String(100), db.ForeignKey('artifact.id'))
+    # JSON summary of the bounding boxes of changed regions in the diff.
+    diff_regions = db.Column(db.String(100), db.ForeignKey('artifact.id'))
     distortion = db.Column(db.Float())
+    # The build's distortion threshold when the diff was reported.
+    distortion_threshold = db.Column(db.Float())
 
+    # Task status is cached separately by operations.TaskOps, so don't
+    # eagerly load tasks along with every run in a release.
     tasks = db.relationship('WorkQueue',
-                            lazy='joined',
-                            join_depth=1,
+                            lazy='select',
                             order_by='WorkQueue.created')
 
     # For flask-cache memoize key.
@@ -58,15 +58,24 @@ class BaseOps(object):
 
     The versioned_cache_key value will be the same for the lifetime of the
     BaseOps object, which should be a single HTTP request.
+
+    When parent is set, the versioned_cache_key also includes the parent's
+    versioned key. Evicting the parent evicts all of its children, while
+    evicting a child leaves the parent and its other children cached.
     """
 
     cache_key = None
     versioned_cache_key = None
+    parent = None
 
     # For Flask-Cache keys
     def __repr__(self):
         if self.versioned_cache_key is None:
-            self.versioned_cache_key = _get_versioned_hash_key(self.cache_key)
+            versioned_cache_key = _get_versioned_hash_key(self.cache_key)
+            if self.parent is not None:
+                versioned_cache_key = '%r/%s' % (
+                    self.parent, versioned_cache_key)
+            self.versioned_cache_key = versioned_cache_key
         return self.versioned_cache_key
 
     def evict(self):
@@ -191,6 +200,31 @@ class BuildOps(BaseOps):
             return ('runs_failed',)
         return ('runs_pending',)
 
+    def get_candidates(self, page_size, offset):
+        return CandidateListOps(self.build_id).get_candidates(
+            page_size, offset)
+
+    def get_release(self, release_name, release_number):
+        return ReleaseOps(
+            self.build_id, release_name, release_number).get_release()
+
+    def get_run(self, release_name, release_number, test_name):
+        return RunOps(
+            self.build_id, release_name, release_number, test_name).get_run()
+
+
+class CandidateListOps(BaseOps):
+    """Cacheable operations for the list of release candidates in a build.
+
+    Evicted whenever any run in the build changes status, since the list
+    includes per-candidate run statistics.
+    """
+
+    def __init__(self, build_id):
+        self.build_id = build_id
+        self.parent = BuildOps(build_id)
+        self.cache_key = 'caching.CandidateListOps(build_id=%r)' % build_id
+
     @cache.memoize()
     def get_candidates(self, page_size, offset):
         candidate_list = (
@@ -224,14 +258,27 @@ class BuildOps(BaseOps):
 
         return has_next_page, candidate_list, stats_counts
 
+
+class ReleaseOps(BaseOps):
+    """Cacheable operations for a single release candidate."""
+
+    def __init__(self, build_id, release_name, release_number):
+        self.build_id = build_id
+        self.release_name = release_name
+        self.release_number = release_number
+        self.parent = BuildOps(build_id)
+        self.cache_key = (
+            'caching.ReleaseOps(build_id=%r, name=%r, number=%r)' % (
+                build_id, release_name, release_number))
+
     @cache.memoize()
-    def get_release(self, release_name, release_number):
+    def get_release(self):
         release = (
             models.Release.query
             .filter_by(
                 build_id=self.build_id,
-                name=release_name,
-                number=release_number)
+                name=self.release_name,
+                number=self.release_number)
             .first())
 
         if not release:
@@ -246,10 +293,13 @@ class BuildOps(BaseOps):
             runs_successful=0,
             runs_failed=0,
             runs_baseline=0,
-            runs_pending=0)
+            runs_pending=0,
+            runs_identical=0)
         for run in run_list:
-            for key in self.get_stats_keys(run.status):
+            for key in BuildOps.get_stats_keys(run.status):
                 stats_dict[key] += 1
+            if run.image and run.image == run.ref_image:
+                stats_dict['runs_identical'] += 1
 
         approval_log = None
         if release.status in (models.Release.GOOD, models.Release.BAD):
@@ -270,6 +320,24 @@ class BuildOps(BaseOps):
 
         return release, run_list, stats_dict, approval_log
 
+
+class RunOps(BaseOps):
+    """Cacheable operations for a single run in a release candidate.
+
+    Runs are children of their release, since the next and previous runs
+    depend on the status of every other run in the release.
+    """
+
+    def __init__(self, build_id, release_name, release_number, run_name):
+        self.build_id = build_id
+        self.release_name = release_name
+        self.release_number = release_number
+        self.run_name = run_name
+        self.parent = ReleaseOps(build_id, release_name, release_number)
+        self.cache_key = (
+            'caching.RunOps(build_id=%r, name=%r, number=%r, test=%r)' % (
+                build_id, release_name, release_number, run_name))
+
     def _get_next_previous_runs(self, run):
         next_run = None
         previous_run = None
@@ -328,13 +396,13 @@ class BuildOps(BaseOps):
         return next_run, previous_run
 
     @cache.memoize()
-    def get_run(self, release_name, release_number, test_name):
+    def get_run(self):
         run = (
             models.Run.query
             .join(models.Release)
-            .filter(models.Release.name == release_name)
-            .filter(models.Release.number == release_number)
-            .filter(models.Run.name == test_name)
+            .filter(models.Release.name == self.release_name)
+            .filter(models.Release.number == self.release_number)
+            .filter(models.Run.name == self.run_name)
             .first())
         if not run:
             return None, None, None, None
@@ -362,6 +430,30 @@ class BuildOps(BaseOps):
         return run, next_run, previous_run, approval_log
 
 
+class TaskOps(BaseOps):
+    """Cacheable operations for the work queue tasks of a single run.
+
+    Kept separate from RunOps so task heartbeats do not evict any release
+    or run pages.
+    """
+
+    def __init__(self, run_id):
+        self.run_id = run_id
+        self.cache_key = 'caching.TaskOps(run_id=%r)' % run_id
+
+    @cache.memoize()
+    def get_tasks(self):
+        task_list = (
+            work_queue.WorkQueue.query
+            .filter_by(run_id=self.run_id)
+            .order_by(work_queue.WorkQueue.created)
+            .all())
+
+        for task in task_list:
+            db.session.expunge(task)
+
+        return task_list
+
 
 # Connect Frontend and API events to cache eviction.
 
@@ -373,16 +465,20 @@ def _evict_build_cache(sender, build=None, release=None, run=None):
     BuildOps(build.id).evict()
 
 
+def _evict_release_cache(sender, build=None, release=None, run=None):
+    # Only the candidate list and this release (including its runs) depend
+    # on the run, so leave every other release in the build cached.
+    CandidateListOps(build.id).evict()
+    ReleaseOps(build.id, release.name, release.number).evict()
+
+
 def _evict_task_cache(sender, task=None):
     if not task.run_id:
         return
-    run = models.Run.query.get(task.run_id)
-    # Update the modification time on the run, since the task status changed.
-    db.session.add(run)
-    BuildOps(run.release.build_id).evict()
+    TaskOps(task.run_id).evict()
 
 
 signals.build_updated.connect(_evict_user_cache, app)
 signals.release_updated_via_api.connect(_evict_build_cache, app)
-signals.run_updated_via_api.connect(_evict_build_cache, app)
+signals.run_updated_via_api.connect(_evict_release_cache, app)
 signals.task_updated.connect(_evict_task_cache, app)
@@ -15,12 +15,17 @@
 
 """Pull-queue API."""
 
+import collections
 import datetime
 import json
 import logging
 import time
 import uuid
 
+# Local libraries
+from flask.ext.sqlalchemy import SignallingSession
+from sqlalchemy import event
+
 # Local modules
 from . import app
 from . import db
@@ -47,6 +52,8 @@ class WorkQueue(db.Model):
     - By task_id for finishing a task or extending a lease.
     - By Index(queue_name, status, eta) for finding the oldest task for a queue
         that is still pending.
+    - By Index(queue_name, status, release_id, eta) for finding the oldest
+        pending tasks in the same release, for leasing them as a group.
     - By Index(status, create) for finding old tasks that should be deleted
         from the table periodically to free up space.
     """
@@ -84,6 +91,8 @@ class WorkQueue(db.Model):
     __table_args__ = (
         db.Index('created_index', 'queue_name', 'status', 'created'),
         db.Index('lease_index', 'queue_name', 'status', 'eta'),
+        db.Index('release_lease_index',
+                 'queue_name', 'status', 'release_id', 'eta'),
         db.Index('reap_index', 'status', 'created'),
     )
 
@@ -97,6 +106,249 @@ class WorkQueue(db.Model):
         return now < self.eta
 
 
+class WorkQueueStats(db.Model):
+    """Materialized counters and watermarks for each queue and status.
+
+    Maintained incrementally by add, lease, finish and cancel so the queue
+    dashboard doesn't need to aggregate over the whole WorkQueue table.
+    A marker row with queue_name STATS_MARKER_QUEUE records when the
+    counters were last rebuilt from scratch.
+
+    Queries:
+    - All rows, for rendering the queue dashboard.
+    - By (queue_name, status) for updating the counters.
+    """
+
+    queue_name = db.Column(db.String(100), primary_key=True, nullable=False)
+    status = db.Column(db.String(20), primary_key=True, nullable=False)
+    count = db.Column(db.Integer, default=0, nullable=False)
+    newest_created = db.Column(db.DateTime)
+    oldest_eta = db.Column(db.DateTime)
+
+
+class WorkQueueRate(db.Model):
+    """Per-minute activity counters for a queue, used for computing rates.
+
+    Each queue has a fixed ring of RATE_SLOTS rows, one per minute, that
+    are reused once their minute has passed. The table never grows beyond
+    RATE_SLOTS rows per queue and rows are only inserted the first time a
+    slot is used.
+
+    Queries:
+    - By minute for all slots in a recent window.
+    - By (queue_name, slot) for updating the counters.
+    """
+
+    queue_name = db.Column(db.String(100), primary_key=True, nullable=False)
+    slot = db.Column(db.Integer, primary_key=True, nullable=False)
+    minute = db.Column(db.DateTime, nullable=False)
+    added = db.Column(db.Integer, default=0, nullable=False)
+    leased = db.Column(db.Integer, default=0, nullable=False)
+    finished = db.Column(db.Integer, default=0, nullable=False)
+    errors = db.Column(db.Integer, default=0, nullable=False)
+
+    # Total seconds between tasks becoming available and being leased.
+    lease_latency_seconds = db.Column(db.Float, default=0, nullable=False)
+
+    COUNTERS = ('added', 'leased', 'finished', 'errors',
+                'lease_latency_seconds')
+
+
+# Number of minutes of history kept for each queue in WorkQueueRate.
+RATE_SLOTS = 60
+
+# Primary key of the WorkQueueStats marker row written by rebuild_stats.
+STATS_MARKER_QUEUE = '__stats__'
+STATS_MARKER_STATUS = 'rebuilt'
+
+# Key in the session's info dictionary for the pending _StatsUpdate.
+_STATS_KEY = 'work_queue_stats'
+
+
+def _increment(model, key_dict, delta_dict, value_dict=None):
+    """Atomically adds deltas to a counter row, creating it if needed.
+
+    The row is created with an insert that does nothing if a concurrent
+    transaction created the same row first, and the deltas are then added
+    to whichever row won.
+
+    Args:
+        model: WorkQueueStats or WorkQueueRate.
+        key_dict: Primary key columns of the row to update.
+        delta_dict: Maps counter column names to the amount to add.
+        value_dict: Optional. Maps column names to values to overwrite.
+    """
+    value_dict = value_dict or {}
+    update_dict = dict(value_dict)
+    for name, delta in delta_dict.iteritems():
+        update_dict[name] = getattr(model, name) + delta
+
+    query = model.query.filter_by(**key_dict)
+    if query.update(update_dict, synchronize_session='evaluate'):
+        return
+
+    row_dict = dict(key_dict)
+    row_dict.update(value_dict)
+    for name in delta_dict:
+        row_dict[name] = 0
+    db.session.execute(
+        model.__table__.insert()
+        .prefix_with('OR IGNORE', dialect='sqlite')
+        .prefix_with('IGNORE', dialect='mysql')
+        .values(**row_dict))
+    query.update(update_dict, synchronize_session='evaluate')
+
+
+class _StatsUpdate(object):
+    """Accumulates changes to the materialized queue statistics.
+
+    Use _get_stats() instead of creating this directly. The changes are
+    applied when the transaction commits; watermarks are recomputed with
+    index seeks at that point.
+    """
+
+    def __init__(self):
+        self.counts = collections.defaultdict(int)
+        self.rates = collections.defaultdict(
+            lambda: collections.defaultdict(int))
+
+    def move(self, queue_name, old_status, new_status):
+        """Records a task moving from old_status to new_status.
+
+        Either status may be None for tasks that are created or deleted.
+        Moving to the same status refreshes the watermarks only.
+        """
+        if old_status:
+            self.counts[(queue_name, old_status)] -= 1
+        if new_status:
+            self.counts[(queue_name, new_status)] += 1
+
+    def rate(self, queue_name, **delta_dict):
+        """Records activity for the current per-minute rate bucket."""
+        for name, delta in delta_dict.iteritems():
+            self.rates[queue_name][name] += delta
+
+    def apply(self):
+        """Writes all accumulated changes to the database."""
+        for (queue_name, status), delta in self.counts.iteritems():
+            # Separate queries so each is a single seek on created_index
+            # and lease_index respectively.
+            newest_created = (
+                db.session.query(db.func.max(WorkQueue.created))
+                .filter_by(queue_name=queue_name, status=status)
+                .scalar())
+            oldest_eta = (
+                db.session.query(db.func.min(WorkQueue.eta))
+                .filter_by(queue_name=queue_name, status=status)
+                .scalar())
+            _increment(
+                WorkQueueStats,
+                dict(queue_name=queue_name, status=status),
+                dict(count=delta),
+                dict(newest_created=newest_created, oldest_eta=oldest_eta))
+
+        if not self.rates:
+            return
+
+        minute = datetime.datetime.utcnow().replace(second=0, microsecond=0)
+        slot = (minute.hour * 60 + minute.minute) % RATE_SLOTS
+        reset_dict = dict((name, 0) for name in WorkQueueRate.COUNTERS)
+        reset_dict['minute'] = minute
+
+        for queue_name, delta_dict in self.rates.iteritems():
+            # Clear out the slot if it still holds an older minute.
+            (WorkQueueRate.query
+             .filter_by(queue_name=queue_name, slot=slot)
+             .filter(WorkQueueRate.minute != minute)
+             .update(reset_dict, synchronize_session='evaluate'))
+            _increment(
+                WorkQueueRate,
+                dict(queue_name=queue_name, slot=slot),
+                delta_dict,
+                dict(minute=minute))
+
+
+def _get_stats():
+    """Returns the _StatsUpdate for the current transaction.
+
+    Every work queue call in the same transaction shares one _StatsUpdate,
+    so a request that adds or finishes many tasks updates each counter row
+    once, right before committing. That keeps the row locks on the shared
+    counters held for as short a time as possible.
+    """
+    info = db.session().info
+    stats = info.get(_STATS_KEY)
+    if stats is None:
+        stats = info[_STATS_KEY] = _StatsUpdate()
+    return stats
+
+
+@event.listens_for(SignallingSession, 'before_commit')
+def _apply_stats(session):
+    """Writes the pending statistics changes before a commit."""
+    stats = session.info.pop(_STATS_KEY, None)
+    if stats is not None:
+        stats.apply()
+
+
+@event.listens_for(SignallingSession, 'after_rollback')
+def _discard_stats(session):
+    """Drops the pending statistics changes of a rolled back transaction."""
+    session.info.pop(_STATS_KEY, None)
+
+
+def rebuild_stats():
+    """Recomputes all materialized queue counters from the WorkQueue table.
+
+    This aggregates over the whole table, so it should only be used to
+    backfill the counters for an existing deployment or to repair them.
+    """
+    # The rebuild already sees every change made in this transaction.
+    db.session().info.pop(_STATS_KEY, None)
+
+    WorkQueueStats.query.delete(synchronize_session='evaluate')
+
+    stats_list = (
+        db.session.query(
+            WorkQueue.queue_name,
+            WorkQueue.status,
+            db.func.count(WorkQueue.task_id),
+            db.func.max(WorkQueue.created),
+            db.func.min(WorkQueue.eta))
+        .group_by(WorkQueue.queue_name, WorkQueue.status))
+
+    for queue_name, status, count, newest_created, oldest_eta in stats_list:
+        db.session.add(WorkQueueStats(
+            queue_name=queue_name,
+            status=status,
+            count=count,
+            newest_created=newest_created,
+            oldest_eta=oldest_eta))
+
+    db.session.add(WorkQueueStats(
+        queue_name=STATS_MARKER_QUEUE,
+        status=STATS_MARKER_STATUS,
+        count=0,
+        newest_created=datetime.datetime.utcnow()))
+
+
+def ensure_stats():
+    """Rebuilds the queue counters if they have never been rebuilt before.
+
+    Run this once when the server starts, so deployments that predate the
+    WorkQueueStats table count the tasks that already exist.
+
+    Returns:
+        True if the counters were rebuilt, False otherwise.
+    """
+    marker = WorkQueueStats.query.get(
+        (STATS_MARKER_QUEUE, STATS_MARKER_STATUS))
+    if marker:
+        return False
+    rebuild_stats()
+    return True
+
+
 def add(queue_name, payload=None, content_type=None, source=None, task_id=None,
         build_id=None, release_id=None, run_id=None):
     """Adds a work item to a queue.
@@ -142,6 +394,10 @@ def add(queue_name, payload=None, content_type=None, source=None, task_id=None,
         content_type=content_type)
     db.session.add(task)
 
+    stats = _get_stats()
+    stats.move(queue_name, None, WorkQueue.LIVE)
+    stats.rate(queue_name, added=1)
+
     return task.task_id
 
 
@@ -164,6 +420,7 @@ def _task_to_dict(task):
         eta=_datetime_to_epoch_seconds(task.eta),
         source=task.source,
         created=_datetime_to_epoch_seconds(task.created),
+        release_id=task.release_id,
         lease_attempts=task.lease_attempts,
         last_lease=_datetime_to_epoch_seconds(task.last_lease),
         payload=payload,
@@ -174,7 +431,8 @@ def _task_to_dict(task):
 # would let users run their own workers for server-side capture queues.
 
 
-def lease(queue_name, owner, count=1, timeout_seconds=60):
+def lease(queue_name, owner, count=1, timeout_seconds=60,
+          group_by_release=False):
     """Leases a work item from a queue, usually the oldest task available.
 
     Args:
@@ -184,6 +442,9 @@ def lease(queue_name, owner, count=1, timeout_seconds=60):
             than this many items present.
         timeout_seconds: Number of seconds to lock the task for before
             allowing another owner to lease it.
+        group_by_release: When True, only lease tasks from the same release
+            as the oldest task available, so a worker can share the work
+            they have in common.
 
     Returns:
         List of dictionaries representing the task that was leased, or
@@ -195,16 +456,26 @@ def lease(queue_name, owner, count=1, timeout_seconds=60):
         .filter_by(queue_name=queue_name, status=WorkQueue.LIVE)
         .filter(WorkQueue.eta <= now)
         .order_by(WorkQueue.eta)
-        .with_lockmode('update')
-        .limit(count))
+        .with_lockmode('update'))
+
+    if group_by_release:
+        first_task = query.first()
+        if first_task and first_task.release_id is not None:
+            query = query.filter_by(release_id=first_task.release_id)
 
-    task_list = query.all()
+    task_list = query.limit(count).all()
     if not task_list:
         return None
 
     next_eta = now + datetime.timedelta(seconds=timeout_seconds)
 
+    stats = _get_stats()
+    # Refresh the oldest ETA watermark since leasing pushes out the ETA.
+    stats.move(queue_name, WorkQueue.LIVE, WorkQueue.LIVE)
+
     for task in task_list:
+        latency = max(0, (now - task.eta).total_seconds())
+        stats.rate(queue_name, leased=1, lease_latency_seconds=latency)
         task.eta = next_eta
         task.lease_attempts += 1
         task.last_owner = owner
@@ -216,6 +487,34 @@ def lease(queue_name, owner, count=1, timeout_seconds=60):
     return [_task_to_dict(task) for task in task_list]
 
 
+def _check_task_policy(task, task_id, owner, now):
+    """Enforces the ownership policy for a task that was already fetched.
+
+    Args:
+        task: WorkQueue task to check, or None if it could not be found.
+        task_id: ID of the task being checked.
+        owner: Who or what has the current lease on the task.
+        now: Current time as a datetime.datetime.
+
+    Raises:
+        TaskDoesNotExistError if the task does not exist.
+        LeaseExpiredError if the lease is no longer active.
+        NotOwnerError if the specified owner no longer owns the task.
+    """
+    if not task:
+        raise TaskDoesNotExistError('task_id=%r' % task_id)
+
+    # Lease delta should be positive, meaning it has not yet expired!
+    lease_delta = now - task.eta
+    if lease_delta > datetime.timedelta(0):
+        raise LeaseExpiredError('queue=%r, task_id=%r expired %s' % (
+                                task.queue_name, task_id, lease_delta))
+
+    if task.last_owner != owner:
+        raise NotOwnerError('queue=%r, task_id=%r, owner=%r' % (
+                            task.queue_name, task_id, task.last_owner))
+
+
 def _get_task_with_policy(queue_name, task_id, owner):
     """Fetches the specified task and enforces ownership policy.
 
@@ -238,24 +537,78 @@ def _get_task_with_policy(queue_name, task_id, owner):
         .filter_by(queue_name=queue_name, task_id=task_id)
         .with_lockmode('update')
         .first())
-    if not task:
-        raise TaskDoesNotExistError('task_id=%r' % task_id)
-
-    # Lease delta should be positive, meaning it has not yet expired!
-    lease_delta = now - task.eta
-    if lease_delta > datetime.timedelta(0):
-        db.session.rollback()
-        raise LeaseExpiredError('queue=%r, task_id=%r expired %s' % (
-                                task.queue_name, task_id, lease_delta))
 
-    if task.last_owner != owner:
+    try:
+        _check_task_policy(task, task_id, owner, now)
+    except (LeaseExpiredError, NotOwnerError):
         db.session.rollback()
-        raise NotOwnerError('queue=%r, task_id=%r, owner=%r' % (
-                            task.queue_name, task_id, task.last_owner))
+        raise
 
     return task
 
 
+def _get_tasks_with_policy(queue_name, task_id_list, owner):
+    """Fetches many tasks with a single locking query and enforces policy.
+
+    Unlike _get_task_with_policy, a policy violation for one task does not
+    roll back the transaction, so the remaining tasks can still be updated.
+
+    Args:
+        queue_name: Name of the queue the work items are on.
+        task_id_list: IDs of the tasks to fetch.
+        owner: Who or what has the current lease on the tasks.
+
+    Returns:
+        Tuple (task_dict, error_dict) where task_dict maps task IDs to valid
+        WorkQueue tasks that are currently owned, and error_dict maps task
+        IDs to the Error that was encountered for each invalid task.
+    """
+    now = datetime.datetime.utcnow()
+    task_id_set = set(task_id_list)
+    found_dict = {}
+    if task_id_set:
+        found_dict = dict(
+            (task.task_id, task) for task in (
+                WorkQueue.query
+                .filter_by(queue_name=queue_name)
+                .filter(WorkQueue.task_id.in_(task_id_set))
+                .with_lockmode('update')))
+
+    task_dict = {}
+    error_dict = {}
+    for task_id in task_id_set:
+        task = found_dict.get(task_id)
+        try:
+            _check_task_policy(task, task_id, owner, now)
+        except Error, e:
+            error_dict[task_id] = e
+        else:
+            task_dict[task_id] = task
+
+    return task_dict, error_dict
+
+
+def _apply_heartbeat(task, message, index):
+    """Saves a heartbeat message on a task that has passed policy checks."""
+    if task.heartbeat_number > index:
+        return False
+
+    task.heartbeat = message
+    task.heartbeat_number = index
+
+    # Extend the lease by the time of the last lease.
+    now = datetime.datetime.utcnow()
+    timeout_delta = task.eta - task.last_lease
+    task.eta = now + timeout_delta
+    task.last_lease = now
+
+    db.session.add(task)
+
+    signals.task_updated.send(app, task=task)
+
+    return True
+
+
 def heartbeat(queue_name, task_id, owner, message, index):
     """Sets the heartbeat status of the task and extends its lease.
 
@@ -284,18 +637,60 @@ def heartbeat(queue_name, task_id, owner, message, index):
         NotOwnerError if the specified owner no longer owns the task.
     """
     task = _get_task_with_policy(queue_name, task_id, owner)
-    if task.heartbeat_number > index:
-        return False
+    return _apply_heartbeat(task, message, index)
 
-    task.heartbeat = message
-    task.heartbeat_number = index
 
-    # Extend the lease by the time of the last lease.
-    now = datetime.datetime.utcnow()
-    timeout_delta = task.eta - task.last_lease
-    task.eta = now + timeout_delta
-    task.last_lease = now
+def heartbeat_many(queue_name, owner, heartbeat_list):
+    """Sets the heartbeat status of many tasks in a single transaction.
+
+    Args:
+        queue_name: Name of the queue the work items are on.
+        owner: Who or what has the current lease on the tasks.
+        heartbeat_list: List of (task_id, message, index) tuples, with the
+            same meaning as the arguments to heartbeat(). When the same
+            task_id appears more than once, the highest index wins.
+
+    Returns:
+        Dictionary mapping task IDs to the Error encountered for each
+        heartbeat that could not be applied. Empty if all were applied.
+    """
+    latest = {}
+    for task_id, message, index in heartbeat_list:
+        current = latest.get(task_id)
+        if current is None or current[1] <= index:
+            latest[task_id] = (message, index)
+
+    task_dict, error_dict = _get_tasks_with_policy(
+        queue_name, latest.keys(), owner)
+
+    for task_id, task in task_dict.iteritems():
+        message, index = latest[task_id]
+        _apply_heartbeat(task, message, index)
+
+    return error_dict
+
+
+def _apply_finish(task, error, stats):
+    """Finishes a task that has passed policy checks.
+
+    Changes to the queue statistics are recorded in stats.
+    """
+    if not task.status == WorkQueue.LIVE:
+        logging.warning('Finishing already dead task. queue=%r, task_id=%r, '
+                        'owner=%r, status=%r',
+                        task.queue_name, task.task_id, task.last_owner,
+                        task.status)
+        return False
+
+    if not error:
+        task.status = WorkQueue.DONE
+        stats.rate(task.queue_name, finished=1)
+    else:
+        task.status = WorkQueue.ERROR
+        stats.rate(task.queue_name, errors=1)
 
+    stats.move(task.queue_name, WorkQueue.LIVE, task.status)
+    task.finished = datetime.datetime.utcnow()
     db.session.add(task)
 
     signals.task_updated.send(app, task=task)
@@ -322,24 +717,68 @@ def finish(queue_name, task_id, owner, error=False):
         NotOwnerError if the specified owner no longer owns the task.
     """
     task = _get_task_with_policy(queue_name, task_id, owner)
+    return _apply_finish(task, error, _get_stats())
 
-    if not task.status == WorkQueue.LIVE:
-        logging.warning('Finishing already dead task. queue=%r, task_id=%r, '
-                        'owner=%r, status=%r',
-                        task.queue_name, task_id, owner, task.status)
-        return False
 
-    if not error:
-        task.status = WorkQueue.DONE
-    else:
-        task.status = WorkQueue.ERROR
+def finish_many(queue_name, owner, finish_list):
+    """Marks many work items on a queue as finished in a single transaction.
 
-    task.finished = datetime.datetime.utcnow()
-    db.session.add(task)
+    Args:
+        queue_name: Name of the queue the work items are on.
+        owner: Who or what has the current lease on the tasks.
+        finish_list: List of (task_id, error) tuples, with the same meaning
+            as the arguments to finish().
 
-    signals.task_updated.send(app, task=task)
+    Returns:
+        Dictionary mapping task IDs to the Error encountered for each
+        task that could not be finished. Empty if all were finished.
+    """
+    error_by_task = dict(finish_list)
+    task_dict, error_dict = _get_tasks_with_policy(
+        queue_name, error_by_task.keys(), owner)
+
+    stats = _get_stats()
+    for task_id, task in task_dict.iteritems():
+        _apply_finish(task, error_by_task[task_id], stats)
+
+    return error_dict
 
-    return True
+
+def release_many(queue_name, owner, task_id_list):
+    """Gives up leases on tasks that were never started.
+
+    The tasks become available to lease again immediately, and the lease
+    attempts used to fetch them are not counted against them.
+
+    Args:
+        queue_name: Name of the queue the work items are on.
+        owner: Who or what has the current lease on the tasks.
+        task_id_list: IDs of the tasks to release.
+
+    Returns:
+        Dictionary mapping task IDs to the Error encountered for each
+        task that could not be released. Empty if all were released.
+    """
+    task_dict, error_dict = _get_tasks_with_policy(
+        queue_name, task_id_list, owner)
+
+    now = datetime.datetime.utcnow()
+    stats = _get_stats()
+    # Refresh the oldest ETA watermark since the ETAs move back to now.
+    stats.move(queue_name, WorkQueue.LIVE, WorkQueue.LIVE)
+
+    for task in task_dict.itervalues():
+        if task.status != WorkQueue.LIVE:
+            continue
+        task.eta = now
+        task.lease_attempts = max(0, task.lease_attempts - 1)
+        task.last_owner = None
+        task.heartbeat = None
+        task.heartbeat_number = 0
+        db.session.add(task)
+        signals.task_updated.send(app, task=task)
+
+    return error_dict
 
 
 def _query(queue_name=None, build_id=None, release_id=None, run_id=None,
@@ -417,8 +856,35 @@ def cancel(**kwargs):
         The number of tasks that were canceled.
     """
     task_list = _query(**kwargs)
+    stats = _get_stats()
     for task in task_list:
+        stats.move(task.queue_name, task.status, WorkQueue.CANCELED)
         task.status = WorkQueue.CANCELED
         task.finished = datetime.datetime.utcnow()
         db.session.add(task)
     return len(task_list)
+
+
+def retry(task):
+    """Makes a task live again so it can be leased with a fresh attempt count.
+
+    Args:
+        task: WorkQueue task to retry.
+    """
+    stats = _get_stats()
+    stats.move(task.queue_name, task.status, WorkQueue.LIVE)
+    task.status = WorkQueue.LIVE
+    task.lease_attempts = 0
+    task.heartbeat = 'Retrying ...'
+    db.session.add(task)
+
+
+def delete(task):
+    """Deletes a task from its queue.
+
+    Args:
+        task: WorkQueue task to delete.
+    """
+    stats = _get_stats()
+    stats.move(task.queue_name, task.status, None)
+    db.session.delete(task)
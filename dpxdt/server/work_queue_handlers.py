@@ -15,12 +15,13 @@
 
 """Pull-queue web handlers."""
 
+import datetime
+import json
 import logging
 
 # Local libraries
 import flask
-from flask import Flask, redirect, render_template, request, url_for
-from sqlalchemy import func
+from flask import Flask, abort, redirect, render_template, request, url_for
 
 # Local modules
 from . import app
@@ -64,7 +65,9 @@ def handle_lease(queue_name):
             queue_name,
             owner,
             request.form.get('count', 1, type=int),
-            request.form.get('timeout', 60, type=int))
+            request.form.get('timeout', 60, type=int),
+            group_by_release=bool(
+                request.form.get('group_by_release', type=str)))
     except work_queue.Error, e:
         return utils.jsonify_error(e)
 
@@ -121,54 +124,170 @@ def handle_finish(queue_name):
     return flask.jsonify(success=True)
 
 
-@app.route('/api/work_queue')
+def _get_task_list_param():
+    """Gets the JSON list of task updates from the current request."""
+    try:
+        task_list = json.loads(request.form.get('tasks', '[]', type=str))
+    except ValueError, e:
+        abort(utils.jsonify_error(e))
+
+    utils.jsonify_assert(isinstance(task_list, list), 'tasks must be a list')
+    for task in task_list:
+        utils.jsonify_assert(
+            isinstance(task, dict) and task.get('task_id'),
+            'each task requires a task_id')
+
+    return task_list
+
+
+def _jsonify_task_errors(error_dict):
+    """Returns a JSON response describing the results of a batch update."""
+    errors = dict(
+        (task_id, '%s: %s' % (e.__class__.__name__, e))
+        for task_id, e in error_dict.iteritems())
+    return flask.jsonify(success=True, errors=errors)
+
+
+@app.route('/api/work_queue/<string:queue_name>/heartbeat_batch',
+           methods=['POST'])
+@auth.superuser_api_key_required
+@utils.retryable_transaction()
+def handle_heartbeat_batch(queue_name):
+    """Updates the heartbeat messages for many tasks at once."""
+    owner = request.form.get('owner', request.remote_addr, type=str)
+    task_list = _get_task_list_param()
+    heartbeat_list = [
+        (task['task_id'], task.get('message'), int(task.get('index', 0)))
+        for task in task_list]
+
+    error_dict = work_queue.heartbeat_many(queue_name, owner, heartbeat_list)
+
+    db.session.commit()
+    logging.debug('Task heartbeat batch: queue=%r, count=%d, errors=%d',
+                  queue_name, len(heartbeat_list), len(error_dict))
+    return _jsonify_task_errors(error_dict)
+
+
+@app.route('/api/work_queue/<string:queue_name>/finish_batch',
+           methods=['POST'])
+@auth.superuser_api_key_required
+@utils.retryable_transaction()
+def handle_finish_batch(queue_name):
+    """Marks many tasks on a queue as finished at once."""
+    owner = request.form.get('owner', request.remote_addr, type=str)
+    task_list = _get_task_list_param()
+    finish_list = [
+        (task['task_id'], bool(task.get('error')))
+        for task in task_list]
+
+    error_dict = work_queue.finish_many(queue_name, owner, finish_list)
+
+    db.session.commit()
+    logging.debug('Task finish batch: queue=%r, count=%d, errors=%d, '
+                  'owner=%r', queue_name, len(finish_list), len(error_dict),
+                  owner)
+    return _jsonify_task_errors(error_dict)
+
+
+@app.route('/api/work_queue/<string:queue_name>/release_batch',
+           methods=['POST'])
+@auth.superuser_api_key_required
+@utils.retryable_transaction()
+def handle_release_batch(queue_name):
+    """Gives up leases on many unstarted tasks so others can lease them."""
+    owner = request.form.get('owner', request.remote_addr, type=str)
+    task_list = _get_task_list_param()
+    task_id_list = [task['task_id'] for task in task_list]
+
+    error_dict = work_queue.release_many(queue_name, owner, task_id_list)
+
+    db.session.commit()
+    logging.debug('Task release batch: queue=%r, count=%d, errors=%d, '
+                  'owner=%r', queue_name, len(task_id_list), len(error_dict),
+                  owner)
+    return _jsonify_task_errors(error_dict)
+
+
+@app.route('/api/work_queue', methods=['GET', 'POST'])
 @auth.superuser_required
 def view_all_work_queues():
     """Page for viewing the index of all active work queues."""
-    count_list = list(
-        db.session.query(
-            work_queue.WorkQueue.queue_name,
-            work_queue.WorkQueue.status,
-            func.count(work_queue.WorkQueue.task_id))
-        .group_by(work_queue.WorkQueue.queue_name,
-                  work_queue.WorkQueue.status))
-
-    queue_dict = {}
-    for name, status, count in count_list:
-        queue_dict[(name, status)] = dict(
-            name=name, status=status, count=count)
-
-    max_created_list = list(
-        db.session.query(
-            work_queue.WorkQueue.queue_name,
-            work_queue.WorkQueue.status,
-            func.max(work_queue.WorkQueue.created))
-        .group_by(work_queue.WorkQueue.queue_name,
-                  work_queue.WorkQueue.status))
-
-    for name, status, newest_created in max_created_list:
-        queue_dict[(name, status)]['newest_created'] = newest_created
-
-    min_eta_list = list(
-        db.session.query(
-            work_queue.WorkQueue.queue_name,
-            work_queue.WorkQueue.status,
-            func.min(work_queue.WorkQueue.eta))
-        .group_by(work_queue.WorkQueue.queue_name,
-                  work_queue.WorkQueue.status))
-
-    for name, status, oldest_eta in min_eta_list:
-        queue_dict[(name, status)]['oldest_eta'] = oldest_eta
-
-    queue_list = list(queue_dict.values())
+    rebuild_form = forms.RebuildWorkQueueStatsForm()
+    if rebuild_form.validate_on_submit():
+        logging.info('Action: rebuild work queue counters')
+        work_queue.rebuild_stats()
+        db.session.commit()
+        return redirect(url_for('view_all_work_queues'))
+
+    last_rebuilt = None
+    queue_list = []
+    for stats in work_queue.WorkQueueStats.query.all():
+        if stats.queue_name == work_queue.STATS_MARKER_QUEUE:
+            last_rebuilt = stats.newest_created
+            continue
+        if not stats.count:
+            continue
+        queue_list.append(dict(
+            name=stats.queue_name,
+            status=stats.status,
+            count=stats.count,
+            newest_created=stats.newest_created,
+            oldest_eta=stats.oldest_eta))
     queue_list.sort(key=lambda x: (x['name'], x['status']))
 
     context = dict(
         queue_list=queue_list,
+        rate_list=_get_queue_rates(),
+        last_rebuilt=last_rebuilt,
+        rebuild_form=rebuild_form,
     )
     return render_template('view_work_queue_index.html', **context)
 
 
+# Windows in minutes for the rates shown on the work queue index.
+RATE_WINDOWS = (5, 60)
+
+
+def _get_queue_rates():
+    """Returns per-queue throughput and lease latency over recent windows."""
+    now = datetime.datetime.utcnow()
+    since = now - datetime.timedelta(minutes=max(RATE_WINDOWS))
+    rate_list = (
+        work_queue.WorkQueueRate.query
+        .filter(work_queue.WorkQueueRate.minute >= since)
+        .all())
+
+    totals = {}
+    for rate in rate_list:
+        age_minutes = (now - rate.minute).total_seconds() / 60
+        for window in RATE_WINDOWS:
+            if age_minutes >= window:
+                continue
+            key = (rate.queue_name, window)
+            total = totals.setdefault(key, dict(
+                added=0, leased=0, finished=0, errors=0, latency=0.0))
+            total['added'] += rate.added
+            total['leased'] += rate.leased
+            total['finished'] += rate.finished
+            total['errors'] += rate.errors
+            total['latency'] += rate.lease_latency_seconds
+
+    result = []
+    for (name, window), total in sorted(totals.iteritems()):
+        mean_latency = None
+        if total['leased']:
+            mean_latency = total['latency'] / total['leased']
+        result.append(dict(
+            name=name,
+            window=window,
+            added_per_minute=float(total['added']) / window,
+            finished_per_minute=float(total['finished']) / window,
+            errors_per_minute=float(total['errors']) / window,
+            mean_lease_latency=mean_latency))
+
+    return result
+
+
 @app.route('/api/work_queue/<string:queue_name>', methods=['GET', 'POST'])
 @auth.superuser_required
 def manage_work_queue(queue_name):
@@ -181,12 +300,9 @@ def manage_work_queue(queue_name):
             logging.info('Action: %s task_id=%r',
                          modify_form.action.data, modify_form.task_id.data)
             if modify_form.action.data == 'retry':
-                task.status = work_queue.WorkQueue.LIVE
-                task.lease_attempts = 0
-                task.heartbeat = 'Retrying ...'
-                db.session.add(task)
+                work_queue.retry(task)
             else:
-                db.session.delete(task)
+                work_queue.delete(task)
             db.session.commit()
         else:
             logging.warning('Could not find task_id=%r to delete',
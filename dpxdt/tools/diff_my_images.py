@@ -102,7 +102,7 @@ class RunTest(workers.WorkflowItem):
     """
 
     def run(self, build_id, release_name, release_number, test, heartbeat=None):
-        ref_image, ref_log, ref_url = None, None, None
+        ref_image, ref_log, ref_url, ref_mask = None, None, None, None
         try:
             last_good = yield release_worker.FindRunWorkflow(
                 build_id, test.name)
@@ -112,6 +112,7 @@ class RunTest(workers.WorkflowItem):
             ref_image = last_good['image'] or None
             ref_log = last_good['log'] or None
             ref_url = last_good['url'] or None
+            ref_mask = last_good.get('mask') or None
 
         yield heartbeat('Uploading data for %s' % test.name)
         yield release_worker.ReportRunWorkflow(
@@ -125,6 +126,7 @@ class RunTest(workers.WorkflowItem):
             ref_image=ref_image,
             ref_log=ref_log,
             ref_url=ref_url,
+            ref_mask=ref_mask,
             run_failed=test.run_failed)
 
 
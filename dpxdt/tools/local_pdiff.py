@@ -492,6 +492,7 @@ def main(argv):
         logging.getLogger().setLevel(logging.DEBUG)
 
     coordinator = workers.get_coordinator()
+    process_worker.register(coordinator)
     timer_worker.register(coordinator)
 
     global FAILED_TESTS
@@ -33,6 +33,7 @@ FLAGS = gflags.FLAGS
 from dpxdt.client import capture_worker
 from dpxdt.client import fetch_worker
 from dpxdt.client import pdiff_worker
+from dpxdt.client import process_worker
 from dpxdt.client import timer_worker
 from dpxdt.client import workers
 from dpxdt import server
@@ -61,16 +62,28 @@ gflags.DEFINE_string('host', '0.0.0.0', 'Host argument for the server.')
 
 
 def run_workers():
+    # Fork worker processes before registering workers starts any threads.
+    capture_worker.start_processes()
+    pdiff_worker.start_processes()
+
     coordinator = workers.get_coordinator()
     capture_worker.register(coordinator)
     fetch_worker.register(coordinator)
     pdiff_worker.register(coordinator)
+    process_worker.register(coordinator)
     timer_worker.register(coordinator)
     coordinator.start()
     logging.info('Workers started')
     return coordinator
 
 
+def rebuild_queue_stats():
+    """Backfills the work queue counters the first time a server starts."""
+    if server.work_queue.ensure_stats():
+        logging.info('Rebuilt work queue counters')
+    server.db.session.commit()
+
+
 def main(block=True):
     if FLAGS.verbose:
         logging.getLogger().setLevel(logging.DEBUG)
@@ -85,6 +98,9 @@ def main(block=True):
     if FLAGS.verbose_workers:
         logging.getLogger('dpxdt.client.workers').setLevel(logging.DEBUG)
 
+    if FLAGS.enable_api_server:
+        rebuild_queue_stats()
+
     if FLAGS.enable_queue_workers:
         coordinator = run_workers()
 
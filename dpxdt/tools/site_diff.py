@@ -30,7 +30,10 @@ Example usage:
 
 import HTMLParser
 import Queue
+import collections
 import datetime
+import heapq
+import itertools
 import json
 import logging
 import os
@@ -63,6 +66,17 @@ gflags.DEFINE_bool(
     'keep_query_string', False,
     'Keep the query string when cleaning URLs')
 
+gflags.DEFINE_integer(
+    'crawl_max_inflight', 10,
+    'Most pages to fetch at once while crawling. New pages are fetched as '
+    'soon as the pages linking to them are parsed. Set --fetch_threads at '
+    'least this high so they can all be fetched in parallel.')
+
+gflags.DEFINE_integer(
+    'crawl_max_inflight_per_host', 4,
+    'Most pages to fetch at once from any one host while crawling, to '
+    'avoid overloading it.')
+
 
 # URL regex rewriting code originally from mirrorrr
 # http://code.google.com/p/mirrorrr/source/browse/trunk/transform_content.py
@@ -198,6 +212,100 @@ def prune_urls(url_set, start_url, allowed_list, ignored_list):
     return result
 
 
+class CrawlFrontier(object):
+    """URLs waiting to be crawled, fetched in order of depth.
+
+    A URL's depth is the fewest clicks from the start URL, the same as a
+    crawl that fetches one depth at a time, even when a longer path to it
+    is found first. URLs deeper than max_depth are remembered but never
+    fetched, unless a shorter path to them turns up.
+
+    Args:
+        max_depth: Deepest URLs to fetch, or -1 for no limit.
+        max_inflight: Most URLs to fetch at once.
+        max_inflight_per_host: Most URLs to fetch at once from one host.
+    """
+
+    def __init__(self, max_depth, max_inflight, max_inflight_per_host):
+        self.max_depth = max_depth
+        self.max_inflight = max_inflight
+        self.max_inflight_per_host = max_inflight_per_host
+        # Maps URL to its depth.
+        self.depths = {}
+        # Maps a fetched URL to the set of URLs it links to.
+        self.links = {}
+        # URLs that have been fetched or are being fetched.
+        self.started = set()
+        # Maps host to a heap of (depth, order, URL) waiting to be fetched.
+        self.queues = collections.defaultdict(list)
+        self.order = itertools.count()
+        self.inflight = collections.Counter()
+
+    def add(self, url, depth):
+        """Adds a URL found at the given depth.
+
+        Returns:
+            True if the URL wasn't known before, False otherwise.
+        """
+        is_new = url not in self.depths
+        found = [(url, depth)]
+        while found:
+            url, depth = found.pop()
+            if self.depths.get(url, depth + 1) <= depth:
+                continue
+            self.depths[url] = depth
+            if url in self.links:
+                # Already fetched by a longer path, so everything it links
+                # to is closer too.
+                found.extend((link, depth + 1) for link in self.links[url])
+            elif (url not in self.started and
+                    (self.max_depth < 0 or depth <= self.max_depth)):
+                heapq.heappush(
+                    self.queues[urlparse.urlparse(url).netloc],
+                    (depth, next(self.order), url))
+        return is_new
+
+    def start_ready(self):
+        """Returns the URLs to fetch now and marks them as in flight.
+
+        The shallowest URLs go first, from hosts that aren't at their limit.
+        """
+        ready = []
+        while sum(self.inflight.values()) < self.max_inflight:
+            best_host = None
+            for host, queue in self.queues.iteritems():
+                # Drop URLs that were queued again by a shorter path.
+                while queue and queue[0][2] in self.started:
+                    heapq.heappop(queue)
+                if (queue and
+                        self.inflight[host] < self.max_inflight_per_host and
+                        (best_host is None or
+                         queue[0] < self.queues[best_host][0])):
+                    best_host = host
+            if best_host is None:
+                break
+
+            _, _, url = heapq.heappop(self.queues[best_host])
+            self.started.add(url)
+            self.inflight[best_host] += 1
+            ready.append(url)
+        return ready
+
+    def finish(self, url, link_set):
+        """Marks a URL as fetched, with the URLs its page links to.
+
+        Links from pages at the deepest allowed depth are remembered in
+        case a shorter path to the page turns up.
+
+        Returns:
+            List of the linked URLs that weren't known before.
+        """
+        self.inflight[urlparse.urlparse(url).netloc] -= 1
+        self.links[url] = link_set
+        depth = self.depths[url] + 1
+        return [link for link in link_set if self.add(link, depth)]
+
+
 class SiteDiff(workers.WorkflowItem):
     """Workflow for coordinating the site diff.
 
@@ -221,8 +329,10 @@ class SiteDiff(workers.WorkflowItem):
         if not ignore_prefixes:
             ignore_prefixes = []
 
-        pending_urls = set([clean_url(start_url)])
-        seen_urls = set()
+        frontier = CrawlFrontier(
+            FLAGS.crawl_depth, FLAGS.crawl_max_inflight,
+            FLAGS.crawl_max_inflight_per_host)
+        frontier.add(clean_url(start_url), 0)
         good_urls = set()
 
         yield heartbeat('Scanning for content')
@@ -230,47 +340,46 @@ class SiteDiff(workers.WorkflowItem):
         http_username = FLAGS.http_username
         http_password = FLAGS.http_password
 
-        limit_depth = FLAGS.crawl_depth >= 0
-        depth = 0
-        while (not limit_depth or depth <= FLAGS.crawl_depth) and pending_urls:
+        # Maps each FetchItem in flight to the URL it's for.
+        pending = {}
+        while True:
             # TODO: Enforce a job-wide timeout on the whole process of
             # URL discovery, to make sure infinitely deep sites do not
             # cause this job to never stop.
-            seen_urls.update(pending_urls)
-            yield heartbeat(
-                'Scanning %d pages for good urls' % len(pending_urls))
-            output = yield [fetch_worker.FetchItem(
-                                                   u,
-                                                   username=http_username,
-                                                   password=http_password)
-                            for u in pending_urls]
-            pending_urls.clear()
-
-            for item in output:
+            for url in frontier.start_ready():
+                item = fetch_worker.FetchItem(
+                    url, username=http_username, password=http_password)
+                pending[item] = url
+            if not pending:
+                break
+
+            # Parse each page as soon as it's fetched, so the pages it links
+            # to can start while the rest are still loading.
+            yield workers.WaitAny(pending.keys())
+
+            for item in [x for x in pending if x.done]:
+                url = pending.pop(item)
                 if not item.data:
-                    logging.debug('No data from url=%r', item.url)
+                    logging.debug('No data from url=%r', url)
+                    frontier.finish(url, set())
                     continue
 
                 if item.content_type != 'text/html':
-                    logging.debug('Skipping non-HTML document url=%r',
-                                  item.url)
+                    logging.debug('Skipping non-HTML document url=%r', url)
+                    frontier.finish(url, set())
                     continue
 
-                good_urls.add(item.url)
-                found = extract_urls(item.url, item.data)
+                good_urls.add(url)
+                found = extract_urls(url, item.data)
                 pruned = prune_urls(
                     found, start_url, [start_url], ignore_prefixes)
-                new = pruned - seen_urls
-                pending_urls.update(new)
-                yield heartbeat('Found %d new URLs from %s' % (
-                                len(new), item.url))
-
-            yield heartbeat('Finished crawl at depth %d' % depth)
-            depth += 1
+                new = frontier.finish(url, pruned)
+                yield heartbeat('Found %d new URLs from %s; fetching %d '
+                                'pages' % (len(new), url, len(pending)))
 
         yield heartbeat(
             'Found %d total URLs, %d good HTML pages; starting '
-            'screenshots' % (len(seen_urls), len(good_urls)))
+            'screenshots' % (len(frontier.started), len(good_urls)))
 
         # TODO: Make the default release name prettier.
         if not upload_release_name:
@@ -9,3 +9,11 @@ set -e
 ./tests/site_diff_test.py
 ./tests/timer_worker_test.py
 ./tests/workers_test.py
+./tests/concurrency_test.py
+./tests/image_diff_test.py
+./tests/masks_test.py
+./tests/capture_worker_test.py
+./tests/process_worker_test.py
+./tests/cache_proxy_test.py
+./tests/artifact_cache_test.py
+./tests/api_test.py
@@ -0,0 +1,474 @@
+#!/usr/bin/env python
+# Copyright 2015 Brett Slatkin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the api module."""
+
+import StringIO
+import json
+import logging
+import sys
+import unittest
+
+# Local Libraries
+import gflags
+FLAGS = gflags.FLAGS
+
+# Local modules
+from dpxdt import constants
+from dpxdt import server
+from dpxdt.server import db
+from dpxdt.server import models
+from dpxdt.server import work_queue
+from dpxdt.tools import run_server
+
+# Test-only modules
+import test_utils
+
+
+# Will be set by one-time setUp
+server_thread = None
+
+
+def setUpModule():
+    """Sets up the environment for testing."""
+    global server_thread
+    server_thread = test_utils.start_server()
+
+
+class ApiTestBase(unittest.TestCase):
+    """Base class for tests that call the API as a build's worker."""
+
+    distortion_threshold = None
+
+    def setUp(self):
+        """Sets up the test harness."""
+        self.client = server.app.test_client()
+        self.build_id = self.create_build(
+            'Test build', distortion_threshold=self.distortion_threshold)
+        self.release_name, self.release_number = self.create_release(
+            self.build_id)
+
+    def create_build(self, name, distortion_threshold=None):
+        """Creates a build and returns its ID."""
+        build = models.Build(
+            name=name, distortion_threshold=distortion_threshold)
+        db.session.add(build)
+        db.session.commit()
+        return build.id
+
+    def call(self, path, status_code=200, **params):
+        """Posts to an API path and returns the JSON response."""
+        response = self.client.post('/api/' + path, data=params)
+        self.assertEquals(status_code, response.status_code, response.data)
+        return json.loads(response.data)
+
+    def create_release(self, build_id):
+        """Creates a release candidate and returns its name and number."""
+        result = self.call(
+            'create_release',
+            build_id=build_id,
+            release_name='Release %s' % self.id(),
+            url='http://example.com/')
+        return result['release_name'], result['release_number']
+
+    def upload(self, build_id, data):
+        """Uploads an artifact for a build and returns its SHA1 sum.
+
+        Artifacts are keyed by content, so the data is made unique to the
+        test to keep their pixel hashes and diff results apart.
+        """
+        data = '%s: %s' % (self.id(), data)
+        result = self.call(
+            'upload',
+            build_id=build_id,
+            file=(StringIO.StringIO(data), 'screenshot.png'))
+        return result['sha1sum']
+
+    def report_run(self, run_name, build_id=None, release=None, **params):
+        """Reports data for a run of this test's release candidate."""
+        release_name, release_number = release or (
+            self.release_name, self.release_number)
+        self.call(
+            'report_run',
+            build_id=build_id or self.build_id,
+            release_name=release_name,
+            release_number=release_number,
+            run_name=run_name,
+            **params)
+
+    def get_run(self, run_name, build_id=None, release=None):
+        """Returns the named run of this test's release candidate."""
+        release_name, release_number = release or (
+            self.release_name, self.release_number)
+        db.session.remove()
+        return (
+            models.Run.query
+            .join(models.Release)
+            .filter(models.Release.build_id == (build_id or self.build_id),
+                    models.Release.name == release_name,
+                    models.Release.number == release_number,
+                    models.Run.name == run_name)
+            .one())
+
+    def get_tasks(self, queue_name, run):
+        """Returns the tasks that were enqueued for a run."""
+        return list(work_queue.WorkQueue.query.filter_by(
+            queue_name=queue_name, run_id=run.id))
+
+
+class ReportRunTest(ApiTestBase):
+    """Tests for the report_run API."""
+
+    def testIdenticalImages(self):
+        """Tests that byte-identical screenshots skip the pdiff."""
+        image = self.upload(self.build_id, 'identical')
+        self.report_run('run', image=image, ref_image=image)
+
+        run = self.get_run('run')
+        self.assertEquals(models.Run.DIFF_NOT_FOUND, run.status)
+        self.assertEquals([], self.get_tasks(constants.PDIFF_QUEUE_NAME, run))
+
+    def testDifferentImages(self):
+        """Tests that screenshots with different bytes need a pdiff."""
+        image = self.upload(self.build_id, 'after')
+        ref_image = self.upload(self.build_id, 'before')
+        self.report_run('run', image=image, ref_image=ref_image)
+
+        run = self.get_run('run')
+        self.assertEquals(models.Run.NEEDS_DIFF, run.status)
+        self.assertEquals(
+            1, len(self.get_tasks(constants.PDIFF_QUEUE_NAME, run)))
+
+    def testSamePixels(self):
+        """Tests that screenshots with the same pixel hash skip the pdiff."""
+        image = self.upload(self.build_id, 'after')
+        ref_image = self.upload(self.build_id, 'before')
+        self.report_run(
+            'first', image=image, ref_image=ref_image,
+            run_pixel_hash='same', ref_pixel_hash='same')
+
+        run = self.get_run('first')
+        self.assertEquals(models.Run.DIFF_NOT_FOUND, run.status)
+        self.assertEquals([], self.get_tasks(constants.PDIFF_QUEUE_NAME, run))
+
+        # The hashes are kept on the artifacts for later runs.
+        self.report_run('second', image=image, ref_image=ref_image)
+
+        run = self.get_run('second')
+        self.assertEquals(models.Run.DIFF_NOT_FOUND, run.status)
+        self.assertEquals([], self.get_tasks(constants.PDIFF_QUEUE_NAME, run))
+
+    def testDifferentPixels(self):
+        """Tests that screenshots with different pixel hashes need a pdiff."""
+        image = self.upload(self.build_id, 'after')
+        ref_image = self.upload(self.build_id, 'before')
+        self.report_run(
+            'run', image=image, ref_image=ref_image,
+            run_pixel_hash='after', ref_pixel_hash='before')
+
+        run = self.get_run('run')
+        self.assertEquals(models.Run.NEEDS_DIFF, run.status)
+        self.assertEquals(
+            1, len(self.get_tasks(constants.PDIFF_QUEUE_NAME, run)))
+
+
+class DiffResultTest(ApiTestBase):
+    """Tests for reusing the pdiff results of image pairs in report_run."""
+
+    def setUp(self):
+        """Diffs a pair of images in the test's build."""
+        ApiTestBase.setUp(self)
+        self.image = self.upload(self.build_id, 'after')
+        self.ref_image = self.upload(self.build_id, 'before')
+        self.report_run('first', image=self.image, ref_image=self.ref_image)
+
+        self.diff_image = self.upload(self.build_id, 'diff')
+        self.diff_log = self.upload(self.build_id, 'log')
+        self.report_run(
+            'first', diff_image=self.diff_image, diff_log=self.diff_log,
+            distortion=0.5)
+
+        result = models.DiffResult.query.get((self.ref_image, self.image))
+        self.assertEquals(self.diff_image, result.diff_image)
+        self.assertEquals(self.diff_log, result.diff_log)
+        self.assertEquals(0.5, result.distortion)
+
+    def owns_artifact(self, build_id, sha1sum):
+        """Returns True if the build may download the artifact."""
+        table = models.artifact_ownership_table
+        return db.session.query(table).filter_by(
+            artifact=sha1sum, build_id=build_id).first() is not None
+
+    def assertReused(self, run):
+        """Asserts that the run was given the stored pdiff result."""
+        self.assertEquals(models.Run.DIFF_FOUND, run.status)
+        self.assertEquals(self.diff_image, run.diff_image)
+        self.assertEquals(self.diff_log, run.diff_log)
+        self.assertEquals(0.5, run.distortion)
+        self.assertEquals([], self.get_tasks(constants.PDIFF_QUEUE_NAME, run))
+
+    def testReuseInSameBuild(self):
+        """Tests that another run of the same image pair reuses the diff."""
+        self.report_run('second', image=self.image, ref_image=self.ref_image)
+        self.assertReused(self.get_run('second'))
+
+    def testReuseInOtherBuild(self):
+        """Tests that a build that owns both images reuses the diff."""
+        build_id = self.create_build('Other build')
+        release = self.create_release(build_id)
+        self.assertEquals(self.image, self.upload(build_id, 'after'))
+        self.assertEquals(self.ref_image, self.upload(build_id, 'before'))
+        self.assertFalse(self.owns_artifact(build_id, self.diff_image))
+
+        self.report_run(
+            'other', build_id=build_id, release=release,
+            image=self.image, ref_image=self.ref_image)
+
+        self.assertReused(
+            self.get_run('other', build_id=build_id, release=release))
+        self.assertTrue(self.owns_artifact(build_id, self.diff_image))
+        self.assertTrue(self.owns_artifact(build_id, self.diff_log))
+
+    def testNoReuseWithoutAccess(self):
+        """Tests that a build can't read the diff of another build's images."""
+        build_id = self.create_build('Other build')
+        release = self.create_release(build_id)
+        self.report_run(
+            'other', build_id=build_id, release=release,
+            image=self.image, ref_image=self.ref_image)
+
+        run = self.get_run('other', build_id=build_id, release=release)
+        self.assertEquals(models.Run.NEEDS_DIFF, run.status)
+        self.assertEquals(None, run.diff_image)
+        self.assertEquals(None, run.diff_log)
+        self.assertEquals(
+            1, len(self.get_tasks(constants.PDIFF_QUEUE_NAME, run)))
+        self.assertFalse(self.owns_artifact(build_id, self.diff_image))
+        self.assertFalse(self.owns_artifact(build_id, self.diff_log))
+
+    def testReuseUnderThreshold(self):
+        """Tests that a reused diff is checked against the build's threshold."""
+        build_id = self.create_build('Other build', distortion_threshold=0.6)
+        release = self.create_release(build_id)
+        self.upload(build_id, 'after')
+        self.upload(build_id, 'before')
+
+        self.report_run(
+            'other', build_id=build_id, release=release,
+            image=self.image, ref_image=self.ref_image)
+
+        run = self.get_run('other', build_id=build_id, release=release)
+        self.assertEquals(models.Run.DIFF_NOT_FOUND, run.status)
+        self.assertEquals(None, run.diff_image)
+        self.assertEquals(self.diff_log, run.diff_log)
+        self.assertEquals(0.5, run.distortion)
+        self.assertEquals(0.6, run.distortion_threshold)
+        self.assertEquals([], self.get_tasks(constants.PDIFF_QUEUE_NAME, run))
+
+    def testNoReuseWithMask(self):
+        """Tests that diffs of masked runs are computed again."""
+        mask = self.upload(self.build_id, 'mask')
+        self.report_run(
+            'second', image=self.image, ref_image=self.ref_image, mask=mask)
+
+        run = self.get_run('second')
+        self.assertEquals(models.Run.NEEDS_DIFF, run.status)
+        self.assertEquals(None, run.diff_image)
+
+
+class DistortionThresholdTest(ApiTestBase):
+    """Tests for report_run with a build's distortion threshold."""
+
+    distortion_threshold = 0.01
+
+    def setUp(self):
+        """Reports a pair of images that need a pdiff."""
+        ApiTestBase.setUp(self)
+        image = self.upload(self.build_id, 'after')
+        ref_image = self.upload(self.build_id, 'before')
+        self.report_run('run', image=image, ref_image=ref_image)
+        self.diff_image = self.upload(self.build_id, 'diff')
+        self.diff_log = self.upload(self.build_id, 'log')
+
+    def testUnderThreshold(self):
+        """Tests that a diff under the threshold counts as no difference."""
+        self.report_run(
+            'run', diff_image=self.diff_image, diff_log=self.diff_log,
+            distortion=0.001)
+
+        run = self.get_run('run')
+        self.assertEquals(models.Run.DIFF_NOT_FOUND, run.status)
+        self.assertEquals(None, run.diff_image)
+        self.assertEquals(self.diff_log, run.diff_log)
+        self.assertEquals(0.001, run.distortion)
+        self.assertEquals(0.01, run.distortion_threshold)
+
+        # Other builds may have a lower threshold, so it's not shared.
+        self.assertEquals(
+            None, models.DiffResult.query.get((run.ref_image, run.image)))
+
+    def testOverThreshold(self):
+        """Tests that a diff over the threshold is a difference."""
+        self.report_run(
+            'run', diff_image=self.diff_image, diff_log=self.diff_log,
+            distortion=0.5)
+
+        run = self.get_run('run')
+        self.assertEquals(models.Run.DIFF_FOUND, run.status)
+        self.assertEquals(self.diff_image, run.diff_image)
+        self.assertEquals(0.5, run.distortion)
+        self.assertEquals(0.01, run.distortion_threshold)
+
+
+class RequestRunTest(ApiTestBase):
+    """Tests for the request_run API."""
+
+    def request_run(self, config_dict, status_code=200, **params):
+        """Requests a capture of the page run with the given config."""
+        return self.call(
+            'request_run',
+            status_code=status_code,
+            build_id=self.build_id,
+            release_name=self.release_name,
+            release_number=self.release_number,
+            run_name='page',
+            url='http://example.com/page',
+            config=json.dumps(config_dict),
+            **params)
+
+    def get_config(self, sha1sum):
+        """Returns the capture config saved as the given artifact."""
+        return json.loads(models.Artifact.query.get(sha1sum).data)
+
+    def get_run_names(self):
+        """Returns the names of all runs of this test's release candidate."""
+        db.session.remove()
+        query = (
+            db.session.query(models.Run.name)
+            .join(models.Release)
+            .filter(models.Release.build_id == self.build_id,
+                    models.Release.name == self.release_name,
+                    models.Release.number == self.release_number))
+        return sorted(name for name, in query)
+
+    def testSingleRun(self):
+        """Tests that a config without viewport sizes captures one run."""
+        result = self.request_run({'viewportSize': {'width': 1024}})
+        self.assertEquals('page', result['run_name'])
+        self.assertEquals(['page'], self.get_run_names())
+
+        run = self.get_run('page')
+        tasks = self.get_tasks(constants.CAPTURE_QUEUE_NAME, run)
+        self.assertEquals(1, len(tasks))
+        payload = json.loads(tasks[0].payload)
+        self.assertFalse('viewport_runs' in payload)
+
+    def testViewportSizes(self):
+        """Tests that one capture task is enqueued for every viewport size."""
+        desktop = {'width': 1024, 'height': 768}
+        mobile = {'width': 320, 'height': 480, 'name': 'mobile'}
+        result = self.request_run({'viewportSizes': [desktop, mobile]})
+
+        self.assertEquals(
+            ['page@1024x768', 'page@mobile'],
+            [info['run_name'] for info in result['viewport_runs']])
+        self.assertEquals(
+            ['page@1024x768', 'page@mobile'], self.get_run_names())
+
+        desktop_run = self.get_run('page@1024x768')
+        tasks = self.get_tasks(constants.CAPTURE_QUEUE_NAME, desktop_run)
+        self.assertEquals(1, len(tasks))
+        payload = json.loads(tasks[0].payload)
+        self.assertEquals('page@1024x768', payload['run_name'])
+        self.assertEquals(
+            [dict(run_name='page@1024x768', viewport_size=desktop),
+             dict(run_name='page@mobile', viewport_size=mobile)],
+            payload['viewport_runs'])
+
+        config_dict = self.get_config(payload['config_sha1sum'])
+        self.assertEquals([desktop, mobile], config_dict['viewportSizes'])
+        self.assertEquals('http://example.com/page', config_dict['targetUrl'])
+
+        # Each run shows the config for its own size.
+        mobile_run = self.get_run('page@mobile')
+        self.assertEquals(
+            [], self.get_tasks(constants.CAPTURE_QUEUE_NAME, mobile_run))
+        self.assertEquals(
+            desktop, self.get_config(desktop_run.config)['viewportSize'])
+        self.assertEquals(
+            mobile, self.get_config(mobile_run.config)['viewportSize'])
+        self.assertFalse(
+            'viewportSizes' in self.get_config(mobile_run.config))
+        self.assertEquals('http://example.com/page', mobile_run.url)
+
+    def testViewportSizesWithBaseline(self):
+        """Tests that the baseline is captured at the same viewport sizes."""
+        sizes = [{'width': 1024, 'height': 768}, {'width': 320, 'height': 480}]
+        self.request_run(
+            {'viewportSizes': sizes},
+            ref_url='http://example.com/baseline',
+            ref_config=json.dumps({'viewportSizes': sizes[:1]}))
+
+        run = self.get_run('page@1024x768')
+        tasks = self.get_tasks(constants.CAPTURE_QUEUE_NAME, run)
+        self.assertEquals(2, len(tasks))
+        for task in tasks:
+            payload = json.loads(task.payload)
+            config_dict = self.get_config(payload['config_sha1sum'])
+            self.assertEquals(sizes, config_dict['viewportSizes'])
+
+        run = self.get_run('page@320x480')
+        self.assertEquals('http://example.com/baseline', run.ref_url)
+        self.assertEquals(
+            sizes[1], self.get_config(run.ref_config)['viewportSize'])
+
+    def assertRejected(self, viewport_sizes, message):
+        """Asserts that the viewport sizes are rejected without any runs."""
+        result = self.request_run(
+            {'viewportSizes': viewport_sizes}, status_code=400)
+        self.assertEquals('AssertionError: ' + message, result['error'])
+        self.assertEquals([], self.get_run_names())
+
+    def testInvalidViewportSizes(self):
+        """Tests that invalid viewport sizes are rejected."""
+        self.assertRejected(
+            {'width': 1024, 'height': 768}, 'viewportSizes must be a list')
+        for viewport_sizes in [
+                [{'width': 1024}],
+                [{'width': '1024', 'height': 768}],
+                [1024]]:
+            self.assertRejected(
+                viewport_sizes,
+                'viewportSizes entries require a width and height')
+
+    def testDuplicateViewportSizes(self):
+        """Tests that viewport sizes with the same run name are rejected."""
+        self.assertRejected(
+            [{'width': 320, 'height': 480}, {'width': 320, 'height': 480}],
+            'viewportSizes entries must be unique')
+        self.assertRejected(
+            [{'width': 320, 'height': 480, 'name': 'mobile'},
+             {'width': 360, 'height': 640, 'name': 'mobile'}],
+            'viewportSizes entries must be unique')
+
+
+def main(argv):
+    logging.getLogger().setLevel(logging.DEBUG)
+    argv = FLAGS(argv)
+    unittest.main(argv=argv)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# Copyright 2013 Brett Slatkin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the artifact_cache module."""
+
+import hashlib
+import logging
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import threading
+import unittest
+
+# Local Libraries
+import gflags
+FLAGS = gflags.FLAGS
+
+# Local modules
+from dpxdt.client import artifact_cache
+
+
+class ArtifactCacheTest(unittest.TestCase):
+    """Tests for the ArtifactCache."""
+
+    def setUp(self):
+        """Sets up the test harness."""
+        self.output_dir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.output_dir, 'cache')
+        self.cache = artifact_cache.ArtifactCache(self.cache_dir, 1000)
+
+    def tearDown(self):
+        """Cleans up the test harness."""
+        shutil.rmtree(self.output_dir, True)
+
+    def write(self, name, data):
+        """Writes a file and returns its (path, sha1sum)."""
+        path = os.path.join(self.output_dir, name)
+        with open(path, 'wb') as data_file:
+            data_file.write(data)
+        return path, hashlib.sha1(data).hexdigest()
+
+    def testHardlink(self):
+        """Tests that cache hits are hardlinks to read-only files."""
+        path, sha1sum = self.write('download', 'my data')
+        result_path = os.path.join(self.output_dir, 'result')
+
+        self.assertFalse(self.cache.get(sha1sum, result_path))
+        self.cache.put(sha1sum, path)
+        self.assertTrue(self.cache.get(sha1sum, result_path))
+
+        self.assertEquals('my data', open(result_path).read())
+        cache_path = os.path.join(self.cache_dir, sha1sum)
+        self.assertEquals(os.stat(cache_path).st_ino,
+                          os.stat(result_path).st_ino)
+        self.assertFalse(os.stat(result_path).st_mode & stat.S_IWUSR)
+        self.assertEquals(1, self.cache.hits)
+        self.assertEquals(1, self.cache.misses)
+
+    def testReplacesResult(self):
+        """Tests that a hit replaces a file already at the result path."""
+        path, sha1sum = self.write('download', 'my data')
+        result_path, _ = self.write('result', 'old data')
+        self.cache.put(sha1sum, path)
+        self.assertTrue(self.cache.get(sha1sum, result_path))
+        self.assertEquals('my data', open(result_path).read())
+
+    def testBadContent(self):
+        """Tests that files that don't match their hash aren't cached."""
+        path, _ = self.write('download', 'my data')
+        sha1sum = hashlib.sha1('other data').hexdigest()
+        self.cache.put(sha1sum, path)
+        self.assertFalse(self.cache.get(
+            sha1sum, os.path.join(self.output_dir, 'result')))
+        self.assertEquals([], os.listdir(self.cache_dir))
+
+    def testEviction(self):
+        """Tests that the least recently used artifacts are removed."""
+        first_path, first = self.write('first', 'a' * 400)
+        second_path, second = self.write('second', 'b' * 400)
+        third_path, third = self.write('third', 'c' * 400)
+        result_path = os.path.join(self.output_dir, 'result')
+
+        self.cache.put(first, first_path)
+        self.cache.put(second, second_path)
+        self.assertTrue(self.cache.get(first, result_path))
+        self.cache.put(third, third_path)
+
+        self.assertTrue(self.cache.get(first, result_path))
+        self.assertFalse(self.cache.get(second, result_path))
+        self.assertTrue(self.cache.get(third, result_path))
+        self.assertEquals(800, self.cache.total_bytes)
+        self.assertEquals(1, self.cache.evictions)
+        self.assertEquals(sorted([first, third]),
+                          sorted(os.listdir(self.cache_dir)))
+
+    def testReload(self):
+        """Tests that a new cache uses the artifacts already on disk."""
+        path, sha1sum = self.write('download', 'my data')
+        self.cache.put(sha1sum, path)
+        open(os.path.join(self.cache_dir, 'leftover.tmp'), 'w').close()
+
+        cache = artifact_cache.ArtifactCache(self.cache_dir, 1000)
+        self.assertTrue(cache.get(
+            sha1sum, os.path.join(self.output_dir, 'result')))
+        self.assertEquals(len('my data'), cache.total_bytes)
+        self.assertEquals([sha1sum], os.listdir(self.cache_dir))
+
+    def testConcurrentFills(self):
+        """Tests many threads filling the cache with the same artifact."""
+        paths = []
+        for i in xrange(10):
+            path, sha1sum = self.write('download%d' % i, 'my data')
+            paths.append(path)
+
+        threads = [
+            threading.Thread(target=self.cache.put, args=(sha1sum, path))
+            for path in paths]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEquals([sha1sum], os.listdir(self.cache_dir))
+        self.assertEquals(len('my data'), self.cache.total_bytes)
+
+
+def main(argv):
+    logging.getLogger().setLevel(logging.DEBUG)
+    argv = FLAGS(argv)
+    unittest.main(argv=argv)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
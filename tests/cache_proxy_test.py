@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+# Copyright 2013 Brett Slatkin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the cache_proxy module."""
+
+import BaseHTTPServer
+import collections
+import json
+import logging
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import unittest
+import urllib2
+
+# Local Libraries
+import gflags
+FLAGS = gflags.FLAGS
+
+# Local modules
+from dpxdt.client import cache_proxy
+
+
+# Response headers for each path served by the origin.
+ORIGIN_PATHS = {
+    '/fresh.css': [('Cache-Control', 'max-age=600')],
+    '/no-store.css': [('Cache-Control', 'no-store')],
+    '/no-headers.css': [],
+    '/etag.js': [('Cache-Control', 'no-cache'), ('ETag', '"v1"')],
+    '/cookie.css': [('Cache-Control', 'max-age=600'),
+                    ('Set-Cookie', 'a=1')],
+    '/big.png': [('Cache-Control', 'max-age=600')],
+}
+
+
+class OriginHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves each path in ORIGIN_PATHS and counts the requests."""
+
+    requests = collections.Counter()
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.requests[self.path] += 1
+        headers = ORIGIN_PATHS[self.path]
+        if ('ETag', self.headers.getheader('if-none-match')) in headers:
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        body = 'body of %s' % self.path
+        if self.path == '/big.png':
+            body = 'x' * 600
+        self.send_response(200)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class CacheProxyTest(unittest.TestCase):
+    """Tests for the caching proxy."""
+
+    def setUp(self):
+        """Sets up the test harness."""
+        OriginHandler.requests.clear()
+        self.origin = BaseHTTPServer.HTTPServer(
+            ('127.0.0.1', 0), OriginHandler)
+        thread = threading.Thread(target=self.origin.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.origin_url = 'http://127.0.0.1:%d' % self.origin.server_port
+
+        self.cache_dir = tempfile.mkdtemp()
+        self.proxies = []
+        self.proxy = self.start_proxy()
+
+    def tearDown(self):
+        """Cleans up the test harness."""
+        for proxy in self.proxies:
+            proxy.shutdown()
+            proxy.server_close()
+        self.origin.shutdown()
+        self.origin.server_close()
+        shutil.rmtree(self.cache_dir, True)
+        FLAGS.capture_proxy_force_cache_suffixes = []
+
+    def start_proxy(self, max_bytes=10000):
+        proxy = cache_proxy.start(self.cache_dir, max_bytes)
+        self.proxies.append(proxy)
+        return proxy
+
+    def fetch(self, path, proxy=None):
+        """Fetches a path from the origin and returns (body, X-Cache)."""
+        proxy = proxy or self.proxy
+        opener = urllib2.build_opener(
+            urllib2.ProxyHandler({'http': 'http://' + proxy.address}))
+        response = opener.open(self.origin_url + path)
+        try:
+            return response.read(), response.info().getheader('x-cache')
+        finally:
+            response.close()
+
+    def testFresh(self):
+        """Tests that fresh responses are served from the cache."""
+        self.assertEquals(('body of /fresh.css', 'MISS'),
+                          self.fetch('/fresh.css'))
+        self.assertEquals(('body of /fresh.css', 'HIT'),
+                          self.fetch('/fresh.css'))
+        self.assertEquals(1, OriginHandler.requests['/fresh.css'])
+
+        stats = self.proxy.get_stats()
+        self.assertEquals(1, stats['hits'])
+        self.assertEquals(1, stats['misses'])
+        self.assertEquals(0.5, stats['hit_rate'])
+        self.assertEquals(len('body of /fresh.css'),
+                          stats['bytes_from_cache'])
+
+    def testNotStorable(self):
+        """Tests that responses the headers forbid caching aren't cached."""
+        for path in ('/no-store.css', '/no-headers.css', '/cookie.css'):
+            self.assertEquals('MISS', self.fetch(path)[1])
+            self.assertEquals('MISS', self.fetch(path)[1])
+            self.assertEquals(2, OriginHandler.requests[path])
+
+    def testRevalidate(self):
+        """Tests that stale responses with an ETag are revalidated."""
+        self.assertEquals(('body of /etag.js', 'MISS'),
+                          self.fetch('/etag.js'))
+        self.assertEquals(('body of /etag.js', 'REVALIDATED'),
+                          self.fetch('/etag.js'))
+        self.assertEquals(2, OriginHandler.requests['/etag.js'])
+        self.assertEquals(1, self.proxy.get_stats()['revalidations'])
+
+    def testForcedSuffix(self):
+        """Tests caching static assets whatever their headers say."""
+        FLAGS.capture_proxy_force_cache_suffixes = ['.css']
+        self.assertEquals('MISS', self.fetch('/no-store.css')[1])
+        self.assertEquals('HIT', self.fetch('/no-store.css')[1])
+        self.assertEquals(1, OriginHandler.requests['/no-store.css'])
+
+    def testEviction(self):
+        """Tests that the least recently used responses are removed."""
+        self.fetch('/fresh.css')
+        self.fetch('/big.png')
+        self.assertEquals('HIT', self.fetch('/fresh.css')[1])
+        # The cache is full, so the least recently used response goes to
+        # make room for another one.
+        self.proxy.cache.max_bytes = self.proxy.cache.total_bytes
+        self.fetch('/etag.js')
+        self.assertEquals('HIT', self.fetch('/fresh.css')[1])
+        self.assertEquals('MISS', self.fetch('/big.png')[1])
+        self.assertTrue(self.proxy.get_stats()['evictions'] >= 1)
+
+    def testSurvivesRestart(self):
+        """Tests that a new proxy uses the responses already on disk."""
+        self.fetch('/fresh.css')
+        other_proxy = self.start_proxy()
+        self.assertEquals('HIT', self.fetch('/fresh.css', other_proxy)[1])
+        self.assertEquals(1, OriginHandler.requests['/fresh.css'])
+
+    def testTunnel(self):
+        """Tests that CONNECT requests are tunneled to the remote server."""
+        host, port = self.proxy.address.split(':')
+        sock = socket.create_connection((host, int(port)), 5)
+        try:
+            sock.sendall('CONNECT 127.0.0.1:%d HTTP/1.1\r\n\r\n' %
+                         self.origin.server_port)
+            self.assertTrue(sock.recv(1024).startswith('HTTP/1.1 200'))
+            sock.sendall('GET /fresh.css HTTP/1.0\r\n\r\n')
+            response = ''
+            while True:
+                data = sock.recv(1024)
+                if not data:
+                    break
+                response += data
+        finally:
+            sock.close()
+        self.assertTrue(response.endswith('body of /fresh.css'), response)
+        self.assertEquals(1, self.proxy.get_stats()['tunnels'])
+
+    def testStats(self):
+        """Tests requesting the stats from the proxy itself."""
+        self.fetch('/fresh.css')
+        response = urllib2.urlopen('http://%s/stats' % self.proxy.address)
+        stats = json.loads(response.read())
+        self.assertEquals(1, stats['misses'])
+        self.assertEquals(1, stats['cached_responses'])
+
+    def testFreshness(self):
+        """Tests reading the freshness of a response from its headers."""
+        now = 1000
+        self.assertEquals(60, cache_proxy.get_freshness_seconds(
+            [('Cache-Control', 'public, max-age=60')], now))
+        self.assertEquals(30, cache_proxy.get_freshness_seconds(
+            [('Cache-Control', 'max-age=60, s-maxage=30')], now))
+        self.assertEquals(120, cache_proxy.get_freshness_seconds(
+            [('Date', 'Thu, 01 Jan 1970 00:00:00 GMT'),
+             ('Expires', 'Thu, 01 Jan 1970 00:02:00 GMT')], now))
+        self.assertEquals(0, cache_proxy.get_freshness_seconds(
+            [('Expires', '0')], now))
+        self.assertEquals(0, cache_proxy.get_freshness_seconds(
+            [('Cache-Control', 'no-cache')], now))
+        self.assertEquals(None, cache_proxy.get_freshness_seconds(
+            [('Cache-Control', 'private, max-age=60')], now))
+        self.assertEquals(None, cache_proxy.get_freshness_seconds([], now))
+
+
+def main(argv):
+    logging.getLogger().setLevel(logging.DEBUG)
+    argv = FLAGS(argv)
+    unittest.main(argv=argv)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
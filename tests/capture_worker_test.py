@@ -0,0 +1,434 @@
+#!/usr/bin/env python
+# Copyright 2013 Brett Slatkin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the capture_worker module."""
+
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+# Local Libraries
+import gflags
+FLAGS = gflags.FLAGS
+
+# Local modules
+from dpxdt.client import capture_worker
+from dpxdt.client import process_worker
+from dpxdt.client import queue_worker
+from dpxdt.client import release_worker
+from dpxdt.client import timer_worker
+from dpxdt.client import workers
+
+
+# Stands in for capture.js in server and manifest modes. The config
+# controls what each job does, and the screenshot is the pid of the process.
+FAKE_CAPTURE_SCRIPT = r'''
+import BaseHTTPServer
+import json
+import os
+import sys
+import time
+
+def run_job(job):
+    config = json.load(open(job['configPath']))
+    with open(job['logPath'], 'a') as log_file:
+        log_file.write('capturing %s\n' % config['targetUrl'])
+    if config.get('crash'):
+        os._exit(1)
+    time.sleep(config.get('sleep', 0))
+    with open(job['outputPath'], 'w') as output_file:
+        output_file.write(str(os.getpid()))
+    return config.get('returncode', 0)
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_POST(self):
+        job = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        returncode = run_job(job)
+        self.send_response(200)
+        self.end_headers()
+        self.wfile.write(json.dumps({'returncode': returncode}))
+
+if sys.argv[1] == '--server':
+    BaseHTTPServer.HTTPServer(
+        ('127.0.0.1', int(sys.argv[2])), Handler).serve_forever()
+elif sys.argv[1] == '--manifest':
+    returncodes = []
+    for job in json.load(open(sys.argv[2]))['jobs']:
+        returncodes.append(run_job(job))
+        json.dump({'returncodes': returncodes}, open(sys.argv[3], 'w'))
+'''
+
+
+def write_fake_script(output_dir):
+    """Writes the fake capture script and uses it for captures."""
+    script_path = os.path.join(output_dir, 'fake_capture.py')
+    with open(script_path, 'w') as script_file:
+        script_file.write(FAKE_CAPTURE_SCRIPT)
+    FLAGS.capture_binary = sys.executable
+    FLAGS.capture_script = script_path
+
+
+class CaptureServerTest(unittest.TestCase):
+    """Tests for the CaptureServer."""
+
+    def setUp(self):
+        """Sets up the test harness."""
+        self.output_dir = tempfile.mkdtemp()
+        write_fake_script(self.output_dir)
+        self.server = capture_worker.CaptureServer(2)
+        self.log_path = os.path.join(self.output_dir, 'log.txt')
+        self.config_path = os.path.join(self.output_dir, 'config.json')
+        self.output_path = os.path.join(self.output_dir, 'capture.png')
+
+    def tearDown(self):
+        """Cleans up the test harness."""
+        self.server.stop()
+        shutil.rmtree(self.output_dir, True)
+
+    def capture(self, timeout_seconds=10, **config):
+        config.setdefault('targetUrl', 'http://example.com')
+        with open(self.config_path, 'w') as config_file:
+            json.dump(config, config_file)
+        returncode = self.server.capture(
+            self.log_path, self.config_path, self.output_path,
+            timeout_seconds)
+        return returncode, open(self.output_path).read()
+
+    def testReuseAndRecycle(self):
+        """Tests the process is reused until it has done max_jobs."""
+        returncode, first_pid = self.capture()
+        self.assertEquals(0, returncode)
+        self.assertEquals((1, first_pid), self.capture(returncode=1))
+        self.assertFalse(self.server.alive)
+
+        returncode, next_pid = self.capture()
+        self.assertNotEquals(first_pid, next_pid)
+        self.assertEquals(
+            'capturing http://example.com\n' * 3, open(self.log_path).read())
+
+    def testCrash(self):
+        """Tests a crashed process is replaced for the next job."""
+        returncode, first_pid = self.capture()
+        self.assertRaises(capture_worker.CaptureServerError,
+                          self.capture, crash=True)
+        self.assertFalse(self.server.alive)
+
+        returncode, next_pid = self.capture()
+        self.assertEquals(0, returncode)
+        self.assertNotEquals(first_pid, next_pid)
+
+    def testTimeout(self):
+        """Tests a job that takes too long kills the process."""
+        self.assertRaises(process_worker.TimeoutError,
+                          self.capture, timeout_seconds=0.5, sleep=5)
+        self.assertFalse(self.server.alive)
+        self.assertEquals(0, self.capture()[0])
+
+
+class ManifestCaptureTest(unittest.TestCase):
+    """Tests for capturing many screenshots from a manifest."""
+
+    def setUp(self):
+        """Sets up the test harness."""
+        self.output_dir = tempfile.mkdtemp()
+        write_fake_script(self.output_dir)
+        self.coordinator = workers.get_coordinator()
+        process_worker.register(self.coordinator)
+        timer_worker.register(self.coordinator)
+        self.coordinator.start()
+
+    def tearDown(self):
+        """Cleans up the test harness."""
+        self.coordinator.stop()
+        self.coordinator.join()
+        shutil.rmtree(self.output_dir, True)
+
+    def run_manifest(self, config_list):
+        job_list = []
+        for i, config in enumerate(config_list):
+            config_path = os.path.join(self.output_dir, 'config%d.json' % i)
+            with open(config_path, 'w') as config_file:
+                json.dump(config, config_file)
+            job_list.append((
+                os.path.join(self.output_dir, 'log%d.txt' % i),
+                config_path,
+                os.path.join(self.output_dir, 'capture%d.png' % i)))
+
+        manifest_path = os.path.join(self.output_dir, 'manifest.json')
+        results_path = os.path.join(self.output_dir, 'results.json')
+        capture_worker.write_manifest(manifest_path, job_list)
+
+        item = capture_worker.ManifestCaptureWorkflow(
+            os.path.join(self.output_dir, 'log.txt'), manifest_path,
+            results_path, len(job_list))
+        item.root = True
+        self.coordinator.input_queue.put(item)
+        self.coordinator.wait_one()
+        return capture_worker.read_manifest_results(
+            results_path, len(job_list))
+
+    def testFailureIsolation(self):
+        """Tests one job failing doesn't fail the others."""
+        self.assertEquals([0, 1, 0], self.run_manifest([
+            {'targetUrl': 'http://example.com/1'},
+            {'targetUrl': 'http://example.com/2', 'returncode': 1},
+            {'targetUrl': 'http://example.com/3'},
+        ]))
+        self.assertEquals('capturing http://example.com/3\n',
+                          open(os.path.join(self.output_dir, 'log2.txt')).read())
+        self.assertEquals(
+            open(os.path.join(self.output_dir, 'capture0.png')).read(),
+            open(os.path.join(self.output_dir, 'capture2.png')).read())
+
+    def testCrash(self):
+        """Tests jobs after a crash have no result."""
+        self.assertEquals([0, None, None], self.run_manifest([
+            {'targetUrl': 'http://example.com/1'},
+            {'targetUrl': 'http://example.com/2', 'crash': True},
+            {'targetUrl': 'http://example.com/3'},
+        ]))
+
+    def testConfigGroupKey(self):
+        """Tests configs that only differ by URL can share a process."""
+        def key(config):
+            config_path = os.path.join(self.output_dir, 'config.json')
+            with open(config_path, 'w') as config_file:
+                json.dump(config, config_file)
+            return capture_worker.get_config_group_key(config_path)
+
+        self.assertEquals(
+            key({'targetUrl': 'http://a', 'viewportSize': {'width': 10}}),
+            key({'targetUrl': 'http://b', 'viewportSize': {'width': 10},
+                 'ignoreRegions': [{'selector': '.ad'}]}))
+        self.assertNotEquals(
+            key({'targetUrl': 'http://a', 'viewportSize': {'width': 10}}),
+            key({'targetUrl': 'http://a', 'viewportSize': {'width': 20}}))
+
+
+class FakeDownloadArtifactWorkflow(workers.WorkflowItem):
+    """Stands in for downloading a config; the sha1sum is its JSON."""
+
+    def run(self, build_id, sha1sum, result_path=None):
+        yield []  # Make this into a generator
+        with open(result_path, 'w') as result_file:
+            result_file.write(sha1sum)
+
+
+class FakeReportCaptureWorkflow(workers.WorkflowItem):
+    """Stands in for ReportCaptureWorkflow and saves what it reports."""
+
+    reports = []
+
+    def run(self, build_id, release_name, release_number, run_name,
+            baseline, output_path, image_path, log_path, config_path,
+            capture_failed, failure_reason, heartbeat, viewport_runs=None):
+        yield heartbeat('Reporting capture status to server')
+        FakeReportCaptureWorkflow.reports.append((run_name, capture_failed))
+
+
+class RecordHeartbeatWorkflow(workers.WorkflowItem):
+    """Stands in for a heartbeat and saves its message in a list."""
+
+    def run(self, message_list, message):
+        yield []  # Make this into a generator
+        message_list.append(message)
+
+
+class DoCaptureBatchWorkflowTest(unittest.TestCase):
+    """Tests for DoCaptureBatchWorkflow."""
+
+    def setUp(self):
+        """Sets up the test harness."""
+        self.output_dir = tempfile.mkdtemp()
+        write_fake_script(self.output_dir)
+        self.original_flush_seconds = FLAGS.queue_update_flush_seconds
+        self.original_download = release_worker.DownloadArtifactWorkflow
+        self.original_report = capture_worker.ReportCaptureWorkflow
+        release_worker.DownloadArtifactWorkflow = FakeDownloadArtifactWorkflow
+        capture_worker.ReportCaptureWorkflow = FakeReportCaptureWorkflow
+        FakeReportCaptureWorkflow.reports = []
+
+        self.coordinator = workers.get_coordinator()
+        process_worker.register(self.coordinator)
+        timer_worker.register(self.coordinator)
+        self.coordinator.start()
+
+    def tearDown(self):
+        """Cleans up the test harness."""
+        self.coordinator.stop()
+        self.coordinator.join()
+        release_worker.DownloadArtifactWorkflow = self.original_download
+        capture_worker.ReportCaptureWorkflow = self.original_report
+        FLAGS.queue_update_flush_seconds = self.original_flush_seconds
+        shutil.rmtree(self.output_dir, True)
+
+    def testHeartbeatWhileCapturing(self):
+        """Tests every job in a manifest keeps its lease while it runs."""
+        FLAGS.queue_update_flush_seconds = 0.05
+        heartbeats = [[] for _ in xrange(3)]
+        payload_list = [
+            dict(build_id=1, release_name='r', release_number=1,
+                 run_name='run%d' % i,
+                 config_sha1sum=json.dumps(
+                     {'targetUrl': 'http://example.com/%d' % i,
+                      'sleep': 0.3}),
+                 heartbeat=lambda message, i=i: RecordHeartbeatWorkflow(
+                     heartbeats[i], message))
+            for i in xrange(3)]
+
+        item = capture_worker.DoCaptureBatchWorkflow(payload_list)
+        item.root = True
+        self.coordinator.input_queue.put(item)
+        self.coordinator.wait_one()
+
+        # Reporting happens in a follow-on workflow after the captures.
+        self.assertEquals([], FakeReportCaptureWorkflow.reports)
+        self.assertTrue(isinstance(item.result, queue_worker.FollowOn))
+        report = item.result.workflow
+        report.root = True
+        self.coordinator.input_queue.put(report)
+        self.coordinator.wait_one()
+
+        self.assertEquals([None] * 3, report.result)
+        self.assertEquals(
+            [('run0', False), ('run1', False), ('run2', False)],
+            sorted(FakeReportCaptureWorkflow.reports))
+
+        running = 'Running webpage capture process with 2 others'
+        captured = 'Captured, waiting for the rest of its process'
+        self.assertTrue(heartbeats[2].count(running) > 5, heartbeats[2])
+        self.assertTrue(heartbeats[0].count(captured) > 5, heartbeats[0])
+
+
+class ViewportMatrixTest(unittest.TestCase):
+    """Tests for capturing many viewport sizes from one page load."""
+
+    def testViewportImagePath(self):
+        """Tests the index goes before the screenshot's extension."""
+        self.assertEquals(
+            '/tmp/out/capture.0.png',
+            capture_worker.get_viewport_image_path('/tmp/out/capture.png', 0))
+        self.assertEquals(
+            '/tmp/out/capture.2.bmp',
+            capture_worker.get_viewport_image_path('/tmp/out/capture.bmp', 2))
+
+    def testTimeoutPerViewport(self):
+        """Tests each viewport size gets the time of a whole capture."""
+        self.assertEquals(1, capture_worker.get_viewport_count(None))
+        self.assertEquals(3, capture_worker.get_viewport_count(
+            [{'run_name': 'a'}, {'run_name': 'b'}, {'run_name': 'c'}]))
+
+        output_dir = tempfile.mkdtemp()
+        try:
+            manifest_path = os.path.join(output_dir, 'manifest.json')
+            capture_worker.write_manifest(manifest_path, [], 3)
+            self.assertEquals(
+                capture_worker.get_capture_timeout() * 3 * 1000,
+                json.load(open(manifest_path))['timeoutMs'])
+        finally:
+            shutil.rmtree(output_dir, True)
+
+
+@unittest.skipIf(capture_worker.Image is None, 'Pillow not installed')
+class EncodeImageTest(unittest.TestCase):
+    """Tests for encoding screenshots after they're captured."""
+
+    def setUp(self):
+        """Sets up the test harness."""
+        self.output_dir = tempfile.mkdtemp()
+        self.source_path = os.path.join(self.output_dir, 'capture.bmp')
+        image = capture_worker.Image.new('RGB', (20, 10), (255, 255, 255))
+        image.putpixel((3, 4), (255, 0, 0))
+        image.save(self.source_path)
+
+    def tearDown(self):
+        """Cleans up the test harness."""
+        shutil.rmtree(self.output_dir, True)
+
+    def encode(self, image_format, pool=None):
+        dest_path = capture_worker.get_encoded_image_path(
+            self.source_path, image_format)
+        item = capture_worker.EncodeImageItem(
+            self.source_path, dest_path, image_format)
+        thread = capture_worker.EncodeImageThread(None, None, pool=pool)
+        return thread.handle_item(item)
+
+    def assertSamePixels(self, path):
+        expected = capture_worker.Image.open(self.source_path)
+        actual = capture_worker.Image.open(path).convert(expected.mode)
+        self.assertEquals(list(expected.getdata()), list(actual.getdata()))
+
+    def testPng(self):
+        """Tests encoding as an optimized PNG."""
+        item = self.encode('png')
+        self.assertEquals(None, item.failure_reason)
+        self.assertEquals(
+            os.path.join(self.output_dir, 'capture.encoded.png'),
+            item.dest_path)
+        self.assertEquals(
+            'PNG', capture_worker.Image.open(item.dest_path).format)
+        self.assertSamePixels(item.dest_path)
+        self.assertTrue(item.dest_bytes < item.source_bytes)
+        self.assertTrue(item.seconds >= 0)
+
+    def testWebp(self):
+        """Tests encoding as a lossless WebP."""
+        item = self.encode('webp')
+        self.assertEquals(None, item.failure_reason)
+        self.assertEquals(
+            'WEBP', capture_worker.Image.open(item.dest_path).format)
+        self.assertSamePixels(item.dest_path)
+
+    def testBadScreenshot(self):
+        """Tests a screenshot that can't be decoded fails the encode."""
+        with open(self.source_path, 'w') as source_file:
+            source_file.write('not an image')
+        item = self.encode('png')
+        self.assertTrue(
+            item.failure_reason.startswith('Encoding capture.bmp failed'),
+            item.failure_reason)
+
+    def testProcessPool(self):
+        """Tests encoding in a worker process."""
+        pool = multiprocessing.Pool(1)
+        try:
+            item = self.encode('png', pool=pool)
+        finally:
+            pool.terminate()
+        self.assertEquals(None, item.failure_reason)
+        self.assertSamePixels(item.dest_path)
+
+    def testProcessPoolTimeout(self):
+        """Tests an encode that runs too long fails instead of hanging."""
+        image = capture_worker.Image.effect_noise((2000, 2000), 64)
+        image.convert('RGB').save(self.source_path)
+        pool = multiprocessing.Pool(1)
+        FLAGS.capture_timeout = 0
+        try:
+            item = self.encode('png', pool=pool)
+        finally:
+            FLAGS.capture_timeout = 120
+            pool.terminate()
+        self.assertEquals(
+            'Encoding capture.bmp timed out after 0 seconds',
+            item.failure_reason)
+
+
+if __name__ == '__main__':
+    unittest.main()
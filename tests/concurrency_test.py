@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# Copyright 2013 Brett Slatkin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the concurrency module."""
+
+import logging
+import sys
+import unittest
+
+# Local Libraries
+import gflags
+FLAGS = gflags.FLAGS
+
+# Local modules
+from dpxdt.client import concurrency
+
+
+class ConcurrencyControllerTest(unittest.TestCase):
+    """Tests for the ConcurrencyController."""
+
+    def setUp(self):
+        """Sets up the test harness."""
+        self.now = 1000.0
+        self.cpu_load = 0.1
+        self.free_memory = 0.5
+        self.controller = concurrency.ConcurrencyController(
+            'test-queue', 8, min_tasks=2,
+            get_cpu_load=lambda: self.cpu_load,
+            get_free_memory=lambda: self.free_memory,
+            clock=lambda: self.now)
+
+    def adjust(self):
+        self.now += FLAGS.adaptive_interval_seconds
+        return self.controller.maybe_adjust()
+
+    def fill_slots(self):
+        while self.controller.acquire():
+            pass
+
+    def testWaitsForInterval(self):
+        """Tests that the limit only changes once per interval."""
+        self.cpu_load = 5.0
+        self.assertEquals(8, self.controller.maybe_adjust())
+        self.assertEquals(6, self.adjust())
+        self.assertEquals(6, self.controller.maybe_adjust())
+
+    def testDecreaseWithinBounds(self):
+        """Tests the limit drops under load but not below the lower bound."""
+        self.cpu_load = 5.0
+        self.assertEquals(6, self.adjust())
+        self.assertEquals(5, self.adjust())
+        self.assertEquals(4, self.adjust())
+        self.assertEquals(3, self.adjust())
+        self.assertEquals(2, self.adjust())
+        self.assertEquals(2, self.adjust())
+        self.assertEquals('cpu_load=5.00', self.controller.last_reason)
+
+        self.cpu_load = 0.1
+        self.free_memory = 0.01
+        self.assertEquals(2, self.adjust())
+        self.assertEquals('free_memory=0.01', self.controller.last_reason)
+        self.assertEquals(5, self.controller.decreases)
+
+    def testIncreaseWhenBusy(self):
+        """Tests the limit goes back up only while all slots are busy."""
+        self.cpu_load = 5.0
+        self.adjust()
+        self.adjust()
+        self.assertEquals(5, self.controller.limit)
+
+        self.cpu_load = 0.1
+        self.assertEquals(5, self.adjust())
+        self.assertEquals('spare slots', self.controller.last_reason)
+
+        self.fill_slots()
+        self.assertEquals(5, self.controller.running)
+        self.assertEquals(6, self.adjust())
+        self.assertEquals(6, self.controller.metrics()['limit'])
+        self.assertEquals(
+            'increase', self.controller.metrics()['last_decision'])
+
+        # The new slot was never used, so hold.
+        self.assertEquals(6, self.adjust())
+
+        self.fill_slots()
+        self.assertEquals(7, self.adjust())
+        self.fill_slots()
+        self.assertEquals(8, self.adjust())
+        self.fill_slots()
+        self.assertEquals(8, self.adjust())
+
+    def testLatency(self):
+        """Tests the limit drops when tasks suddenly take longer."""
+        for i in xrange(10):
+            self.controller.acquire()
+            self.controller.release(1.0)
+        self.assertEquals(8, self.adjust())
+
+        for i in xrange(5):
+            self.controller.acquire()
+            self.controller.release(10.0)
+        self.assertEquals(6, self.adjust())
+        self.assertEquals('decrease', self.controller.last_decision)
+
+
+def main(argv):
+    logging.getLogger().setLevel(logging.DEBUG)
+    argv = FLAGS(argv)
+    unittest.main(argv=argv)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,468 @@
+#!/usr/bin/env python
+# Copyright 2013 Brett Slatkin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the image_diff module."""
+
+import Queue
+import json
+import math
+import multiprocessing
+import os
+import shutil
+import tempfile
+import unittest
+
+# Local Libraries
+import gflags
+FLAGS = gflags.FLAGS
+
+# Local modules
+from dpxdt.client import image_diff
+from dpxdt.client import pdiff_worker
+from dpxdt.client import release_worker
+from dpxdt.client import timer_worker
+from dpxdt.client import workers
+
+
+@unittest.skipIf(image_diff.numpy is None, 'numpy and Pillow not installed')
+class DiffImagesTest(unittest.TestCase):
+    """Tests for diff_images."""
+
+    def setUp(self):
+        """Sets up the test harness."""
+        self.output_dir = tempfile.mkdtemp()
+        self.diff_path = os.path.join(self.output_dir, 'diff.png')
+        self.log_path = os.path.join(self.output_dir, 'log.txt')
+
+    def tearDown(self):
+        """Cleans up the test harness."""
+        shutil.rmtree(self.output_dir, True)
+
+    def write_image(self, name, size, color, pixels=None, mode='RGB'):
+        path = os.path.join(self.output_dir, name)
+        image = image_diff.Image.new(mode, size, color)
+        for position, pixel_color in (pixels or {}).iteritems():
+            image.putpixel(position, pixel_color)
+        image.save(path, 'PNG')
+        return path
+
+    def diff(self, ref_path, run_path):
+        distortion = image_diff.diff_images(
+            ref_path, run_path, self.diff_path, self.log_path)
+        log_data = open(self.log_path).read()
+        parsed = float(pdiff_worker.DIFF_REGEX.findall(log_data)[0])
+        self.assertAlmostEquals(distortion, parsed, places=4)
+        return distortion
+
+    def testIdentical(self):
+        """Tests identical images have no distortion and no diff image."""
+        ref_path = self.write_image('ref', (10, 10), (10, 20, 30))
+        run_path = self.write_image('run', (10, 10), (10, 20, 30))
+        self.assertEquals(0, self.diff(ref_path, run_path))
+        self.assertIn('all: 0 (0)', open(self.log_path).read())
+        self.assertFalse(os.path.exists(self.diff_path))
+
+    def testOnePixel(self):
+        """Tests the RMSE across RGB channels for one changed pixel."""
+        ref_path = self.write_image('ref', (2, 2), (0, 0, 0))
+        run_path = self.write_image(
+            'run', (2, 2), (0, 0, 0), pixels={(1, 1): (255, 0, 0)})
+
+        # One of four pixels differs in one of three channels by the full
+        # range, so the mean squared error is 1/12.
+        self.assertAlmostEquals(
+            math.sqrt(1 / 12.0), self.diff(ref_path, run_path))
+
+        diff_image = image_diff.Image.open(self.diff_path).convert('RGBA')
+        self.assertEquals(image_diff.HIGHLIGHT_COLOR,
+                          diff_image.getpixel((1, 1)))
+        self.assertEquals(image_diff.LOWLIGHT_COLOR,
+                          diff_image.getpixel((0, 0)))
+
+    def testDifferentSizes(self):
+        """Tests the reference is padded or cropped to the run's size."""
+        small_path = self.write_image('small', (2, 1), (255, 255, 255))
+        large_path = self.write_image('large', (2, 2), (255, 255, 255))
+
+        # The padded row is transparent black, so it differs in all four
+        # channels for two of the four pixels.
+        self.assertAlmostEquals(
+            math.sqrt(0.5), self.diff(small_path, large_path))
+
+        # Cropping the top row of the larger image matches exactly.
+        self.assertEquals(0, self.diff(large_path, small_path))
+
+    def testPixelHash(self):
+        """Tests the pixel hash ignores how the image is encoded."""
+        ref_path = self.write_image('ref', (3, 2), (10, 20, 30))
+        from PIL import PngImagePlugin
+        run_path = os.path.join(self.output_dir, 'run')
+        info = PngImagePlugin.PngInfo()
+        info.add_text('Timestamp', '2013-06-01 12:00:00')
+        image_diff.Image.new('RGB', (3, 2), (10, 20, 30)).save(
+            run_path, 'PNG', pnginfo=info, compress_level=1)
+        self.assertNotEquals(open(ref_path).read(), open(run_path).read())
+
+        ref_image = image_diff.open_image(ref_path)
+        run_image = image_diff.open_image(run_path)
+        self.assertEquals(image_diff.pixel_hash(ref_image),
+                          image_diff.pixel_hash(run_image, tile_height=1))
+
+        # The same pixels in a different shape have a different hash.
+        other_path = self.write_image('other', (2, 3), (10, 20, 30))
+        self.assertNotEquals(
+            image_diff.pixel_hash(ref_image),
+            image_diff.pixel_hash(image_diff.open_image(other_path)))
+
+        # Diffing computes the same hashes as it goes.
+        self.assertEquals(
+            (0, image_diff.pixel_hash(ref_image),
+             image_diff.pixel_hash(run_image)),
+            image_diff.diff_open_images(
+                ref_image, run_image, ref_path, run_path,
+                self.diff_path, self.log_path, tile_height=1,
+                hash_pixels=True))
+        self.assertIn('all: 0 (0)', open(self.log_path).read())
+        self.assertFalse(os.path.exists(self.diff_path))
+
+        # A reference of another size is hashed in its own shape.
+        other_image = image_diff.open_image(other_path)
+        distortion, ref_pixel_hash, run_pixel_hash = (
+            image_diff.diff_open_images(
+                other_image, run_image, other_path, run_path,
+                self.diff_path, self.log_path, hash_pixels=True))
+        self.assertEquals(image_diff.pixel_hash(other_image), ref_pixel_hash)
+
+    def testTiles(self):
+        """Tests comparing in strips gives the same result as all at once."""
+        ref_path = self.write_image('ref', (4, 10), (0, 0, 0))
+        run_path = self.write_image(
+            'run', (4, 12), (0, 0, 0),
+            pixels={(0, 1): (255, 255, 255), (3, 8): (0, 255, 0)})
+
+        expected = self.diff(ref_path, run_path)
+        expected_diff = image_diff.load_image(self.diff_path)
+
+        distortion = image_diff.diff_images(
+            ref_path, run_path, self.diff_path, self.log_path,
+            tile_height=3)
+        self.assertAlmostEquals(expected, distortion)
+        self.assertEquals(expected_diff.tolist(),
+                          image_diff.load_image(self.diff_path).tolist())
+
+        log_data = open(self.log_path).read()
+        self.assertIn('rows 0-2: ', log_data)
+        self.assertIn('rows 3-5: 0 (0)', log_data)
+        self.assertIn('rows 9-11: ', log_data)
+        self.assertNotIn('Stopped early', log_data)
+
+    def testEarlyExit(self):
+        """Tests the comparison stops once the distortion is high enough."""
+        ref_path = self.write_image('ref', (2, 8), (0, 0, 0))
+        run_path = self.write_image('run', (2, 8), (255, 255, 255))
+
+        distortion = image_diff.diff_images(
+            ref_path, run_path, self.diff_path, self.log_path,
+            tile_height=2, max_distortion=0.2)
+
+        # Only the first two rows were compared, which is a quarter of the
+        # image, so the lower bound is half of the full distortion.
+        self.assertAlmostEquals(0.5, distortion)
+        log_data = open(self.log_path).read()
+        self.assertIn('Stopped early at row 2', log_data)
+        self.assertNotIn('rows 2-3', log_data)
+
+        diff_image = image_diff.Image.open(self.diff_path).convert('RGBA')
+        self.assertEquals(image_diff.HIGHLIGHT_COLOR,
+                          diff_image.getpixel((1, 1)))
+        self.assertEquals(image_diff.LOWLIGHT_COLOR,
+                          diff_image.getpixel((1, 2)))
+
+    def testRegions(self):
+        """Tests changed pixels are grouped into regions with bounding boxes."""
+        regions_path = os.path.join(self.output_dir, 'regions.json')
+        ref_path = self.write_image('ref', (40, 30), (0, 0, 0))
+        pixels = {
+            # Two cells that touch at a corner are one region.
+            (1, 1): (255, 255, 255),
+            (9, 9): (255, 255, 255),
+            (10, 9): (255, 255, 255),
+            # A separate region in the bottom-right corner cell, which is
+            # cut off by the edge of the image.
+            (39, 29): (0, 0, 255),
+        }
+        run_path = self.write_image('run', (40, 30), (0, 0, 0), pixels=pixels)
+
+        distortion = image_diff.diff_images(
+            ref_path, run_path, self.diff_path, self.log_path,
+            regions_path=regions_path, tile_height=4)
+
+        data = json.load(open(regions_path))
+        self.assertEquals(40, data['width'])
+        self.assertEquals(30, data['height'])
+        self.assertEquals(4, data['changed_pixels'])
+        self.assertEquals(2, data['region_count'])
+        self.assertAlmostEquals(distortion, data['distortion'])
+
+        first, second = data['regions']
+        self.assertEquals(
+            dict(left=0, top=0, width=16, height=16, pixels=3),
+            dict((k, v) for k, v in first.items() if k != 'intensity'))
+        self.assertAlmostEquals(1.0, first['intensity'])
+        self.assertEquals(
+            dict(left=32, top=24, width=8, height=6, pixels=1),
+            dict((k, v) for k, v in second.items() if k != 'intensity'))
+        self.assertAlmostEquals(math.sqrt(1 / 3.0), second['intensity'])
+
+    def testIgnoreRegions(self):
+        """Tests changes inside ignored regions don't count as different."""
+        regions_path = os.path.join(self.output_dir, 'regions.json')
+        ref_path = self.write_image('ref', (10, 10), (0, 0, 0))
+        run_path = self.write_image(
+            'run', (10, 10), (0, 0, 0),
+            pixels={(2, 2): (255, 255, 255), (8, 8): (255, 255, 255)})
+
+        self.assertEquals(0, image_diff.diff_images(
+            ref_path, run_path, self.diff_path, self.log_path,
+            regions_path=regions_path, tile_height=3,
+            ignore_regions=[(0, 0, 4, 4), (7, 7, 100, 100)]))
+        self.assertIn('Ignored regions: 2', open(self.log_path).read())
+        self.assertFalse(os.path.exists(self.diff_path))
+        self.assertFalse(os.path.exists(regions_path))
+
+        # Only the pixel outside of the ignored region is different.
+        distortion = image_diff.diff_images(
+            ref_path, run_path, self.diff_path, self.log_path,
+            regions_path=regions_path, ignore_regions=[(1, 1, 2, 2)])
+        self.assertAlmostEquals(0.1, distortion)
+        data = json.load(open(regions_path))
+        self.assertEquals(1, data['changed_pixels'])
+        self.assertEquals(8, data['regions'][0]['left'])
+
+    def testProcessPool(self):
+        """Tests diffing in a worker process gives the same result."""
+        ref_path = self.write_image('ref', (4, 4), (0, 0, 0))
+        run_path = self.write_image(
+            'run', (4, 4), (0, 0, 0), pixels={(2, 1): (255, 255, 255)})
+        expected = self.diff(ref_path, run_path)
+        expected_diff = image_diff.load_image(self.diff_path).tolist()
+        os.remove(self.diff_path)
+
+        pool = multiprocessing.Pool(1)
+        try:
+            distortion, ref_pixel_hash, run_pixel_hash = pool.apply(
+                pdiff_worker.run_image_diff,
+                (ref_path, run_path, self.diff_path, self.log_path, None,
+                 [], 2, None))
+        finally:
+            pool.terminate()
+
+        self.assertAlmostEquals(expected, distortion)
+        self.assertEquals(
+            expected_diff, image_diff.load_image(self.diff_path).tolist())
+        self.assertEquals(
+            image_diff.pixel_hash(image_diff.open_image(ref_path)),
+            ref_pixel_hash)
+        self.assertNotEquals(ref_pixel_hash, run_pixel_hash)
+
+    def testProcessPoolTimeout(self):
+        """Tests a diff that runs too long in a worker process fails."""
+        ref_path = self.write_image('ref', (2000, 2000), (0, 0, 0))
+        run_path = self.write_image('run', (2000, 2000), (1, 1, 1))
+        item = pdiff_worker.ImageDiffItem(
+            ref_path, run_path, self.diff_path, self.log_path)
+
+        original_timeout = FLAGS.pdiff_timeout
+        FLAGS.pdiff_timeout = 0
+        pool = multiprocessing.Pool(1)
+        try:
+            thread = pdiff_worker.ImageDiffThread(None, None, pool=pool)
+            self.assertRaises(pdiff_worker.PdiffFailedError,
+                              thread.handle_item, item)
+        finally:
+            pool.terminate()
+            FLAGS.pdiff_timeout = original_timeout
+
+    def testNoRegions(self):
+        """Tests no region summary is written for identical images."""
+        regions_path = os.path.join(self.output_dir, 'regions.json')
+        ref_path = self.write_image('ref', (10, 10), (10, 20, 30))
+        run_path = self.write_image('run', (10, 10), (10, 20, 30))
+        image_diff.diff_images(
+            ref_path, run_path, self.diff_path, self.log_path,
+            regions_path=regions_path)
+        self.assertFalse(os.path.exists(regions_path))
+
+
+class FakeReportPdiffWorkflow(workers.WorkflowItem):
+    """Records reported pdiff results instead of sending them."""
+
+    reports = []
+
+    def run(self, build_id, release_name, release_number, run_name,
+            diff_path=None, log_path=None, diff_failed=False, distortion=None,
+            **kwargs):
+        yield []  # Make this into a generator
+        log_data = None
+        if log_path:
+            log_data = open(log_path).read()
+        FakeReportPdiffWorkflow.reports.append(
+            (run_name, diff_failed, distortion, log_data))
+
+
+@unittest.skipIf(image_diff.numpy is None, 'numpy and Pillow not installed')
+class DoPdiffQueueWorkflowTest(unittest.TestCase):
+    """Tests for DoPdiffQueueWorkflow with the numpy engine."""
+
+    def setUp(self):
+        """Sets up the test harness."""
+        FLAGS.pdiff_engine = 'numpy'
+        self.output_dir = tempfile.mkdtemp()
+        self.original_report = release_worker.ReportPdiffWorkflow
+        release_worker.ReportPdiffWorkflow = FakeReportPdiffWorkflow
+        FakeReportPdiffWorkflow.reports = []
+
+        self.coordinator = workers.get_coordinator()
+        diff_queue = Queue.Queue()
+        self.coordinator.register(pdiff_worker.ImageDiffItem, diff_queue)
+        self.coordinator.worker_threads.append(
+            pdiff_worker.ImageDiffThread(
+                diff_queue, self.coordinator.input_queue))
+        self.coordinator.start()
+
+    def tearDown(self):
+        """Cleans up the test harness."""
+        self.coordinator.stop()
+        self.coordinator.join()
+        release_worker.ReportPdiffWorkflow = self.original_report
+        FLAGS.pdiff_engine = 'imagemagick'
+        shutil.rmtree(self.output_dir, True)
+
+    def testUndecodableImage(self):
+        """Tests an image that can't be decoded fails the diff."""
+        ref_path = os.path.join(self.output_dir, 'ref')
+        image_diff.Image.new('RGB', (4, 4)).save(ref_path, 'PNG')
+        run_path = os.path.join(self.output_dir, 'run')
+        with open(run_path, 'w') as run_file:
+            run_file.write('not a png')
+
+        item = pdiff_worker.DoPdiffQueueWorkflow(
+            build_id=1, release_name='release', release_number=1,
+            run_name='run', reference_sha1sum='ref', run_sha1sum='run',
+            heartbeat=lambda message: [],
+            downloads={'ref': ref_path, 'run': run_path})
+        item.root = True
+        self.coordinator.input_queue.put(item)
+        self.assertRaises(pdiff_worker.PdiffFailedError,
+                          self.coordinator.wait_one)
+
+        self.assertEquals(1, len(FakeReportPdiffWorkflow.reports))
+        run_name, diff_failed, distortion, log_data = (
+            FakeReportPdiffWorkflow.reports[0])
+        self.assertEquals('run', run_name)
+        self.assertTrue(diff_failed)
+        self.assertEquals(None, distortion)
+        self.assertIn('IOError', log_data)
+
+
+class FakePdiffQueueWorkflow(workers.WorkflowItem):
+    """Stands in for DoPdiffQueueWorkflow and tracks how many are running."""
+
+    running = 0
+    max_running = 0
+
+    def run(self, downloads=None, **kwargs):
+        cls = FakePdiffQueueWorkflow
+        cls.running += 1
+        cls.max_running = max(cls.max_running, cls.running)
+        try:
+            yield timer_worker.TimerItem(0.05)
+        finally:
+            cls.running -= 1
+
+
+class RecordHeartbeatWorkflow(workers.WorkflowItem):
+    """Stands in for a heartbeat and saves its message in a list."""
+
+    def run(self, message_list, message):
+        yield []  # Make this into a generator
+        message_list.append(message)
+
+
+class DoPdiffBatchWorkflowTest(unittest.TestCase):
+    """Tests for DoPdiffBatchWorkflow."""
+
+    def setUp(self):
+        """Sets up the test harness."""
+        self.original_threads = FLAGS.pdiff_threads
+        self.original_flush_seconds = FLAGS.queue_update_flush_seconds
+        self.original_workflow = pdiff_worker.DoPdiffQueueWorkflow
+        pdiff_worker.DoPdiffQueueWorkflow = FakePdiffQueueWorkflow
+        FakePdiffQueueWorkflow.max_running = 0
+
+        self.coordinator = workers.get_coordinator()
+        timer_worker.register(self.coordinator)
+        self.coordinator.start()
+
+    def tearDown(self):
+        """Cleans up the test harness."""
+        self.coordinator.stop()
+        self.coordinator.join()
+        pdiff_worker.DoPdiffQueueWorkflow = self.original_workflow
+        FLAGS.pdiff_threads = self.original_threads
+        FLAGS.queue_update_flush_seconds = self.original_flush_seconds
+
+    def testConcurrencyLimit(self):
+        """Tests a batch runs at most --pdiff_threads diffs at a time."""
+        FLAGS.pdiff_threads = 2
+        payload_list = [
+            dict(reference_sha1sum='same', run_sha1sum='same',
+                 heartbeat=lambda message: [])
+            for _ in xrange(5)]
+
+        item = pdiff_worker.DoPdiffBatchWorkflow(payload_list)
+        item.root = True
+        self.coordinator.input_queue.put(item)
+        self.coordinator.wait_one()
+
+        self.assertEquals([None] * 5, item.result)
+        self.assertEquals(2, FakePdiffQueueWorkflow.max_running)
+
+    def testHeartbeatWhileWaiting(self):
+        """Tests tasks waiting for a diff thread keep their leases alive."""
+        FLAGS.pdiff_threads = 1
+        FLAGS.queue_update_flush_seconds = 0.01
+        heartbeats = [[] for _ in xrange(3)]
+        payload_list = [
+            dict(reference_sha1sum='same', run_sha1sum='same',
+                 heartbeat=lambda message, i=i: RecordHeartbeatWorkflow(
+                     heartbeats[i], message))
+            for i in xrange(3)]
+
+        item = pdiff_worker.DoPdiffBatchWorkflow(payload_list)
+        item.root = True
+        self.coordinator.input_queue.put(item)
+        self.coordinator.wait_one()
+
+        self.assertEquals([None] * 3, item.result)
+        self.assertEquals([], heartbeats[0])
+        self.assertTrue(len(heartbeats[2]) > len(heartbeats[1]) > 1,
+                        heartbeats)
+        self.assertEquals(
+            set(['Waiting for a free diff thread']), set(heartbeats[2]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# Copyright 2013 Brett Slatkin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the masks module."""
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+# Local modules
+from dpxdt.client import masks
+
+
+class BuildMaskTest(unittest.TestCase):
+    """Tests for build_mask."""
+
+    def setUp(self):
+        """Sets up the test harness."""
+        self.output_dir = tempfile.mkdtemp()
+        self.config_path = os.path.join(self.output_dir, 'config.json')
+        self.image_path = os.path.join(self.output_dir, 'capture.png')
+        self.mask_path = os.path.join(self.output_dir, 'mask.json')
+
+    def tearDown(self):
+        """Cleans up the test harness."""
+        shutil.rmtree(self.output_dir, True)
+
+    def write_config(self, config):
+        with open(self.config_path, 'w') as config_file:
+            json.dump(config, config_file)
+
+    def build(self):
+        return masks.build_mask(
+            self.config_path, self.image_path, self.mask_path)
+
+    def testNoRegions(self):
+        """Tests no mask is written when the config ignores nothing."""
+        self.write_config({'targetUrl': 'http://example.com'})
+        self.assertEquals(None, self.build())
+        self.assertFalse(os.path.exists(self.mask_path))
+
+    def testCombined(self):
+        """Tests fixed rectangles and selector rectangles are combined."""
+        self.write_config({'ignoreRegions': [
+            {'left': 0, 'top': 10, 'width': 100, 'height': 20},
+            {'selector': '.carousel'},
+        ]})
+        masks.write_mask(
+            self.image_path + masks.BROWSER_MASK_SUFFIX, [(5, 500, 10, 10)])
+
+        self.assertEquals(self.mask_path, self.build())
+        self.assertEquals(
+            [(0, 10, 100, 20), (5, 500, 10, 10)],
+            masks.read_mask(self.mask_path))
+        self.assertEquals(
+            masks.MASK_VERSION, json.load(open(self.mask_path))['version'])
+
+    def testSelectorMatchedNothing(self):
+        """Tests no mask is written when selectors match no elements."""
+        self.write_config({'ignoreRegions': [{'selector': '#missing'}]})
+        self.assertEquals(None, self.build())
+
+    def testBadRegion(self):
+        """Tests invalid rectangles are rejected."""
+        self.write_config({'ignoreRegions': [{'left': 0, 'top': 10}]})
+        self.assertRaises(masks.BadRegionError, self.build)
+
+        self.write_config({'ignoreRegions': [
+            {'left': 0, 'top': 10, 'width': -1, 'height': 5}]})
+        self.assertRaises(masks.BadRegionError, self.build)
+
+
+if __name__ == '__main__':
+    unittest.main()
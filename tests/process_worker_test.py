@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# Copyright 2013 Brett Slatkin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the process_worker module."""
+
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+# Local Libraries
+import gflags
+FLAGS = gflags.FLAGS
+
+# Local modules
+from dpxdt.client import process_worker
+from dpxdt.client import workers
+
+
+class CommandWorkflow(process_worker.ProcessWorkflow):
+    """Runs the given command."""
+
+    def __init__(self, log_path, args, **kwargs):
+        process_worker.ProcessWorkflow.__init__(self, log_path, **kwargs)
+        self.command = args
+
+    def get_args(self):
+        return self.command
+
+
+class ProcessWorkflowTest(unittest.TestCase):
+    """Tests for the ProcessWorkflow and ProcessThread."""
+
+    def setUp(self):
+        """Sets up the test harness."""
+        FLAGS.polltime = 1
+        self.output_dir = tempfile.mkdtemp()
+        self.log_path = os.path.join(self.output_dir, 'log.txt')
+        self.coordinator = workers.get_coordinator()
+        process_worker.register(self.coordinator)
+        self.coordinator.start()
+
+    def tearDown(self):
+        """Cleans up the test harness."""
+        self.coordinator.stop()
+        self.coordinator.join()
+        shutil.rmtree(self.output_dir, True)
+
+    def run_command(self, args, **kwargs):
+        item = CommandWorkflow(self.log_path, args, **kwargs)
+        item.root = True
+        self.coordinator.input_queue.put(item)
+        self.coordinator.wait_one()
+        return item
+
+    def testExitImmediately(self):
+        """Tests that exits are seen without waiting out the poll time."""
+        start = time.time()
+        for i in xrange(5):
+            item = self.run_command([sys.executable, '-c', 'pass'])
+            self.assertEquals(0, item.result)
+        # SIGCHLD wakes the reaper, so it never waits out the poll time.
+        self.assertTrue(time.time() - start < FLAGS.polltime)
+
+    def testReturnCode(self):
+        """Tests that the subprocess return code is the result."""
+        item = self.run_command(
+            [sys.executable, '-c', 'import sys; sys.exit(3)'])
+        self.assertEquals(3, item.result)
+
+    def testTimeout(self):
+        """Tests that a subprocess past its deadline is killed."""
+        start = time.time()
+        self.assertRaises(
+            process_worker.TimeoutError,
+            self.run_command,
+            [sys.executable, '-c', 'import time; time.sleep(30)'],
+            timeout_seconds=0.5)
+        self.assertTrue(time.time() - start < 5)
+
+    def testManyTimeouts(self):
+        """Tests tracking the deadlines of several subprocesses at once."""
+        items = [
+            CommandWorkflow(
+                self.log_path,
+                [sys.executable, '-c', 'import time; time.sleep(30)'],
+                timeout_seconds=timeout)
+            for timeout in (1.5, 0.2, 30)]
+        items[2].command = [sys.executable, '-c', 'pass']
+        for item in items:
+            item.root = True
+            self.coordinator.input_queue.put(item)
+        for i in xrange(len(items)):
+            try:
+                self.coordinator.wait_one()
+            except process_worker.TimeoutError:
+                pass
+
+        self.assertTrue(
+            isinstance(items[0].error[1], process_worker.TimeoutError))
+        self.assertTrue(
+            isinstance(items[1].error[1], process_worker.TimeoutError))
+        self.assertEquals(0, items[2].result)
+
+    def testUsageLogged(self):
+        """Tests that peak memory and CPU time are written to the log."""
+        item = self.run_command(
+            [sys.executable, '-c', 'x = "a" * (50 * 1024 * 1024)'])
+        self.assertEquals(0, item.result)
+        log = open(self.log_path).read()
+        self.assertTrue('Process usage: peak_rss_mb=' in log, log)
+        peak_rss_mb = float(log.split('peak_rss_mb=')[1].split(',')[0])
+        self.assertTrue(peak_rss_mb >= 50, peak_rss_mb)
+
+    def testMemoryLimit(self):
+        """Tests that a subprocess can't allocate past its memory limit."""
+        command = [sys.executable, '-c', 'x = "a" * (500 * 1024 * 1024)']
+        self.assertNotEquals(
+            0, self.run_command(command, memory_limit_mb=200).result)
+        self.assertEquals(0, self.run_command(command).result)
+
+    def testCpuLimit(self):
+        """Tests that a subprocess is killed when it uses too much CPU."""
+        item = self.run_command(
+            [sys.executable, '-c', 'while True: pass'],
+            cpu_limit_seconds=1)
+        self.assertTrue(item.result < 0, item.result)
+
+    def testTimeoutKillsProcessGroup(self):
+        """Tests that children of a subprocess are killed on timeout."""
+        pid_path = os.path.join(self.output_dir, 'pid.txt')
+        script = (
+            'import subprocess, sys, time\n'
+            'child = subprocess.Popen([sys.executable, "-c", '
+            '"import time; time.sleep(30)"])\n'
+            'open(%r, "w").write(str(child.pid))\n'
+            'time.sleep(30)\n' % pid_path)
+        self.assertRaises(
+            process_worker.TimeoutError,
+            self.run_command,
+            [sys.executable, '-c', script],
+            timeout_seconds=1)
+
+        child_pid = int(open(pid_path).read())
+        # The grandchild is reparented and reaped by init once killed.
+        for i in xrange(50):
+            try:
+                os.kill(child_pid, 0)
+            except OSError:
+                break
+            time.sleep(0.1)
+        else:
+            self.fail('Child pid=%d is still running' % child_pid)
+
+
+def main(argv):
+    logging.getLogger().setLevel(logging.DEBUG)
+    argv = FLAGS(argv)
+    unittest.main(argv=argv)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -24,6 +24,7 @@ import unittest
 # Local Libraries
 import gflags
 FLAGS = gflags.FLAGS
+from sqlalchemy.orm import Query
 
 # Local modules
 from dpxdt.client import fetch_worker
@@ -53,9 +54,62 @@ def setUpModule():
 
 class TestQueueWorkflow(workers.WorkflowItem):
     def run(self, foo=None, bar=None, baz=None, heartbeat=None):
+        yield heartbeat('Starting the workflow')
         yield heartbeat('Inside the workflow!')
 
 
+class SlowQueueWorkflow(workers.WorkflowItem):
+    def run(self, seconds=None, heartbeat=None):
+        yield heartbeat('Sleeping')
+        yield timer_worker.TimerItem(seconds)
+
+
+class LostLeaseQueueWorkflow(workers.WorkflowItem):
+    errors = []
+
+    def run(self, foo=None, heartbeat=None):
+        try:
+            for i in xrange(100):
+                yield heartbeat('Working %d' % i)
+                yield timer_worker.TimerItem(0.05)
+        except queue_worker.HeartbeatError, e:
+            LostLeaseQueueWorkflow.errors.append(e)
+            raise
+
+
+class FollowOnQueueWorkflow(workers.WorkflowItem):
+    events = []
+
+    def run(self, name=None, seconds=None, heartbeat=None):
+        FollowOnQueueWorkflow.events.append('start %s' % name)
+        yield heartbeat('Starting')
+        raise workers.Return(queue_worker.FollowOn(
+            FollowOnWorkflow(name, seconds, heartbeat)))
+
+
+class FollowOnWorkflow(workers.WorkflowItem):
+    def run(self, name, seconds, heartbeat):
+        yield heartbeat('Following on')
+        yield timer_worker.TimerItem(seconds)
+        FollowOnQueueWorkflow.events.append('done %s' % name)
+
+
+class TestBatchWorkflow(workers.WorkflowItem):
+    batches = []
+
+    def run(self, payload_list):
+        TestBatchWorkflow.batches.append(
+            [payload['release'] for payload in payload_list])
+        yield [payload['heartbeat']('In a batch') for payload in payload_list]
+        error_list = []
+        for payload in payload_list:
+            if payload['fail']:
+                error_list.append(queue_worker.GiveUpAfterAttemptsError(1))
+            else:
+                error_list.append(None)
+        raise workers.Return(error_list)
+
+
 class RemoteQueueWorkflowTest(unittest.TestCase):
     """Tests for the RemoteQueueWorkflow."""
 
@@ -63,6 +117,7 @@ class RemoteQueueWorkflowTest(unittest.TestCase):
         """Sets up the test harness."""
         FLAGS.queue_idle_poll_seconds = 0.01
         FLAGS.queue_busy_poll_seconds = 0.01
+        FLAGS.queue_update_flush_seconds = 0.01
         self.coordinator = workers.get_coordinator()
         fetch_worker.register(self.coordinator)
         timer_worker.register(self.coordinator)
@@ -100,6 +155,380 @@ class RemoteQueueWorkflowTest(unittest.TestCase):
         for task_id in task_ids:
             found = work_queue.WorkQueue.query.get((task_id, TEST_QUEUE))
             self.assertEquals(work_queue.WorkQueue.DONE, found.status)
+            self.assertEquals('Inside the workflow!', found.heartbeat)
+            self.assertEquals(1, found.heartbeat_number)
+
+    def testLostLease(self):
+        """Tests a task stops when the server rejects its heartbeats."""
+        queue_name = TEST_QUEUE + '-lost'
+        task_id = work_queue.add(queue_name, payload={'foo': 1})
+        db.session.commit()
+
+        item = queue_worker.RemoteQueueWorkflow(
+            queue_name,
+            LostLeaseQueueWorkflow,
+            max_tasks=1)
+        item.root = True
+        self.coordinator.input_queue.put(item)
+        time.sleep(0.5)
+
+        task = work_queue.WorkQueue.query.get((task_id, queue_name))
+        task.last_owner = 'someone-else'
+        db.session.add(task)
+        db.session.commit()
+
+        time.sleep(0.5)
+        item.stop()
+        self.coordinator.wait_one()
+
+        self.assertEquals(1, len(LostLeaseQueueWorkflow.errors))
+        self.assertTrue('NotOwnerError' in
+                        str(LostLeaseQueueWorkflow.errors[0]))
+        db.session.expire_all()
+        task = work_queue.WorkQueue.query.get((task_id, queue_name))
+        self.assertEquals(work_queue.WorkQueue.LIVE, task.status)
+        self.assertEquals('someone-else', task.last_owner)
+
+    def testPrefetchAndRelease(self):
+        """Tests prefetched tasks are released when the worker stops."""
+        FLAGS.queue_prefetch_tasks = 2
+        queue_name = TEST_QUEUE + '-prefetch'
+        for i in xrange(5):
+            work_queue.add(queue_name, payload={'seconds': 1})
+        db.session.commit()
+
+        item = queue_worker.RemoteQueueWorkflow(
+            queue_name,
+            SlowQueueWorkflow,
+            max_tasks=1)
+        item.root = True
+        self.coordinator.input_queue.put(item)
+        time.sleep(0.5)
+        item.stop()
+        self.coordinator.wait_one()
+        FLAGS.queue_prefetch_tasks = 0
+
+        # Let the stopped update flusher wind down.
+        time.sleep(0.1)
+
+        # The task that already started runs to completion and is finished
+        # before the worker stops.
+        db.session.expire_all()
+        task_list = work_queue.WorkQueue.query.filter_by(
+            queue_name=queue_name).all()
+        self.assertEquals(
+            [0, 0, 0, 0, 1], sorted(t.lease_attempts for t in task_list))
+        self.assertEquals(
+            1, len([t for t in task_list if t.last_owner]))
+        self.assertEquals(
+            [work_queue.WorkQueue.DONE],
+            [t.status for t in task_list if t.last_owner])
+
+
+    def testFollowOn(self):
+        """Tests follow-on work runs after its task frees the slot."""
+        queue_name = TEST_QUEUE + '-follow-on'
+        task_ids = []
+        for name, seconds in (('a', 0.2), ('b', 1), ('c', 0.2)):
+            task_ids.append(work_queue.add(
+                queue_name, payload={'name': name, 'seconds': seconds}))
+        db.session.commit()
+
+        FLAGS.queue_prefetch_tasks = 2
+        item = queue_worker.RemoteQueueWorkflow(
+            queue_name,
+            FollowOnQueueWorkflow,
+            max_tasks=1)
+        item.root = True
+        self.coordinator.input_queue.put(item)
+        time.sleep(2)
+        item.stop()
+        self.coordinator.wait_one()
+        FLAGS.queue_prefetch_tasks = 0
+        time.sleep(0.1)
+
+        # The second task starts while the first one follows on, but the
+        # third waits for a follow-on to finish.
+        events = FollowOnQueueWorkflow.events
+        self.assertEquals(
+            ['start a', 'start b', 'done a', 'start c', 'done c', 'done b'],
+            events)
+
+        db.session.expire_all()
+        for task_id in task_ids:
+            task = work_queue.WorkQueue.query.get((task_id, queue_name))
+            self.assertEquals(work_queue.WorkQueue.DONE, task.status)
+            self.assertEquals('Following on', task.heartbeat)
+
+    def testBatches(self):
+        """Tests tasks are run in batches from the same release."""
+        queue_name = TEST_QUEUE + '-batches'
+        task_ids = []
+        for i in xrange(5):
+            release_id = 100 + i % 2
+            task_ids.append(work_queue.add(
+                queue_name,
+                payload={'release': release_id, 'fail': i == 4},
+                release_id=release_id))
+        db.session.commit()
+
+        item = queue_worker.RemoteQueueWorkflow(
+            queue_name,
+            TestQueueWorkflow,
+            max_tasks=1,
+            local_batch_workflow=TestBatchWorkflow,
+            batch_size=2)
+        item.root = True
+        self.coordinator.input_queue.put(item)
+        time.sleep(2)
+        item.stop()
+        self.coordinator.wait_one()
+
+        batches = TestBatchWorkflow.batches
+        self.assertEquals(5, sum(len(b) for b in batches))
+        for batch in batches:
+            self.assertTrue(len(batch) <= 2)
+            self.assertEquals(1, len(set(batch)))
+
+        db.session.expire_all()
+        status_list = [
+            work_queue.WorkQueue.query.get((task_id, queue_name)).status
+            for task_id in task_ids]
+        self.assertEquals([work_queue.WorkQueue.DONE] * 4 +
+                          [work_queue.WorkQueue.ERROR], status_list)
+
+
+class TaskUpdateBatchTest(unittest.TestCase):
+    """Tests for the TaskUpdateBatch."""
+
+    def testCoalesce(self):
+        """Tests that only the latest heartbeat for each task is kept."""
+        batch = queue_worker.TaskUpdateBatch()
+        batch.heartbeat('one', 'first', 0)
+        batch.heartbeat('one', 'third', 2)
+        batch.heartbeat('one', 'second', 1)
+        batch.heartbeat('two', 'other', 0)
+        batch.finish('two', error=True)
+        self.assertEquals(3, len(batch))
+
+        heartbeats, finishes = batch.take()
+        self.assertEquals(
+            {'one': ('third', 2), 'two': ('other', 0)}, heartbeats)
+        self.assertEquals({'two': True}, finishes)
+        self.assertEquals(0, len(batch))
+
+        batch.heartbeat('one', 'fourth', 3)
+        batch.restore(heartbeats, finishes)
+        heartbeats, finishes = batch.take()
+        self.assertEquals(
+            {'one': ('fourth', 3), 'two': ('other', 0)}, heartbeats)
+        self.assertEquals({'two': True}, finishes)
+
+    def testLose(self):
+        """Tests rejected heartbeats are only kept for running tasks."""
+        batch = queue_worker.TaskUpdateBatch()
+        batch.start('one')
+        batch.heartbeat('one', 'first', 0)
+        batch.finish('one')
+        batch.lose('one', 'LeaseExpiredError: gone')
+        batch.lose('two', 'LeaseExpiredError: gone')
+        self.assertEquals({'one': 'LeaseExpiredError: gone'}, batch.lost)
+        self.assertEquals(0, len(batch))
+
+        batch.stop('one')
+        self.assertEquals({}, batch.lost)
+
+
+class WorkQueueBatchTest(unittest.TestCase):
+    """Tests for batch updates to the work queue."""
+
+    def testHeartbeatAndFinishMany(self):
+        """Tests applying many heartbeats and finishes in one transaction."""
+        queue_name = TEST_QUEUE + '-batch'
+        task_ids = [work_queue.add(queue_name, payload={'foo': i})
+                    for i in xrange(3)]
+        db.session.commit()
+        work_queue.lease(queue_name, 'me', count=2)
+        db.session.commit()
+
+        leased = [t for t in task_ids
+                  if work_queue.WorkQueue.query.get((t, queue_name))
+                  .last_owner == 'me']
+        self.assertEquals(2, len(leased))
+        not_leased = (set(task_ids) - set(leased)).pop()
+
+        error_dict = work_queue.heartbeat_many(queue_name, 'me', [
+            (leased[0], 'old', 0),
+            (leased[0], 'new', 1),
+            (leased[1], 'other', 0),
+            (not_leased, 'nope', 0),
+            ('missing', 'nope', 0),
+        ])
+        db.session.commit()
+        self.assertEquals(set([not_leased, 'missing']), set(error_dict))
+        self.assertTrue(isinstance(
+            error_dict['missing'], work_queue.TaskDoesNotExistError))
+        self.assertEquals(
+            'new',
+            work_queue.WorkQueue.query.get((leased[0], queue_name)).heartbeat)
+
+        error_dict = work_queue.finish_many(queue_name, 'someone-else', [
+            (leased[0], False),
+        ])
+        self.assertTrue(isinstance(
+            error_dict[leased[0]], work_queue.NotOwnerError))
+
+        error_dict = work_queue.finish_many(queue_name, 'me', [
+            (leased[0], False),
+            (leased[1], True),
+        ])
+        db.session.commit()
+        self.assertEquals({}, error_dict)
+        self.assertEquals(
+            work_queue.WorkQueue.DONE,
+            work_queue.WorkQueue.query.get((leased[0], queue_name)).status)
+        self.assertEquals(
+            work_queue.WorkQueue.ERROR,
+            work_queue.WorkQueue.query.get((leased[1], queue_name)).status)
+
+
+    def testLeaseGroupByRelease(self):
+        """Tests leasing only tasks from the release of the oldest task."""
+        queue_name = TEST_QUEUE + '-group'
+        for release_id in (1, 2, 1, 2, 1):
+            work_queue.add(queue_name, payload={'foo': 1}, release_id=release_id)
+        db.session.commit()
+
+        task_list = work_queue.lease(
+            queue_name, 'me', count=5, group_by_release=True)
+        db.session.commit()
+        self.assertEquals([1, 1, 1], [t['release_id'] for t in task_list])
+
+        task_list = work_queue.lease(
+            queue_name, 'me', count=5, group_by_release=True)
+        db.session.commit()
+        self.assertEquals([2, 2], [t['release_id'] for t in task_list])
+
+
+class WorkQueueStatsTest(unittest.TestCase):
+    """Tests for the materialized work queue statistics."""
+
+    def get_counts(self, queue_name):
+        return dict(
+            (stats.status, stats.count)
+            for stats in work_queue.WorkQueueStats.query.filter_by(
+                queue_name=queue_name))
+
+    def testCounters(self):
+        """Tests counters stay in sync with the WorkQueue table."""
+        queue_name = TEST_QUEUE + '-stats'
+        task_ids = [work_queue.add(queue_name, payload={'foo': i})
+                    for i in xrange(4)]
+        db.session.commit()
+        self.assertEquals({'live': 4}, self.get_counts(queue_name))
+
+        work_queue.lease(queue_name, 'me', count=2)
+        db.session.commit()
+        leased = [t for t in task_ids
+                  if work_queue.WorkQueue.query.get((t, queue_name))
+                  .last_owner == 'me']
+
+        work_queue.finish_many(queue_name, 'me', [
+            (leased[0], False),
+            (leased[1], True),
+        ])
+        db.session.commit()
+        self.assertEquals({'live': 2, 'done': 1, 'error': 1},
+                          self.get_counts(queue_name))
+
+        work_queue.cancel(queue_name=queue_name)
+        db.session.commit()
+        self.assertEquals({'live': 0, 'done': 0, 'error': 0, 'canceled': 4},
+                          self.get_counts(queue_name))
+
+        stats = work_queue.WorkQueueStats.query.get((queue_name, 'canceled'))
+        newest_task = (
+            work_queue.WorkQueue.query
+            .filter_by(queue_name=queue_name)
+            .order_by(work_queue.WorkQueue.created.desc())
+            .first())
+        self.assertEquals(newest_task.created, stats.newest_created)
+
+        rate_list = work_queue.WorkQueueRate.query.filter_by(
+            queue_name=queue_name).all()
+        self.assertEquals(4, sum(r.added for r in rate_list))
+        self.assertEquals(2, sum(r.leased for r in rate_list))
+        self.assertEquals(1, sum(r.finished for r in rate_list))
+        self.assertEquals(1, sum(r.errors for r in rate_list))
+
+        task = work_queue.WorkQueue.query.get((task_ids[0], queue_name))
+        work_queue.retry(task)
+        db.session.commit()
+        work_queue.delete(
+            work_queue.WorkQueue.query.get((task_ids[1], queue_name)))
+        db.session.commit()
+        self.assertEquals({'live': 1, 'done': 0, 'error': 0, 'canceled': 2},
+                          self.get_counts(queue_name))
+
+    def testAppliedOnCommit(self):
+        """Tests counter changes are merged and dropped on rollback."""
+        queue_name = TEST_QUEUE + '-stats-commit'
+        work_queue.add(queue_name, payload={'foo': 1})
+        db.session.rollback()
+        work_queue.add(queue_name, payload={'foo': 2})
+        work_queue.add(queue_name, payload={'foo': 3})
+        self.assertEquals({}, self.get_counts(queue_name))
+
+        db.session.commit()
+        self.assertEquals({'live': 2}, self.get_counts(queue_name))
+
+    def testRebuild(self):
+        """Tests rebuilding repairs counters that drifted."""
+        queue_name = TEST_QUEUE + '-stats-rebuild'
+        work_queue.add(queue_name, payload={'foo': 1})
+        db.session.commit()
+        stats = work_queue.WorkQueueStats.query.get((queue_name, 'live'))
+        stats.count = -3
+        db.session.add(stats)
+        db.session.commit()
+
+        work_queue.rebuild_stats()
+        db.session.commit()
+        self.assertEquals({'live': 1}, self.get_counts(queue_name))
+        self.assertFalse(work_queue.ensure_stats())
+
+        work_queue.WorkQueueStats.query.delete()
+        db.session.commit()
+        self.assertTrue(work_queue.ensure_stats())
+        db.session.commit()
+        self.assertEquals({'live': 1}, self.get_counts(queue_name))
+        self.assertFalse(work_queue.ensure_stats())
+
+    def testConcurrentCreate(self):
+        """Tests a counter row created by another transaction is reused."""
+        queue_name = TEST_QUEUE + '-stats-race'
+        work_queue.add(queue_name, payload={'foo': 1})
+        db.session.commit()
+
+        # Pretend the row didn't exist yet when the first update ran, as
+        # if another transaction inserted it right after.
+        original_update = Query.update
+        missed = []
+        def racy_update(query, *args, **kwargs):
+            if not missed:
+                missed.append(query)
+                return 0
+            return original_update(query, *args, **kwargs)
+
+        Query.update = racy_update
+        try:
+            work_queue.add(queue_name, payload={'foo': 2})
+            db.session.commit()
+        finally:
+            Query.update = original_update
+
+        self.assertEquals(1, len(missed))
+        self.assertEquals({'live': 2}, self.get_counts(queue_name))
 
 
 def main(argv):
@@ -245,6 +245,125 @@ class SiteDiffTest(unittest.TestCase):
         test.shutdown()
 
 
+class CrawlFrontierTest(unittest.TestCase):
+    """Tests for the CrawlFrontier."""
+
+    def crawl(self, links, max_depth=-1, max_inflight=10,
+              max_inflight_per_host=10):
+        """Crawls a fake site, finishing the last URL started first.
+
+        Args:
+            links: Maps each URL to the URLs its page links to.
+
+        Returns:
+            Tuple (list of URLs in the order they were fetched, frontier).
+        """
+        frontier = site_diff.CrawlFrontier(
+            max_depth, max_inflight, max_inflight_per_host)
+        frontier.add('http://a/', 0)
+        fetched = []
+        inflight = []
+        while True:
+            inflight.extend(frontier.start_ready())
+            if not inflight:
+                break
+            url = inflight.pop()
+            fetched.append(url)
+            frontier.finish(url, set(links.get(url, [])))
+        return fetched, frontier
+
+    def testDepth(self):
+        """Tests URLs deeper than the limit aren't fetched."""
+        links = {
+            'http://a/': ['http://a/1'],
+            'http://a/1': ['http://a/2'],
+            'http://a/2': ['http://a/3'],
+        }
+        fetched, _ = self.crawl(links, max_depth=1)
+        self.assertEquals(['http://a/', 'http://a/1'], fetched)
+        fetched, _ = self.crawl(links, max_depth=0)
+        self.assertEquals(['http://a/'], fetched)
+        fetched, _ = self.crawl(links)
+        self.assertEquals(4, len(fetched))
+
+    def testShorterPathFoundLater(self):
+        """Tests depths are the fewest clicks even when found out of order.
+
+        Here /deep is first found three clicks away, past the limit, but it
+        is also linked from /b, one click away.
+        """
+        links = {
+            'http://a/': ['http://a/b', 'http://a/c'],
+            'http://a/b': ['http://a/deep'],
+            'http://a/c': ['http://a/c2'],
+            'http://a/c2': ['http://a/deep'],
+            'http://a/deep': ['http://a/deeper'],
+        }
+        frontier = site_diff.CrawlFrontier(2, 10, 10)
+        frontier.add('http://a/', 0)
+        self.assertEquals(['http://a/'], frontier.start_ready())
+        frontier.finish('http://a/', set(links['http://a/']))
+        self.assertEquals(
+            set(['http://a/b', 'http://a/c']), set(frontier.start_ready()))
+        frontier.finish('http://a/c', set(links['http://a/c']))
+        self.assertEquals(['http://a/c2'], frontier.start_ready())
+        frontier.finish('http://a/c2', set(links['http://a/c2']))
+        self.assertEquals(3, frontier.depths['http://a/deep'])
+        self.assertEquals([], frontier.start_ready())
+
+        frontier.finish('http://a/b', set(links['http://a/b']))
+        self.assertEquals(2, frontier.depths['http://a/deep'])
+        self.assertEquals(['http://a/deep'], frontier.start_ready())
+        frontier.finish('http://a/deep', set(links['http://a/deep']))
+        self.assertEquals([], frontier.start_ready())
+
+    def testRelaxFetchedPage(self):
+        """Tests a fetched page's links move closer with the page."""
+        frontier = site_diff.CrawlFrontier(2, 10, 10)
+        frontier.add('http://a/', 0)
+        frontier.start_ready()
+        frontier.add('http://a/x', 2)
+        frontier.start_ready()
+        frontier.finish('http://a/x', set(['http://a/y']))
+        self.assertEquals(3, frontier.depths['http://a/y'])
+        self.assertEquals([], frontier.start_ready())
+
+        frontier.finish('http://a/', set(['http://a/x']))
+        self.assertEquals(1, frontier.depths['http://a/x'])
+        self.assertEquals(2, frontier.depths['http://a/y'])
+        self.assertEquals(['http://a/y'], frontier.start_ready())
+
+    def testInflightLimits(self):
+        """Tests the in-flight window and the per-host limit."""
+        frontier = site_diff.CrawlFrontier(-1, 3, 2)
+        for url in ('http://a/1', 'http://a/2', 'http://a/3',
+                    'http://b/1', 'http://b/2'):
+            frontier.add(url, 1)
+
+        # The third URL from host a waits for one of the first two.
+        self.assertEquals(['http://a/1', 'http://a/2', 'http://b/1'],
+                          frontier.start_ready())
+        self.assertEquals([], frontier.start_ready())
+
+        frontier.finish('http://b/1', set())
+        self.assertEquals(['http://b/2'], frontier.start_ready())
+        frontier.finish('http://a/1', set())
+        self.assertEquals(['http://a/3'], frontier.start_ready())
+        self.assertEquals(2, frontier.inflight['a'])
+        self.assertEquals(1, frontier.inflight['b'])
+
+    def testFetchesEachUrlOnce(self):
+        """Tests URLs linked from many pages are only fetched once."""
+        links = dict(
+            ('http://a/%d' % i, ['http://a/%d' % j for j in xrange(10)])
+            for i in xrange(10))
+        links['http://a/'] = ['http://a/0']
+        fetched, frontier = self.crawl(links, max_inflight=3)
+        self.assertEquals(11, len(fetched))
+        self.assertEquals(sorted(fetched), sorted(set(fetched)))
+        self.assertEquals(0, sum(frontier.inflight.values()))
+
+
 class HtmlRewritingTest(unittest.TestCase):
     """Tests the HTML rewriting functions."""
 
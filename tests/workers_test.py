@@ -41,6 +41,7 @@ class EchoThread(workers.WorkerThread):
         # WorkflowThread before they're marked as 'done' by being handled
         # in this thread. Without this sleep the workers_tests are flaky.
         time.sleep(0.1)
+        item.handle_count += 1
         if item.should_die:
             raise Exception('Dying on %d' % item.input_number)
         item.output_number = item.input_number
@@ -53,6 +54,7 @@ class EchoItem(workers.WorkItem):
         self.input_number = number
         self.output_number = None
         self.should_die = should_die
+        self.handle_count = 0
 
 
 class EchoChild(workers.WorkflowItem):
@@ -297,6 +299,23 @@ class RootWaitAllFireAndForget(workers.WorkflowItem):
         raise workers.Return('Waited for all of them')
 
 
+class RootWaitAnyStreamingWorkflow(workers.WorkflowItem):
+    def run(self, child_count):
+        jobs = [EchoItem(i) for i in xrange(child_count)]
+        pending = jobs
+        while pending:
+            # Yielding items that are still in flight must not run them
+            # again.
+            yield workers.WaitAny(pending)
+            pending = [x for x in pending if not x.done]
+
+        # Give any duplicate runs of the items time to happen.
+        yield timer_worker.TimerItem(1)
+        assert [x.handle_count for x in jobs] == [1] * child_count, (
+            [x.handle_count for x in jobs])
+        raise workers.Return(sum(x.output_number for x in jobs))
+
+
 class WorkflowThreadTest(unittest.TestCase):
     """Tests for the WorkflowThread worker."""
 
@@ -396,6 +415,16 @@ class WorkflowThreadTest(unittest.TestCase):
         finished.check_result()
         self.assertEquals('Dying on 42', work.result)
 
+    def testWaitAnyStreaming(self):
+        """Tests repeatedly waiting for any of the items still running."""
+        work = RootWaitAnyStreamingWorkflow(5)
+        work.root = True
+        self.coordinator.input_queue.put(work)
+        finished = self.coordinator.output_queue.get()
+        self.assertTrue(work is finished)
+        finished.check_result()
+        self.assertEquals(10, work.result)
+
     def testFireAndForget(self):
         """Tests running fire-and-forget WorkItems."""
         work = RootFireAndForgetWorkflow()